@@ -33,6 +33,17 @@ SERVER_EMAIL = ""  # what address does the email come from?
 MANTIS_STATUS_MESSAGE = "status"
 MANTIS_STATUS_RESPONSE = "online"
 
+# Cache for reference data responses (crops, scenarios and regions) - the local memory cache is per process, so
+# use a shared one (memcached, redis or the database cache) to see admin edits in every process right away
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "npsat",
+        # enough for the list responses under one reference data version
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    }
+}
+
 # Admin bot
 # change the string in deployment
 ADMIN_BOT_USERNAME = "TEMPLATE_ADMIN_USERNAME"
@@ -64,3 +75,35 @@ LandUseRasters = {
     2035: os.path.join(DataFolder, "Tulare.gdb", "LU_2005.tif"),
     2050: os.path.join(DataFolder, "Tulare.gdb", "LU_2005.tif"),
 }
+
+# Python Mantis engine tuning
+LoadingBlockYears = 16  # how many interpolated years of loadings the engine holds in memory at once
+TileSize = 512  # pixels along each side of the spatial tiles the engine processes independently - None for one tile
+EngineProcesses = None  # worker processes for running tiles in parallel - None uses one per CPU, 1 runs them in-process
+RasterCacheBytes = 2 * 1024**3  # memory budget for decoded rasters the engine keeps between runs - the worker processes split it between them, and the server process has a budget this size of its own
+UnitResponseFunctionRaster = None  # multiband raster of URFs on the model grid - band N is N years into the future
+RasterStoreFolder = os.path.join(DataFolder, "raster_store")  # filled by the ingest_rasters command
+EngineDtype = "float64"  # "float32" halves the engine's memory and bandwidth - year sums stay within ~1e-6 of float64
+EngineLoadScenario = "GNLM"  # mantis_id of the load scenario NgwRasters hold - only its runs can use the Python engine
+EngineFlowScenario = None  # mantis_id of the flow scenario UnitResponseFunctionRaster was made for - only its runs can use the Python engine
+LocalEngineMaxPixels = 250000  # runs whose regions cover more pixels than this go to a Mantis server instead
+UnsatDepthRasters = {}  # unsat scenario mantis_id -> raster of depth to the water table on the model grid
+RechargeRaster = None  # raster of recharge rates on the model grid - delays are depth * water content / recharge
+RegionMaskFolder = os.path.join(RasterStoreFolder, "region_masks")  # region geometries rasterized onto the model grid
+EngineStateFolder = os.path.join(RasterStoreFolder, "run_states")  # what completed runs keep so a later sim_end_year only computes the added years
+EngineStateMaxSimEndYear = 2500  # how far kept runs can be extended - loadings delayed past this are left out of them
+
+# Region geometry
+GeometrySimplifyLevels = {  # ?simplify= level -> (Douglas-Peucker tolerance in degrees, decimals to round to)
+    1: (0.0002, 5),
+    2: (0.001, 4),
+    3: (0.005, 3),
+}
+RegionGeometryBatchSize = 200  # most regions /api/region_geometry/ returns geometries for in one request
+TopologyFolder = os.path.join(DataFolder, "topology")  # TopoJSON of each region type, built from the regions when first asked for
+TileFolder = os.path.join(DataFolder, "tiles")  # web mercator tiles of region geometry - fill it ahead of time with the pregenerate_tiles command
+TileMaxZoom = 14  # deepest zoom level tiles are served for
+TilePregenerateZooms = (5, 10)  # zoom levels pregenerate_tiles renders by default, first to last
+RegionIndexCellSize = 0.1  # degrees across each cell of the grid used to find regions at a point
+RegionContainmentSamples = 400  # about how many points to sample in each region when working out how much of it is inside other regions
+RegionContainmentMinimumOverlap = 0.01  # smallest fraction of a region inside another that's kept as containment
@@ -61,6 +61,23 @@ urlpatterns = [
     url(r"^api/feed/", views.FeedOnDashboard.as_view()),
     # model status
     url(r"^api/model_run__status/", views.GetModelStatus.as_view()),
+    # crops each scenario uses
+    url(r"^api/scenario_crops/$", views.ScenarioCrops.as_view()),
+    # regions without geometry, and the geometries of several regions at once
+    url(r"^api/region_index/$", views.RegionIndex.as_view()),
+    url(r"^api/region_geometry/$", views.RegionGeometry.as_view()),
+    # geometries by their hash - immutable
+    url(r"^api/geometry/(?P<sha256>[0-9a-f]{64})/$", views.GeometryBlobView.as_view()),
+    # whole region types as TopoJSON
+    url(
+        r"^api/region_topology/(?P<region_type>[0-9]+)/$",
+        views.RegionTopology.as_view(),
+    ),
+    # web mercator tiles of region geometry
+    url(
+        r"^api/region_tiles/(?P<region_type>[0-9]+)/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)/?$",
+        views.RegionTiles.as_view(),
+    ),
     # DRF docs from drf-yasg
     # url(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     # url(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
@@ -4,7 +4,13 @@ from django.contrib import admin
 
 from . import models
 
-admin.site.register(models.Region)
+
+class RegionAdmin(admin.ModelAdmin):
+    # a dropdown of geometries would load every one of them
+    raw_id_fields = ["geometry_blob"]
+
+
+admin.site.register(models.Region, RegionAdmin)
 admin.site.register(models.Crop)
 admin.site.register(models.CropGroup)
 admin.site.register(models.MantisServer)
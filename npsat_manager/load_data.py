@@ -5,6 +5,7 @@ import json
 from npsat_backend import settings
 
 from npsat_manager import models
+from npsat_manager.support import containment, topology
 from django.contrib.auth.models import User
 from npsat_backend import local_settings
 
@@ -42,6 +43,11 @@ def load_regions():
     load_townships()
     load_b118_basin()
 
+    # saving the regions cleared out any old topologies, so build them again now rather than on the first request
+    for region_type, _ in models.Region.REGION_TYPE:
+        topology.write_topology(region_type)
+    containment.update_containment()
+
 
 def load_crops(
     crop_csv=os.path.join(data_folder, "crops", "gnlm_swat_matched.csv"),
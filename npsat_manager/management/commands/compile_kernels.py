@@ -0,0 +1,28 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+log = logging.getLogger("npsat.commands.compile_kernels")
+
+
+class Command(BaseCommand):
+    help = "Compiles the numba kernels for this machine's CPU and saves them to numba's cache, so engine processes load them instead of compiling on their first run. Run it after each deploy."
+
+    def handle(self, *args, **options):
+        try:
+            from npsat_manager import mantis_numba
+        except ImportError as error:
+            raise CommandError("numba isn't available: {}".format(error))
+
+        total = 0
+        for name, signature, elapsed, from_cache in mantis_numba.warm_up():
+            total += elapsed
+            self.stdout.write(
+                "{}{} - {} in {:.3f}s".format(
+                    name,
+                    signature,
+                    "loaded from cache" if from_cache else "compiled",
+                    elapsed,
+                )
+            )
+        self.stdout.write("All kernels ready in {:.3f}s".format(total))
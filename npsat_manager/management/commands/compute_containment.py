@@ -0,0 +1,15 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from npsat_manager.support import containment
+
+log = logging.getLogger("npsat.commands.compute_containment")
+
+
+class Command(BaseCommand):
+    help = "Works out which regions lie inside regions of other types again - run it after changing region geometries outside of loading regions"
+
+    def handle(self, *args, **options):
+        count = containment.update_containment()
+        self.stdout.write("Stored containment for {} pairs of regions".format(count))
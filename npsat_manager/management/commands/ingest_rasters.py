@@ -0,0 +1,126 @@
+import logging
+import os
+import shutil
+
+from django.core.management.base import BaseCommand, CommandError
+
+from npsat_backend import settings
+from npsat_manager.sparse_urf import SparseURF, STORE_FOLDER_NAME
+from npsat_manager.support import compatibility, raster_store
+
+log = logging.getLogger("npsat.commands.ingest_rasters")
+
+
+class Command(BaseCommand):
+    help = "Copies the Ngw, land use, unsaturated zone and URF rasters into the memory-mapped raster store so the Python engine can read them without arcpy or GDAL"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--folder",
+            type=str,
+            dest="folder",
+            default=settings.RasterStoreFolder,
+            help="Folder of the raster store to write to",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            dest="force",
+            default=False,
+            help="Ingest rasters again even if the store already has a current copy",
+        )
+
+    def handle(self, *args, **options):
+        if not compatibility.ARCPY and not compatibility.GDAL:
+            raise CommandError(
+                "Ingesting rasters needs arcpy or GDAL to read the originals"
+            )
+
+        store = raster_store.get_raster_store(options["folder"])
+
+        sources = list(settings.NgwRasters.values()) + list(
+            settings.LandUseRasters.values()
+        )
+        sources += list(settings.UnsatDepthRasters.values())
+        if settings.RechargeRaster is not None:
+            sources.append(settings.RechargeRaster)
+        # land use years share rasters - only ingest each once
+        sources = list(dict.fromkeys(sources))
+
+        # everything has to be on the same grid so that one window means the same pixels in every input
+        grid = compatibility.get_raster_info(sources[0])
+        for source in sources:
+            self._ingest(store, source, grid, options["force"], multiband=False)
+
+        if settings.UnitResponseFunctionRaster is not None:
+            ingested = self._ingest(
+                store,
+                settings.UnitResponseFunctionRaster,
+                grid,
+                options["force"],
+                multiband=True,
+                name="unit_response_functions",
+            )
+            sparse_folder = os.path.join(store.folder, STORE_FOLDER_NAME)
+            if ingested or not os.path.exists(sparse_folder):
+                self._write_sparse(store.open("unit_response_functions"), sparse_folder)
+
+    def _ingest(self, store, source, grid, force, multiband, name=None):
+        """ingests a single raster - returns False if the store already had a current copy"""
+        existing_name, _ = store.find(source)
+        if existing_name is not None and not force:
+            self.stdout.write(
+                "{} is already ingested as {}".format(source, existing_name)
+            )
+            return False
+        if name is None:
+            # replace the raster's own entry when forced to ingest it again
+            name = existing_name or raster_store.store_name(source)
+
+        info = compatibility.get_raster_info(source)
+        if info.shape != grid.shape or not _same_geotransform(
+            info.geotransform, grid.geotransform
+        ):
+            raise CommandError(
+                "{} isn't aligned with the model grid - shape {} and geotransform {}, expected {} and {}".format(
+                    source, info.shape, info.geotransform, grid.shape, grid.geotransform
+                )
+            )
+
+        if multiband:
+            array = compatibility.read_raster_bands(source)
+        else:
+            array = compatibility.read_raster_window(source)
+
+        store.add(
+            name,
+            array,
+            source=source,
+            geotransform=info.geotransform,
+            nodata=info.nodata,
+            block_shape=info.block_shape,
+        )
+        self.stdout.write(
+            "Ingested {} as {} - {} {} ({:.1f} MB)".format(
+                source, name, array.shape, array.dtype, array.nbytes / 1024**2
+            )
+        )
+        return True
+
+    def _write_sparse(self, unit_response_functions, folder):
+        """compacts the URFs and swaps the result in for any old compact copy"""
+        sparse = SparseURF.from_dense(unit_response_functions)
+        temporary_folder = folder + ".tmp"
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        sparse.save(temporary_folder)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(temporary_folder, folder)
+        self.stdout.write(
+            "Wrote compact URFs - {:.1f} MB instead of {:.1f} MB".format(
+                sparse.nbytes / 1024**2, unit_response_functions.nbytes / 1024**2
+            )
+        )
+
+
+def _same_geotransform(first, second, tolerance=1e-6):
+    return all(abs(a - b) <= tolerance for a, b in zip(first, second))
@@ -0,0 +1,61 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from npsat_backend import settings
+from npsat_manager import models
+from npsat_manager.support import tiles
+
+log = logging.getLogger("npsat.commands.pregenerate_tiles")
+
+
+class Command(BaseCommand):
+    help = "Renders the region geometry tiles ahead of time, so maps don't wait on tiles being made on their first request. Run it after loading regions."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--region_type",
+            type=int,
+            dest="region_types",
+            action="append",
+            help="Region type to render tiles for - can be given more than once. Defaults to every type",
+        )
+        parser.add_argument(
+            "--min_zoom",
+            type=int,
+            dest="min_zoom",
+            default=settings.TilePregenerateZooms[0],
+            help="First zoom level to render",
+        )
+        parser.add_argument(
+            "--max_zoom",
+            type=int,
+            dest="max_zoom",
+            default=settings.TilePregenerateZooms[1],
+            help="Last zoom level to render",
+        )
+
+    def handle(self, *args, **options):
+        region_types = options["region_types"] or [
+            region_type for region_type, _ in models.Region.REGION_TYPE
+        ]
+        unknown = set(region_types) - set(dict(models.Region.REGION_TYPE))
+        if unknown:
+            raise CommandError("Unknown region types {}".format(sorted(unknown)))
+        if not 0 <= options["min_zoom"] <= options["max_zoom"] <= settings.TileMaxZoom:
+            raise CommandError(
+                "Zoom levels need to be in order, from 0 up to TileMaxZoom ({})".format(
+                    settings.TileMaxZoom
+                )
+            )
+
+        zooms = range(options["min_zoom"], options["max_zoom"] + 1)
+        for region_type in region_types:
+            # start from nothing, so no tile made from older regions is left behind
+            tiles.remove_tiles(region_type)
+            count = tiles.pregenerate_tiles(region_type, zooms)
+            self.stdout.write(
+                "Wrote {} tiles for {}".format(
+                    count, dict(models.Region.REGION_TYPE)[region_type]
+                )
+            )
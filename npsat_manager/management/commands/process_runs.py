@@ -16,19 +16,22 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         self.mantis_server = None
+        self.local_server = None
         self.last_warning_time = 0
 
-        while self.mantis_server is None:
+        while self.mantis_server is None and self.local_server is None:
 
             mantis_servers = mantis_manager.initialize()
             # asyncio.run(mantis_manager.main_model_run_loop(mantis_servers))  # see note on main_model_run_loop for why we're not using it
 
             self._waiting_runs = []
-            if len(mantis_servers) > 0:
-                self.mantis_server = mantis_servers[
-                    0
-                ]  # leaving in place the infra for multiple servers in the future, but we'll use one for now
-            else:
+            # leaving in place the infra for multiple servers in the future, but we'll use one of each backend for now
+            for server in mantis_servers:
+                if server.backend == models.MantisServer.PYTHON_ENGINE:
+                    self.local_server = self.local_server or server
+                else:
+                    self.mantis_server = self.mantis_server or server
+            if self.mantis_server is None and self.local_server is None:
                 # warn once a day if run processing isn't happening
                 if (
                     datetime.datetime.utcnow().timestamp() - 86400
@@ -55,13 +58,40 @@ class Command(BaseCommand):
                     time.sleep(2)
                     continue
 
+                sent = 0
                 for run in self._waiting_runs:
-                    self.mantis_server.send_command(model_run=run)
+                    server = self._choose_server(run)
+                    if server is None:
+                        continue
+                    server.send_command(model_run=run)
+                    sent += 1
+
+                # if only runs nothing here can process are waiting, don't spin on them
+                if sent == 0:
+                    time.sleep(2)
             except:
                 log.error("Encountered problem running model run - recovering")
                 log.error(traceback.format_exc())
                 raise
 
+    def _choose_server(self, run):
+        """
+                Small jobs the Python engine can handle run in process, which skips the network round trip and
+                waiting behind bigger runs in Mantis' queue. Everything else goes to the Mantis server, including
+                runs the check fails on (a missing raster or a bad geometry), so one of those can't stop the loop.
+        """
+        try:
+            if self.local_server is not None and run.can_run_locally:
+                return self.local_server
+        except Exception:
+            log.error(
+                "Couldn't check whether model run {} can run locally - sending it to Mantis".format(
+                    run.id
+                )
+            )
+            log.error(traceback.format_exc())
+        return self.mantis_server
+
     def _get_runs(self):
         new_runs = (
             models.ModelRun.objects.filter(status=models.ModelRun.READY)
@@ -0,0 +1,19 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from npsat_manager import models
+
+log = logging.getLogger("npsat.commands.simplify_regions")
+
+
+class Command(BaseCommand):
+    help = "Remakes the simplified geometries for every region - run it after changing GeometrySimplifyLevels"
+
+    def handle(self, *args, **options):
+        regions = models.Region.objects.exclude(geometry_blob=None).select_related(
+            "geometry_blob"
+        )
+        for region in regions.iterator():
+            region.update_simplified_geometries()
+        self.stdout.write("Simplified {} regions' geometries".format(regions.count()))
@@ -2,14 +2,25 @@
 	TODO: Add issue about division by 100 in setup code
 """
 
+import os
+import mmap
 import numpy
 import logging
+import collections
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 
 import arrow
+import django
+from django.apps import apps
 
 from npsat_backend import settings
 from npsat_manager import models
+from npsat_manager.sparse_urf import SparseURF, STORE_FOLDER_NAME
 from npsat_manager.support import compatibility
+from npsat_manager.support.raster_cache import raster_cache
+from npsat_manager.support.region_masks import region_masks, runs_to_mask, runs_window
 
 log = logging.getLogger("npsat.mantis")
 
@@ -49,24 +60,75 @@ max_year = min_year + time_range
 """
 
 
-def make_weight_raster(land_use, modifications):
+# same code Mantis uses for the "All Other Crops" proportion in its input message
+ALL_OTHER_CROPS_CODE = -9
+
+
+def make_weight_lookup(modifications, crop_code_field="caml_code"):
     """
-            Given a land use raster and a set of weights, applies the weights to each land use type
-            then sets everything else to 1 so that the raster can be used as a multiplier later
-    :param land_use: path to a land use raster on disk
+            Reduces a set of modifications to a plain dict of land use code -> weight, so that reclassifying
+            doesn't need the database anymore. The "All Other Crops" proportion, if there is one, is stored
+            under ALL_OTHER_CROPS_CODE and becomes the weight for every land use code without its own.
     :param modifications: an iterable of npsat_manager.models.Modification objects
-    :return:
+    :param crop_code_field: which code on Crop the land use rasters are classified with
+    :return: dict of land use code -> weight
     """
-    land_use_array = compatibility.raster_to_numpy_array(land_use)
-    land_use_array += 10000  # offset everything by 10000 so we can identify everything that's still a default later
+    weight_lookup = {}
     for modification in modifications:
-        land_use_array[
-            land_use_array == modification.crop.caml_code
-        ] = modification.reduction
+        if modification.crop.crop_type == models.Crop.ALL_OTHER_CROPS:
+            weight_lookup[ALL_OTHER_CROPS_CODE] = float(modification.proportion)
+        else:
+            code = getattr(modification.crop, crop_code_field)
+            if code is not None:
+                weight_lookup[int(code)] = float(modification.proportion)
+    return weight_lookup
 
-    land_use_array[land_use_array >= 10000] = 1
 
-    return land_use_array
+def apply_weight_lookup(land_use_array, weight_lookup, dtype=numpy.float64):
+    """
+            Reclassifies a land use array into weights with a single lookup table index instead of one
+            comparison pass per modification. Anything without its own weight (including negative nodata
+            values) gets the "All Other Crops" weight, or 1 when there isn't one, so that the result can
+            be used as a multiplier later.
+
+            Given a list of K weight lookups, the table gets a row for each and the same single index
+            makes a K deep stack of weights.
+    :param land_use_array: integer land use codes
+    :param weight_lookup: dict of land use code -> weight, as made by make_weight_lookup, or a list of them
+    :param dtype: numpy dtype of the weights
+    :return: array of weights the same shape as land_use_array, with a leading K axis for a list of lookups
+    """
+    batch = isinstance(weight_lookup, (list, tuple))
+    weight_lookups = weight_lookup if batch else [weight_lookup]
+    codes = [code for lookup in weight_lookups for code in lookup if code >= 0]
+    max_code = int(max(land_use_array.max(initial=0), max(codes, default=0)))
+
+    # the extra slot at the end holds the default weight for anything we can't index directly
+    lookup_table = numpy.empty((len(weight_lookups), max_code + 2), dtype=dtype)
+    for row, lookup in enumerate(weight_lookups):
+        lookup_table[row] = lookup.get(ALL_OTHER_CROPS_CODE, 1)
+        for code, weight in lookup.items():
+            if code >= 0:
+                lookup_table[row, code] = weight
+
+    indices = land_use_array.astype(numpy.intp)
+    indices[indices < 0] = max_code + 1
+    weights = lookup_table[:, indices]
+    return weights if batch else weights[0]
+
+
+def make_weight_raster(land_use, weight_lookup, window=None, dtype=numpy.float64):
+    """
+            Given a land use raster and a set of weights, applies the weights to each land use type
+            then sets everything else to 1 so that the raster can be used as a multiplier later
+    :param land_use: path to a land use raster on disk
+    :param weight_lookup: dict of land use code -> weight, as made by make_weight_lookup, or a list of them
+    :param window: optional compatibility.Window to only reclassify part of the raster
+    :param dtype: numpy dtype of the weights
+    :return:
+    """
+    land_use_array = raster_cache.read(land_use, window=window)
+    return apply_weight_lookup(land_use_array, weight_lookup, dtype=dtype)
 
 
 def run(
@@ -103,52 +165,330 @@ def create_ranges_nd(start, stop, N, endpoint=True):
     return start[..., None] + steps[..., None] * numpy.arange(N)
 
 
-def make_annual_loadings(modifications, years=settings.NgwRasters.keys()):
+# when a run's reductions phase in - modifications take effect gradually from start_year, when nothing has
+# changed yet, through end_year, when they're fully in place. The engine simulates through sim_end_year, holding
+# the last data year's loadings from then on - None stops at the last data year.
+ReductionSchedule = collections.namedtuple(
+    "ReductionSchedule", ["start_year", "end_year", "sim_end_year"]
+)
+
+
+def default_reduction_schedule():
+    """modifications apply in full from settings.ChangeYear on, and the run ends at the last data year"""
+    return ReductionSchedule(settings.ChangeYear, settings.ChangeYear, None)
+
+
+def reduction_ramp(years, start_year, end_year):
+    """
+            How far along the reductions are in each year - 0 through start_year, rising linearly to 1 at end_year
+            and staying there. A start year on or after the end year makes a step at the start year.
+    :param years: array of years
+    :return: float64 array the shape of years, between 0 and 1
+    """
+    years = numpy.asarray(years, dtype=numpy.float64)
+    if end_year <= start_year:
+        return (years >= start_year).astype(numpy.float64)
+    return numpy.clip((years - start_year) / (end_year - start_year), 0, 1)
+
+
+def make_base_loadings(years=settings.NgwRasters.keys(), window=None, dtype=None):
+    """
+            Reads the unmodified loadings for just the years we have precalculated (1945, 1960, etc). They come
+            straight from the raster cache, so every run over the same block of the grid shares them.
+    :param years: the data years to load - keys of settings.NgwRasters
+    :param window: optional compatibility.Window - only that block of each raster is loaded
+    :param dtype: numpy dtype to compute in - defaults to settings.EngineDtype. Everything downstream (interpolation
+                                    and convolution) follows the dtype of the loadings.
+    :return: dict of data year -> 2D read only loading array
+    """
+    dtype = numpy.dtype(dtype or settings.EngineDtype)
+    return {
+        year: raster_cache.read(settings.NgwRasters[year], window=window, dtype=dtype)
+        for year in years
+    }
+
 
-    # First make the loadings for just the years we have precalculated (1945, 1960, etc)
+def make_loading_changes(
+    weight_lookup, years=settings.NgwRasters.keys(), window=None, dtype=None
+):
+    """
+            How much fully applied modifications change the loadings in each data year - (weight - 1) * Ngw, so the
+            modified loading is the base loading plus the change. Changes are cached alongside the rasters for each
+            weight lookup, so runs that only move the reduction years don't recompute them.
+    :param weight_lookup: dict of land use code -> weight, as made by make_weight_lookup. A list of K lookups
+                                    makes changes for K scenarios at once - each band then has a leading K axis.
+    :param years: the data years to load - keys of settings.NgwRasters
+    :param window: optional compatibility.Window - only that block of each raster is loaded
+    :param dtype: numpy dtype to compute in - defaults to settings.EngineDtype
+    :return: dict of data year -> loading change array
+    """
+    dtype = numpy.dtype(dtype or settings.EngineDtype)
+    if isinstance(weight_lookup, (list, tuple)):
+        batch_changes = [
+            make_loading_changes(lookup, years=years, window=window, dtype=dtype)
+            for lookup in weight_lookup
+        ]
+        return {
+            year: numpy.stack([changes[year] for changes in batch_changes])
+            for year in years
+        }
 
-    print("Building Annual Loadings")
-    loadings = {}
+    changes = {}
     for year in years:
-        print(year)
-        base_loading_matrix = compatibility.raster_to_numpy_array(
-            settings.NgwRasters[year]
-        )
-        if (
-            year >= settings.ChangeYear
-        ):  # if this year is after our reductions are supposed to be made
+
+        def compute(window, year=year):
             weight_matrix = make_weight_raster(
-                settings.LandUseRasters[year], modifications=modifications
+                settings.LandUseRasters[year], weight_lookup, window=window, dtype=dtype
+            )
+            base_loading_matrix = raster_cache.read(
+                settings.NgwRasters[year], window=window, dtype=dtype
             )
-            loadings[year] = weight_matrix * base_loading_matrix
-        else:  # otherwise, use the straight Ngw values - no changes have been made since they're in the past
-            loadings[year] = base_loading_matrix
+            return (weight_matrix - 1) * base_loading_matrix
 
-    # Now that we have the values for the base years, we want to interpolate between them to make ndarrays for each year
+        changes[year] = raster_cache.read_derived(
+            "loading_change {} {}".format(sorted(weight_lookup.items()), dtype),
+            [settings.NgwRasters[year], settings.LandUseRasters[year]],
+            compute,
+            window=window,
+        )
+    return changes
 
-    print("Interpolating between years")
-    sorted_years = sorted(years)
-    all_years_data = None
-    for i, year in enumerate(sorted_years):
-        print(year)
-        if year == sorted_years[-1]:  # if it's the last year, we have special behavior
-            break
 
-        next_data_year = sorted_years[i + 1]
-        interval_size = next_data_year - year
-        all_years_in_range = create_ranges_nd(
-            loadings[year], loadings[next_data_year], interval_size
-        )
-        if all_years_data is None:
-            all_years_data = all_years_in_range
+def count_annual_years(loadings, last_year=None):
+    """
+            Number of annual bands iterate_annual_loadings will produce for a dict of data year loadings -
+            every year from the first data year through last_year (the last data year by default), inclusive
+    """
+    if last_year is None:
+        last_year = max(loadings)
+    return last_year - min(loadings) + 1
+
+
+def iterate_annual_loadings(
+    loadings, block_size=settings.LoadingBlockYears, last_year=None
+):
+    """
+            Generator that interpolates annual loading bands between the data years on demand, instead of
+            materializing the whole years x rows x cols cube. Bands are written into a single preallocated
+            buffer of block_size years, so peak memory is bounded by the block size rather than the simulated period.
+
+            Yields (year_index, block) tuples - year_index is the offset of the block's first band from the first
+            data year, and block is a (years, rows, cols) view into the buffer. The buffer is reused for the next
+            block, so consumers must be done with (or copy) a block before asking for the next one.
+
+            Each band is linearly interpolated between the data years that surround it - a data year's band is its
+            own loading, and years after the last data year repeat its band.
+    :param loadings: dict of data year -> loading array, as returned by make_base_loadings
+    :param block_size: how many annual bands to yield at a time
+    :param last_year: the last year to make a band for - defaults to the last data year
+    :return:
+    """
+    sorted_years = sorted(loadings)
+    if last_year is None:
+        last_year = sorted_years[-1]
+    first_band = loadings[sorted_years[0]]
+    buffer = numpy.empty(
+        (block_size,) + first_band.shape,
+        dtype=numpy.result_type(first_band, numpy.float32),
+    )
+
+    block_start = 0
+    filled = 0
+    for year in range(sorted_years[0], last_year + 1):
+        if year in loadings:
+            buffer[filled] = loadings[year]
+            if year != sorted_years[-1]:
+                start = loadings[year]
+                next_data_year = sorted_years[sorted_years.index(year) + 1]
+                step = (loadings[next_data_year] - start) / (next_data_year - year)
+                offset = 0
+        elif year > sorted_years[-1]:
+            buffer[filled] = loadings[sorted_years[-1]]
         else:
-            all_years_data = numpy.concatenate(
-                [all_years_data, all_years_in_range], -1
-            )  # stack them on the last axis now
+            offset += 1
+            numpy.multiply(step, offset, out=buffer[filled])
+            buffer[filled] += start
+        filled += 1
+
+        if filled == block_size:
+            yield block_start, buffer
+            block_start += filled
+            filled = 0
+
+    if filled:
+        yield block_start, buffer[:filled]
+
+
+def iterate_modified_loadings(
+    loadings, changes, schedule=None, block_size=settings.LoadingBlockYears
+):
+    """
+            Generator of annual blocks of modified loadings - base + ramp(t) * change, where the ramp follows the
+            schedule's reduction years. Base and change bands are interpolated block by block, and the ramp for the
+            block is broadcast over space in a single multiply-add, so the ramp costs one pass over each block no
+            matter how many years it spans. Blocks entirely before the reductions start skip the change altogether.
+
+            Yields (year_index, block) tuples the same way iterate_annual_loadings does, and the same caveat about
+            the buffer being reused applies.
+    :param loadings: dict of data year -> base loading array, as returned by make_base_loadings
+    :param changes: dict of data year -> loading change array, as returned by make_loading_changes. Changes for
+                                    K scenarios make (years, K, ...) blocks.
+    :param schedule: ReductionSchedule - defaults to default_reduction_schedule()
+    :param block_size: how many annual bands to yield at a time
+    :return:
+    """
+    if schedule is None:
+        schedule = default_reduction_schedule()
+    first_year = min(loadings)
+    first_change = changes[first_year]
+    buffer = numpy.empty(
+        (block_size,) + first_change.shape,
+        dtype=numpy.result_type(first_change, numpy.float32),
+    )
+    # base bands are (rows, cols) and change bands can be (K, rows, cols), so line the base up with the change
+    base_axes = (slice(None),) + (None,) * (
+        first_change.ndim - loadings[first_year].ndim
+    )
+
+    for (year_index, base_block), (_, change_block) in zip(
+        iterate_annual_loadings(
+            loadings, block_size=block_size, last_year=schedule.sim_end_year
+        ),
+        iterate_annual_loadings(
+            changes, block_size=block_size, last_year=schedule.sim_end_year
+        ),
+    ):
+        n_block_years = base_block.shape[0]
+        block = buffer[:n_block_years]
+        ramp = reduction_ramp(
+            first_year + year_index + numpy.arange(n_block_years),
+            schedule.start_year,
+            schedule.end_year,
+        ).astype(buffer.dtype)
+        if ramp.any():
+            numpy.multiply(
+                change_block, ramp.reshape((-1,) + (1,) * first_change.ndim), out=block
+            )
+            block += base_block[base_axes]
+        else:
+            block[...] = base_block[base_axes]
+        yield year_index, block
+
+
+def make_annual_loadings(
+    modifications, years=settings.NgwRasters.keys(), schedule=None
+):
+    """
+            Builds the full rows x cols x years loading cube in one array. The engine itself streams blocks from
+            iterate_modified_loadings instead - this remains for callers that want the whole cube at once, and fills
+            a single preallocated array rather than concatenating each interpolated range onto the last.
+    :param modifications: an iterable of npsat_manager.models.Modification objects
+    :param years: the data years to load - keys of settings.NgwRasters
+    :param schedule: ReductionSchedule - defaults to default_reduction_schedule()
+    :return: 3D array with years on the last axis
+    """
+    if schedule is None:
+        schedule = default_reduction_schedule()
+    loadings = make_base_loadings(years=years)
+    changes = make_loading_changes(make_weight_lookup(modifications), years=years)
+
+    log.info("Interpolating between years")
+    first_band = next(iter(loadings.values()))
+    all_years_data = numpy.empty(
+        first_band.shape + (count_annual_years(loadings, schedule.sim_end_year),),
+        dtype=numpy.result_type(first_band, numpy.float32),
+    )
+    for year_index, block in iterate_modified_loadings(loadings, changes, schedule):
+        all_years_data[..., year_index : year_index + block.shape[0]] = numpy.moveaxis(
+            block, 0, -1
+        )  # stack them on the last axis
 
     return all_years_data
 
 
+def convolve_and_sum_streaming(
+    loading_blocks,
+    n_years,
+    unit_response_functions=None,
+    n_series=None,
+    return_state=False,
+):
+    """
+            Convolves loadings with the unit response functions one block of years at a time, so it can consume
+            iterate_annual_loadings directly and never needs the whole loading cube in memory.
+
+            Since we only want the spatial sum for each year, the convolution for every pixel and the sum across
+            space can be done together - for each loading year, multiplying its band by the URFs for every lag
+            is a single matrix product, and each row of that product lands in the output starting at that year.
+            This is a causal convolution - loadings only arrive in the same or later years.
+
+            The URFs are cast to the loadings' dtype, so with settings.EngineDtype set to float32 the matrix products
+            run in float32 - half the memory traffic of float64. Each product sums over one block of years and the
+            tile's pixels, and those partial sums are accumulated into a float64 output so rounding doesn't build up
+            over the years or across tiles. Against float64, float32 year sums differ by a relative 1e-6 or so.
+
+            Loadings for several scenarios can be convolved in the same pass - their rows are stacked into the
+            same matrix product, so the URFs are only read once for all of them.
+    :param loading_blocks: iterable of (year_index, block) tuples where block is a (years, rows, cols) array,
+                                                    as yielded by iterate_annual_loadings. With n_series, blocks are
+                                                    (years, n_series, rows, cols) instead.
+    :param n_years: total number of years that will be yielded - the length of the output series
+    :param unit_response_functions: A 3D array of (years into the future, rows, cols) - each location has a value
+                                                                    for how much of a loading arrives that many years later.
+                                                                    Can also be a SparseURF, in which case only the stored
+                                                                    values get multiplied.
+    :param n_series: how many scenarios' loadings are in each block, or None for blocks of a single scenario
+    :param return_state: also return what extend_engine_state needs to carry the series on past n_years
+    :return: 1D array with the spatial sum of the convolved loadings for each year, or (n_series, years) with
+                    n_series. With return_state, a tuple of that, the (series, lags - 1) tail of the convolution past
+                    the last year and the (series, lags) spatial sums of the last year's loadings times each lag's URFs.
+    """
+    output = None
+    urfs = None
+    series = n_series or 1
+    start_time = arrow.utcnow()
+    for year_index, block in loading_blocks:
+        block_years = block.shape[0]
+        # years and series x pixels
+        flat_block = block.reshape(block_years * series, -1)
+        if urfs is None:
+            if (
+                unit_response_functions is None
+            ):  # this logic is temporary, but have a safeguard so it's not accidentally used in production
+                if settings.DEBUG:
+                    urfs = numpy.ones(
+                        (n_years, flat_block.shape[1]), dtype=flat_block.dtype
+                    )
+                else:
+                    raise ValueError("Must provide Unit Response Functions!")
+            elif isinstance(unit_response_functions, SparseURF):
+                urfs = unit_response_functions.astype(flat_block.dtype)
+            else:
+                # lags x pixels
+                urfs = unit_response_functions.reshape(
+                    unit_response_functions.shape[0], -1
+                ).astype(flat_block.dtype, copy=False)
+            n_lags = urfs.n_lags if isinstance(urfs, SparseURF) else urfs.shape[0]
+            output = numpy.zeros(
+                (series, n_years + max(n_lags, 1) - 1), dtype=numpy.float64
+            )
+
+        if isinstance(urfs, SparseURF):
+            contributions = urfs.lag_products(flat_block)
+        else:
+            contributions = flat_block @ urfs.T  # years and series x lags
+        contributions = contributions.reshape(block_years, series, -1)
+        for offset, contribution in enumerate(contributions):  # series x lags
+            start = year_index + offset
+            output[:, start : start + contribution.shape[1]] += contribution
+
+    log.debug("Convolution took {}".format(arrow.utcnow() - start_time))
+    results = output[0, :n_years] if n_series is None else output[:, :n_years]
+    if return_state:
+        return results, output[:, n_years:], contributions[-1].astype(numpy.float64)
+    return results
+
+
 def convolve_and_sum(loadings, unit_response_functions=None):
     """
 
@@ -170,7 +510,7 @@ def convolve_and_sum(loadings, unit_response_functions=None):
         if settings.DEBUG:
             unit_response_functions = numpy.ones(
                 (loadings.shape[0], loadings.shape[1], loadings.shape[2]),
-                dtype=numpy.float64,
+                dtype=loadings.dtype,
             )
         else:
             raise ValueError("Must provide Unit Response Functions!")
@@ -218,14 +558,14 @@ def convolve_and_sum_slow(loadings, unit_response_functions=None):
         if settings.DEBUG:
             unit_response_functions = numpy.ones(
                 [loadings.shape[0], loadings.shape[1], loadings.shape[2]],
-                dtype=numpy.float64,
+                dtype=loadings.dtype,
             )
         else:
             raise ValueError("Must provide Unit Response Functions!")
 
     time_span = loadings.shape[0]
     output_matrix = numpy.zeros(
-        [loadings.shape[0], loadings.shape[1], loadings.shape[2]], dtype=numpy.float64
+        [loadings.shape[0], loadings.shape[1], loadings.shape[2]], dtype=loadings.dtype
     )
 
     for year in range(time_span):
@@ -269,19 +609,754 @@ def convolve_and_sum_slow(loadings, unit_response_functions=None):
     results = numpy.sum(output_matrix, [1, 2])  # sum in 2D space
 
 
-def run_mantis(modifications):
-    annual_loadings = make_annual_loadings(modifications=modifications)
-    start_time = arrow.utcnow()
-    results = convolve_and_sum(
-        annual_loadings,
+def load_unit_response_functions():
+    """
+            Loads the URFs configured in settings.UnitResponseFunctionRaster as a (years into the future, rows, cols)
+            array. When they've been ingested into the raster store, this is the memory-mapped copy, so nothing is read
+            until a tile touches it and worker processes can map the same file - and if ingest_rasters also wrote the
+            compact copy, that's used instead.
+    :return: numpy array, SparseURF, or None if no URFs are configured
+    """
+    if settings.UnitResponseFunctionRaster is None:
+        return None
+
+    name, _ = compatibility.RASTER_STORE.find(settings.UnitResponseFunctionRaster)
+    if name is not None:
+        sparse_folder = os.path.join(
+            compatibility.RASTER_STORE.folder, STORE_FOLDER_NAME
+        )
+        if os.path.exists(sparse_folder):
+            return SparseURF.load(sparse_folder)
+        return compatibility.RASTER_STORE.open(name)
+    return compatibility.read_raster_bands(settings.UnitResponseFunctionRaster)
+
+
+# what a run needs to delay loadings through the unsaturated zone - the unsat scenario's mantis_id, the water
+# content, and optionally a travel time in years that overrides the one computed from the scenario's rasters
+UnsaturatedZone = collections.namedtuple(
+    "UnsaturatedZone", ["scenario", "water_content", "travel_time"]
+)
+
+
+def load_unsaturated_zone_factor(scenario, window=None):
+    """
+            Years of travel through the unsaturated zone per unit of water content - the scenario's depth to the
+            water table divided by the recharge rate. This only depends on the scenario, so it's cached per window
+            and every run on the scenario just scales it by its own water content.
+    :param scenario: mantis_id of the unsat scenario - a key of settings.UnsatDepthRasters
+    :param window: optional compatibility.Window
+    :return: read only 2D array - infinite where there's no recharge to carry loadings down
+    """
+    if scenario not in settings.UnsatDepthRasters or settings.RechargeRaster is None:
+        raise ValueError(
+            "No unsaturated zone depth raster configured for unsat scenario {}".format(
+                scenario
+            )
+        )
+    depth_raster = settings.UnsatDepthRasters[scenario]
+
+    def compute(window):
+        depth = raster_cache.read(depth_raster, window=window, dtype=numpy.float64)
+        recharge = raster_cache.read(
+            settings.RechargeRaster, window=window, dtype=numpy.float64
+        )
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            return numpy.where(
+                recharge > 0, numpy.maximum(depth, 0) / recharge, numpy.inf
+            )
+
+    return raster_cache.read_derived(
+        "unsaturated_zone_factor",
+        [depth_raster, settings.RechargeRaster],
+        compute,
+        window=window,
     )
+
+
+def unsaturated_zone_delays(unsaturated_zone, window):
+    """
+            Per pixel delay in years for loadings to cross the unsaturated zone in a window
+    :param unsaturated_zone: UnsaturatedZone
+    :param window: compatibility.Window
+    :return: 2D array of delays
+    """
+    if unsaturated_zone.travel_time is not None:
+        return numpy.full(
+            (window.height, window.width),
+            unsaturated_zone.travel_time,
+            dtype=numpy.float64,
+        )
+    factor = load_unsaturated_zone_factor(unsaturated_zone.scenario, window=window)
+    return factor * unsaturated_zone.water_content
+
+
+def delay_unit_response_functions(unit_response_functions, delays):
+    """
+            Delays loadings by moving each pixel's URF later instead of shifting the loadings themselves - since
+            the engine only sums convolutions, the two give the same result, and this way the loadings stream
+            through unchanged. The whole years of each delay become an integer shift of the lag axis, and the
+            fractional part splits each value between the two lags around it, all as array indexing.
+    :param unit_response_functions: (lags, ...) array of URFs, or a SparseURF
+    :param delays: per pixel delays in years, matching the URFs' pixels. nan or infinite delays mean the
+                                    loadings never arrive.
+    :return: URFs of the same kind, with as many more lags as the longest delay needs
+    """
+    if isinstance(unit_response_functions, SparseURF):
+        return unit_response_functions.delay(delays)
+
+    n_lags = unit_response_functions.shape[0]
+    urfs = numpy.asarray(unit_response_functions).reshape(n_lags, -1)
+    delays = numpy.asarray(delays, dtype=numpy.float64).ravel()
+    arrives = numpy.isfinite(delays)
+    delays = numpy.where(arrives, numpy.maximum(delays, 0), 0)
+    whole_years = numpy.floor(delays).astype(numpy.intp)
+    fraction = numpy.where(arrives, delays - whole_years, 0)
+    kept = numpy.where(arrives, 1 - fraction, 0)
+
+    delayed = numpy.zeros(
+        (n_lags + 1 + whole_years.max(initial=0), urfs.shape[1]), dtype=urfs.dtype
+    )
+    rows = numpy.arange(n_lags)[:, None] + whole_years[None, :]
+    cols = numpy.arange(urfs.shape[1])[None, :]
+    delayed[rows, cols] += urfs * kept
+    delayed[rows + 1, cols] += urfs * fraction
+    return delayed.reshape((delayed.shape[0],) + unit_response_functions.shape[1:])
+
+
+def iterate_tiles(window, tile_size=settings.TileSize):
+    """
+            Splits a window of the raster into square tiles, row by row. Tiles along the right and bottom
+            edges are trimmed to fit.
+    :param window: compatibility.Window of the raster to cover - use compatibility.full_window for all of it
+    :param tile_size: pixels along each side of a tile - None makes a single tile covering the whole window
+    :return: generator of compatibility.Window
+    """
+    if tile_size is None:
+        yield window
+        return
+
+    for row_off in range(window.row_off, window.row_off + window.height, tile_size):
+        for col_off in range(window.col_off, window.col_off + window.width, tile_size):
+            yield compatibility.Window(
+                col_off,
+                row_off,
+                min(tile_size, window.col_off + window.width - col_off),
+                min(tile_size, window.row_off + window.height - row_off),
+            )
+
+
+def run_tile(
+    weight_lookup,
+    window,
+    unit_response_functions=None,
+    mask=None,
+    unsaturated_zone=None,
+    schedule=None,
+    keep_state=False,
+):
+    """
+            Runs reclassification, interpolation, convolution and the spatial sum for a single tile, reading only
+            that tile's block of each raster. Peak memory is the data year loadings for the tile plus one block of
+            interpolated years plus the tile's URFs, no matter how big the whole raster is.
+    :param weight_lookup: dict of land use code -> weight, as made by make_weight_lookup, or a list of them to
+                                    run several scenarios over the same reads of the tile
+    :param window: compatibility.Window for the tile
+    :param unit_response_functions: (years into the future, rows, cols) URFs for the *full* raster, dense or as a
+                                                                    SparseURF - the tile's block is sliced out of them
+    :param mask: optional (window.height, window.width) boolean array - only pixels where it's True are
+                                    interpolated, convolved and summed
+    :param unsaturated_zone: optional UnsaturatedZone to delay the loadings by
+    :param schedule: optional ReductionSchedule for phasing the modifications in - defaults to
+                                    default_reduction_schedule()
+    :param keep_state: return the tile's part of an EngineState too, as convolve_and_sum_streaming does with
+                                    return_state
+    :return: 1D array with this tile's spatial sum for each year - (scenarios, years) for a list of lookups
+    """
+    if schedule is None:
+        schedule = default_reduction_schedule()
+    loadings = make_base_loadings(window=window)
+    changes = make_loading_changes(weight_lookup, window=window)
+    n_series = len(weight_lookup) if isinstance(weight_lookup, (list, tuple)) else None
+    if mask is None:
+        if isinstance(unit_response_functions, SparseURF):
+            unit_response_functions = unit_response_functions.window(window)
+        elif unit_response_functions is not None:
+            unit_response_functions = unit_response_functions[
+                (slice(None),) + window.slices
+            ]
+    else:
+        # everything from here on only needs the masked pixels, as flat arrays
+        mask_rows, mask_cols = numpy.nonzero(mask)
+        loadings = {
+            year: band[..., mask_rows, mask_cols] for year, band in loadings.items()
+        }
+        changes = {
+            year: band[..., mask_rows, mask_cols] for year, band in changes.items()
+        }
+        grid_rows = mask_rows + window.row_off
+        grid_cols = mask_cols + window.col_off
+        if isinstance(unit_response_functions, SparseURF):
+            unit_response_functions = unit_response_functions.select(
+                grid_rows * unit_response_functions.shape[2] + grid_cols
+            )
+        elif unit_response_functions is not None:
+            unit_response_functions = unit_response_functions[:, grid_rows, grid_cols]
+
+    n_years = count_annual_years(loadings, schedule.sim_end_year)
+    if unsaturated_zone is not None and unit_response_functions is not None:
+        delays = unsaturated_zone_delays(unsaturated_zone, window)
+        if mask is not None:
+            delays = delays[mask_rows, mask_cols]
+        # anything delayed past the last year never shows up in the results, so don't make room for it - unless
+        # the run is kept for extending, in which case it might show up in a later one
+        horizon = n_years
+        if keep_state:
+            horizon = max(
+                n_years, settings.EngineStateMaxSimEndYear - min(loadings) + 1
+            )
+        delays = numpy.where(delays < horizon, delays, numpy.inf)
+        unit_response_functions = delay_unit_response_functions(
+            unit_response_functions, delays
+        )
+
+    return convolve_and_sum_streaming(
+        iterate_modified_loadings(loadings, changes, schedule),
+        n_years=n_years,
+        unit_response_functions=unit_response_functions,
+        n_series=n_series,
+        return_state=keep_state,
+    )
+
+
+def share_array(array):
+    """
+            Makes a read only array available to the worker processes without pickling it into every task.
+            Memory-mapped arrays are already backed by a file, so workers just map the same file again. Anything
+            else gets copied once into a shared memory block that the workers attach to.
+    :param array: numpy array or numpy.memmap
+    :return: tuple of (descriptor to hand to attach_shared_array, SharedMemory block or None). The caller owns
+                    the block and needs to close and unlink it when the workers are done.
+    """
+    if isinstance(array, numpy.memmap) and isinstance(
+        array.base, mmap.mmap
+    ):  # a whole mapped file, not a view into one, so the offset and shape describe it fully
+        descriptor = (
+            "memmap",
+            array.filename,
+            array.offset,
+            array.shape,
+            array.dtype.str,
+        )
+        return descriptor, None
+
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return ("shared_memory", block.name, 0, array.shape, array.dtype.str), block
+
+
+def attach_shared_array(descriptor):
+    """
+            Opens an array made available by share_array from inside a worker process
+    :param descriptor: first value returned by share_array
+    :return: tuple of (read only numpy array, SharedMemory block or None) - the block has to stay referenced
+                    for as long as the array is in use
+    """
+    kind, name, offset, shape, dtype = descriptor
+    if kind == "memmap":
+        array = numpy.memmap(name, dtype=dtype, mode="r", offset=offset, shape=shape)
+        return array, None
+
+    block = shared_memory.SharedMemory(name=name)
+    array = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return array, block
+
+
+def share_unit_response_functions(unit_response_functions):
+    """
+            Shares URFs with the worker processes - a dense array through share_array, or each of a SparseURF's
+            arrays separately
+    :return: tuple of (descriptor to hand to attach_unit_response_functions, list of SharedMemory blocks the
+                    caller needs to close and unlink when the workers are done)
+    """
+    if not isinstance(unit_response_functions, SparseURF):
+        descriptor, block = share_array(unit_response_functions)
+        return ("dense", descriptor), [block] if block is not None else []
+
+    descriptors = []
+    blocks = []
+    for array in (
+        unit_response_functions.starts,
+        unit_response_functions.lengths,
+        unit_response_functions.pointers,
+        unit_response_functions.values,
+    ):
+        descriptor, block = share_array(array)
+        descriptors.append(descriptor)
+        if block is not None:
+            blocks.append(block)
+    return ("sparse", unit_response_functions.shape, tuple(descriptors)), blocks
+
+
+def attach_unit_response_functions(descriptor):
+    """
+            Opens URFs made available by share_unit_response_functions from inside a worker process
+    :return: tuple of (numpy array or SparseURF, list of SharedMemory blocks to keep referenced while it's in use)
+    """
+    if descriptor[0] == "dense":
+        array, block = attach_shared_array(descriptor[1])
+        return array, [block] if block is not None else []
+
+    _, shape, descriptors = descriptor
+    arrays = []
+    blocks = []
+    for array_descriptor in descriptors:
+        array, block = attach_shared_array(array_descriptor)
+        arrays.append(array)
+        if block is not None:
+            blocks.append(block)
+    return SparseURF(shape, *arrays), blocks
+
+
+# state for the engine's worker processes. The pool is kept between runs so that each worker's raster cache
+# survives from one run to the next.
+_executor = None
+_executor_processes = None
+# (descriptor, URFs, SharedMemory blocks) of the URFs the worker is attached to
+_worker_unit_response_functions = (None, None, [])
+
+
+def _initialize_worker(raster_cache_bytes):
+    """
+            Runs once in each worker process. On platforms that spawn instead of fork (Windows, where we deploy),
+            the worker starts without Django configured, so set it up before any models get used.
+    :param raster_cache_bytes: the worker's share of settings.RasterCacheBytes - every worker keeps its own
+                                    cache, so each only gets part of the budget
+    """
+    if not apps.ready:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "npsat_backend.settings")
+        django.setup()
+    raster_cache.resize(raster_cache_bytes)
+
+
+def _attach_worker_unit_response_functions(descriptor):
+    """
+            Attaches to the URFs shared for the current run - a worker keeps the last run's URFs attached
+            until a task from a new run arrives
+    """
+    global _worker_unit_response_functions
+
+    attached_descriptor, urfs, blocks = _worker_unit_response_functions
+    if descriptor == attached_descriptor:
+        return urfs
+
+    del urfs
+    _worker_unit_response_functions = (None, None, [])
+    for block in blocks:
+        block.close()
+    if descriptor is not None:
+        urfs, blocks = attach_unit_response_functions(descriptor)
+        _worker_unit_response_functions = (descriptor, urfs, blocks)
+    return _worker_unit_response_functions[1]
+
+
+def _run_tile_in_worker(
+    weight_lookup,
+    window,
+    unit_response_functions_descriptor,
+    mask,
+    unsaturated_zone,
+    schedule,
+    keep_state,
+):
+    unit_response_functions = _attach_worker_unit_response_functions(
+        unit_response_functions_descriptor
+    )
+    return run_tile(
+        weight_lookup,
+        window,
+        unit_response_functions=unit_response_functions,
+        mask=mask,
+        unsaturated_zone=unsaturated_zone,
+        schedule=schedule,
+        keep_state=keep_state,
+    )
+
+
+def get_executor(processes):
+    """
+            Gets the engine's process pool, starting it (or restarting it with a new size) if needed
+    """
+    global _executor, _executor_processes
+
+    if _executor is None or _executor_processes != processes:
+        if _executor is not None:
+            _executor.shutdown()
+        workers = processes or os.cpu_count() or 1
+        _executor = ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_initialize_worker,
+            initargs=(settings.RasterCacheBytes // workers,),
+        )
+        _executor_processes = processes
+    return _executor
+
+
+def shutdown_executor():
+    """Stops the engine's worker processes - the next parallel run starts a fresh pool"""
+    global _executor, _executor_processes
+
+    if _executor is not None:
+        _executor.shutdown()
+    _executor = None
+    _executor_processes = None
+
+
+def run_mantis(
+    modifications,
+    regions=None,
+    unit_response_functions=None,
+    tile_size=settings.TileSize,
+    processes=settings.EngineProcesses,
+    crop_code_field="caml_code",
+    unsaturated_zone=None,
+    schedule=None,
+    state_file=None,
+):
+    """
+            Runs the engine for one set of modifications - the other parameters are passed through to
+            run_weight_lookups.
+
+            With a state file, a run that's been done before with an earlier sim_end_year is carried on from
+            where that one stopped instead of being simulated again - the years it already has are reused, and
+            only the added years get computed. The state file is then updated for the next run.
+    :param modifications: an iterable of npsat_manager.models.Modification objects
+    :param crop_code_field: which code on Crop the land use rasters are classified with
+    :param state_file: optional path of an .npz file to keep the run's EngineState in. It needs to be unique to
+                                    everything about the run except the sim_end_year - see ModelRun.engine_state_file.
+    :return: 1D array with the spatial sum for each year
+    """
+    if schedule is None:
+        schedule = default_reduction_schedule()
+    if state_file is not None and not can_extend(schedule):
+        state_file = None
+
+    if state_file is not None:
+        state = load_engine_state(state_file)
+        if state is not None:
+            n_years = count_annual_years(settings.NgwRasters, schedule.sim_end_year)
+            if n_years <= state.results.shape[1]:
+                log.info("Reusing the first {} years of a previous run".format(n_years))
+                return state.results[0, :n_years].copy()
+            if schedule.sim_end_year <= state.max_sim_end_year:
+                log.info(
+                    "Extending a previous run from {} to {} years".format(
+                        state.results.shape[1], n_years
+                    )
+                )
+                state = extend_engine_state(state, n_years)
+                save_engine_state(state_file, state)
+                return state.results[0].copy()
+
+    weight_lookup = make_weight_lookup(modifications, crop_code_field=crop_code_field)
+    results = run_weight_lookups(
+        weight_lookup,
+        regions=regions,
+        unit_response_functions=unit_response_functions,
+        tile_size=tile_size,
+        processes=processes,
+        unsaturated_zone=unsaturated_zone,
+        schedule=schedule,
+        keep_state=state_file is not None,
+    )
+    if state_file is not None:
+        results, state = results
+        save_engine_state(state_file, state)
+    return results
+
+
+def run_mantis_batch(
+    modification_sets,
+    regions=None,
+    unit_response_functions=None,
+    tile_size=settings.TileSize,
+    processes=settings.EngineProcesses,
+    crop_code_field="caml_code",
+    unsaturated_zone=None,
+    schedule=None,
+):
+    """
+            Runs the engine for K sets of modifications at once, like a sweep over one crop's proportion. Every tile
+            is read once and its K loadings are convolved against the shared URFs in the same matrix products,
+            instead of reading the rasters and URFs K times over. The other parameters are passed through to
+            run_weight_lookups.
+    :param modification_sets: list of K iterables of npsat_manager.models.Modification objects
+    :param crop_code_field: which code on Crop the land use rasters are classified with
+    :return: (K, years) array - row k is the spatial sum for each year for modification_sets[k]
+    """
+    weight_lookups = [
+        make_weight_lookup(modifications, crop_code_field=crop_code_field)
+        for modifications in modification_sets
+    ]
+    return run_weight_lookups(
+        weight_lookups,
+        regions=regions,
+        unit_response_functions=unit_response_functions,
+        tile_size=tile_size,
+        processes=processes,
+        unsaturated_zone=unsaturated_zone,
+        schedule=schedule,
+    )
+
+
+def run_weight_lookups(
+    weight_lookup,
+    regions=None,
+    unit_response_functions=None,
+    tile_size=settings.TileSize,
+    processes=settings.EngineProcesses,
+    unsaturated_zone=None,
+    schedule=None,
+    keep_state=False,
+):
+    """
+            Runs the whole engine tile by tile, then reduces the per-tile year sums into the result for the raster.
+
+            Tiles are independent, so they're fanned out over a pool of worker processes and each tile's result is
+            added in as soon as it completes. Only the weight lookup, the tile's window and mask and a small descriptor
+            of the shared URFs get pickled per task - the URFs themselves are shared with the workers through share_array,
+            and each worker reads its own raster blocks through its raster cache.
+    :param weight_lookup: dict of land use code -> weight, as made by make_weight_lookup, or a list of K of them
+    :param regions: optional iterable of npsat_manager.models.Region - only the pixels inside these regions
+                                    are processed, using their cached masks. None runs the whole raster.
+    :param unit_response_functions: (years into the future, rows, cols) URFs for the full raster. These can be a
+                                                                    numpy.memmap so that each tile only pages in its own block,
+                                                                    or a SparseURF.
+                                                                    Defaults to load_unit_response_functions().
+    :param tile_size: pixels along each side of a tile - None runs the whole raster as one tile
+    :param processes: how many worker processes to use - None uses one per CPU and 1 runs every tile in this process
+    :param unsaturated_zone: optional UnsaturatedZone - loadings are delayed by the time they take to cross it
+    :param schedule: optional ReductionSchedule - when the modifications phase in and how far to simulate
+    :param keep_state: also return an EngineState that extend_engine_state can carry on past the sim_end_year.
+                                    The schedule has to pass can_extend.
+    :return: 1D array with the spatial sum for each year, or (K, years) for a list of lookups. With keep_state,
+                    a tuple of that and the EngineState.
+    """
+    if unit_response_functions is None:
+        unit_response_functions = load_unit_response_functions()
+    raster_info = compatibility.get_raster_info(
+        settings.NgwRasters[min(settings.NgwRasters)]
+    )
+    if regions:
+        runs = region_masks.union_runs(regions, raster_info)
+        run_window = runs_window(runs, raster_info)
+        if run_window.width == 0 or run_window.height == 0:
+            raise ValueError("The selected regions don't overlap the model grid")
+        tiles = []
+        for window in iterate_tiles(run_window, tile_size=tile_size):
+            # tiles in the corners of the window can miss the regions entirely
+            mask = runs_to_mask(runs, window)
+            if mask.any():
+                tiles.append((window, mask))
+        log.info(
+            "Regions cover {} of the {} pixels in the run's window".format(
+                sum(mask.sum() for _, mask in tiles),
+                run_window.width * run_window.height,
+            )
+        )
+    else:
+        run_window = compatibility.full_window(raster_info.shape)
+        tiles = [
+            (window, None) for window in iterate_tiles(run_window, tile_size=tile_size)
+        ]
+    processes = min(processes or os.cpu_count(), len(tiles))
+
+    start_time = arrow.utcnow()
+    results = None
+    if processes <= 1:
+        for window, mask in tiles:
+            log.debug("Running tile {}".format(window))
+            tile_results = run_tile(
+                weight_lookup,
+                window,
+                unit_response_functions=unit_response_functions,
+                mask=mask,
+                unsaturated_zone=unsaturated_zone,
+                schedule=schedule,
+                keep_state=keep_state,
+            )
+            results = _add_tile_results(results, tile_results)
+    else:
+        descriptor, blocks = (None, [])
+        if unit_response_functions is not None:
+            descriptor, blocks = share_unit_response_functions(unit_response_functions)
+        try:
+            log.info("Running {} tiles on {} processes".format(len(tiles), processes))
+            executor = get_executor(processes)
+            futures = [
+                executor.submit(
+                    _run_tile_in_worker,
+                    weight_lookup,
+                    window,
+                    descriptor,
+                    mask,
+                    unsaturated_zone,
+                    schedule,
+                    keep_state,
+                )
+                for window, mask in tiles
+            ]
+            for future in as_completed(futures):
+                results = _add_tile_results(results, future.result())
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
     end_time = arrow.utcnow()
 
-    print("Convolution took: {}".format(end_time - start_time))
+    log.info("Engine run took: {}".format(end_time - start_time))
+    log.debug("Raster cache: {}".format(raster_cache.stats))
 
+    if keep_state:
+        results, tail, final_products = results
+        state = EngineState(
+            first_year=min(settings.NgwRasters),
+            results=results.reshape(-1, results.shape[-1]),
+            tail=tail,
+            final_products=final_products,
+            max_sim_end_year=settings.EngineStateMaxSimEndYear,
+            inputs=engine_inputs_signature(),
+        )
+        return results, state
     return results
 
 
+def _add_padded(total, addition):
+    """adds two (series, n) arrays whose n can differ, padding the shorter one with zeros"""
+    if total.shape[-1] < addition.shape[-1]:
+        total, addition = addition, total
+    total = total.copy()
+    total[..., : addition.shape[-1]] += addition
+    return total
+
+
+def _add_tile_results(results, tile_results):
+    """adds a tile's results into the running total - with kept state, the tails and final products too"""
+    if results is None:
+        return tile_results
+    if isinstance(tile_results, tuple):
+        tile_series, tile_tail, tile_final_products = tile_results
+        series, tail, final_products = results
+        return (
+            series + tile_series,
+            _add_padded(tail, tile_tail),
+            _add_padded(final_products, tile_final_products),
+        )
+    return results + tile_results
+
+
+# what a completed run keeps so that it can be extended to a later sim_end_year without simulating it again.
+# results is the (series, years) output, tail is what the simulated years' loadings still add to later years
+# (series, lags - 1), and final_products are the spatial sums of the last year's loadings times the URFs at each lag
+# (series, lags) - loadings stay at the last year's from then on, so that's all the added years need. Loadings
+# delayed through the unsaturated zone past max_sim_end_year were left out, so it can't be extended beyond that.
+# inputs is engine_inputs_signature() when the run was made.
+EngineState = collections.namedtuple(
+    "EngineState",
+    ["first_year", "results", "tail", "final_products", "max_sim_end_year", "inputs"],
+)
+
+
+def can_extend(schedule):
+    """
+            Whether a run on this schedule keeps the same loadings every year after its sim_end_year - the
+            loadings have to be past the last data year and the reductions have to be done by then
+    """
+    return schedule.sim_end_year is not None and schedule.sim_end_year >= max(
+        [max(settings.NgwRasters), schedule.start_year, schedule.end_year]
+    )
+
+
+def engine_inputs_signature():
+    """text identifying the rasters and settings behind a run, so state from before they changed isn't reused"""
+    rasters = (
+        list(settings.NgwRasters.values())
+        + list(settings.LandUseRasters.values())
+        + list(settings.UnsatDepthRasters.values())
+        + [settings.RechargeRaster, settings.UnitResponseFunctionRaster]
+    )
+    return json.dumps(
+        {
+            "rasters": [
+                [raster, os.path.getmtime(raster) if os.path.exists(raster) else None]
+                for raster in rasters
+                if raster is not None
+            ],
+            "dtype": str(numpy.dtype(settings.EngineDtype)),
+        }
+    )
+
+
+def extend_engine_state(state, n_years):
+    """
+            Carries a run on to n_years without touching the rasters or URFs. Each added year is the old run's
+            tail for that year plus the final year's loadings repeated over every year since - with those loadings
+            constant, that's a running sum of final_products, so the work is proportional to the added years.
+    :param state: EngineState
+    :param n_years: how many years the extended results should have - more than the state has
+    :return: EngineState with n_years of results
+    """
+    added = n_years - state.results.shape[1]
+    cumulative = numpy.cumsum(state.final_products, axis=1)
+    length = max(state.tail.shape[1], added + cumulative.shape[1] - 1)
+
+    def cumulative_at(offsets):
+        # the running sum of final_products at each offset - 0 before it starts and the total after it ends
+        values = cumulative[:, numpy.clip(offsets, 0, cumulative.shape[1] - 1)]
+        return numpy.where(offsets >= 0, values, 0)
+
+    # years from the old sim_end_year on, which get contributions from the added years' loadings
+    offsets = numpy.arange(length)
+    extended = cumulative_at(offsets) - cumulative_at(offsets - added)
+    extended[:, : state.tail.shape[1]] += state.tail
+    return state._replace(
+        results=numpy.concatenate([state.results, extended[:, :added]], axis=1),
+        tail=extended[:, added:],
+    )
+
+
+def save_engine_state(path, state):
+    """writes an EngineState to an .npz file, swapping it in for any old one"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path = "{}.tmp.npz".format(path)
+    numpy.savez(temporary_path, **state._asdict())
+    os.replace(temporary_path, path)
+
+
+def load_engine_state(path):
+    """
+            Reads an EngineState written by save_engine_state
+    :return: EngineState, or None if there isn't one or the rasters or settings it was made with have changed
+    """
+    if not os.path.exists(path):
+        return None
+    with numpy.load(path) as state_file:
+        state = EngineState(
+            first_year=int(state_file["first_year"]),
+            results=state_file["results"],
+            tail=state_file["tail"],
+            final_products=state_file["final_products"],
+            max_sim_end_year=int(state_file["max_sim_end_year"]),
+            inputs=str(state_file["inputs"]),
+        )
+    if state.inputs != engine_inputs_signature() or state.first_year != min(
+        settings.NgwRasters
+    ):
+        log.info("Inputs changed since {} was saved - not using it".format(path))
+        return None
+    return state
+
+
 if __name__ == "__main__":
     start_time = arrow.utcnow()
 
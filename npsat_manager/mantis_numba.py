@@ -4,8 +4,9 @@
 
 import numpy
 import logging
+import time
 
-from numba import njit, jit
+from numba import jit, njit, types
 
 import arrow
 
@@ -51,7 +52,9 @@ max_year = min_year + time_range
 """
 
 
-@jit
+# object mode, as a bare @jit gave before numba 0.59 made nopython the default, since this and the other
+# @jit(forceobj=True) helpers here use Python objects numba can't compile
+@jit(forceobj=True)
 def make_weight_raster(land_use, modifications):
     """
             Given a land use raster and a set of weights, applies the weights to each land use type
@@ -79,7 +82,7 @@ def run(
     pass
 
 
-@jit
+@njit(cache=True)
 def create_ranges_nd(start, stop, N, endpoint=True):
     """
             Via https://stackoverflow.com/a/46694364 - for making in between matrices
@@ -107,7 +110,7 @@ def create_ranges_nd(start, stop, N, endpoint=True):
     return start[..., None] + steps[..., None] * numpy.arange(N)
 
 
-@jit
+@jit(forceobj=True)
 def make_annual_loadings(modifications, years=settings.NgwRasters.keys()):
 
     # First make the loadings for just the years we have precalculated (1945, 1960, etc)
@@ -154,7 +157,7 @@ def make_annual_loadings(modifications, years=settings.NgwRasters.keys()):
     return all_years_data
 
 
-@njit
+@njit(cache=True)
 def convolve_and_sum(loadings, unit_response_functions=None):
     """
 
@@ -198,7 +201,7 @@ def convolve_and_sum(loadings, unit_response_functions=None):
     return results
 
 
-@njit
+@njit(cache=True)
 def numba_convolve_repr():
     l1 = [1, 2, 3, 4, 5, 6, 7]
     l2 = [10, 11, 12, 13, 14, 15, 16]
@@ -207,7 +210,7 @@ def numba_convolve_repr():
     return numpy.convolve(a1, a2)
 
 
-@jit
+@jit(forceobj=True)
 def convolve_and_sum_slow(loadings, unit_response_functions=None):
     """
             This was the first version of the convolution function I wrote. It takes an approach I thought would be
@@ -282,6 +285,49 @@ def convolve_and_sum_slow(loadings, unit_response_functions=None):
     results = numpy.sum(output_matrix, [1, 2])  # sum in 2D space
 
 
+# the argument types each kernel gets compiled for ahead of time by warm_up (and so the compile_kernels command).
+# The engine in mantis.py doesn't call these kernels - they're compiled for this module's own numba runs.
+KERNEL_SIGNATURES = {
+    "create_ranges_nd": [
+        (
+            types.float64[:, ::1],
+            types.float64[:, ::1],
+            types.int64,
+            types.Omitted(True),
+        ),
+        (
+            types.float32[:, ::1],
+            types.float32[:, ::1],
+            types.int64,
+            types.Omitted(True),
+        ),
+    ],
+    "convolve_and_sum": [(types.float64[:, :, ::1], types.Omitted(None))],
+    "numba_convolve_repr": [()],
+}
+
+
+def warm_up():
+    """
+            Compiles every kernel in KERNEL_SIGNATURES. The kernels are cached, so numba writes the machine code
+            for this CPU to its cache directory (__pycache__ next to this file, unless NUMBA_CACHE_DIR is set) and
+            any process that calls them later loads it from there instead of compiling again. If they've already
+            been compiled on this CPU, this just loads them.
+    :return: list of (kernel name, signature, seconds taken, whether it was loaded from the cache) tuples
+    """
+    timings = []
+    for name, signatures in KERNEL_SIGNATURES.items():
+        kernel = globals()[name]
+        for signature in signatures:
+            cache_hits = sum(kernel.stats.cache_hits.values())
+            start_time = time.perf_counter()
+            kernel.compile(signature)
+            elapsed = time.perf_counter() - start_time
+            from_cache = sum(kernel.stats.cache_hits.values()) > cache_hits
+            timings.append((name, signature, elapsed, from_cache))
+    return timings
+
+
 def run_mantis(modifications):
     annual_loadings = make_annual_loadings(modifications=modifications)
     start_time = arrow.utcnow()
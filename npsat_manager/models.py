@@ -1,4 +1,7 @@
 import traceback
+import gzip
+import hashlib
+import os
 import logging
 import asyncio
 import socket
@@ -14,6 +17,18 @@ from django.contrib.auth.models import User
 import arrow
 
 from npsat_backend import settings
+from npsat_manager.support import (
+    compatibility,
+    geometry,
+    region_masks,
+    scenario_crops,
+    tiles,
+    topology,
+)
+from npsat_manager.support import (
+    reference_cache,
+)  # connects the signals that expire cached reference data responses - needs to be imported somewhere
+from npsat_manager.support.raw_json import RawJSON
 
 # Create your models here.
 
@@ -44,9 +59,39 @@ class SimpleJSONField(models.TextField):
         return json.dumps(value)
 
     def from_db_value(self, value, expression, connection):
+        # nullable fields added to existing rows start out as NULL rather than the text null
+        if value is None:
+            return None
         return json.loads(value)
 
 
+class RawJSONField(SimpleJSONField):
+    """
+    Saves like SimpleJSONField, but loads as the stored JSON text, wrapped in RawJSON, instead of parsing it - for
+    big values that mostly get passed straight through to API responses
+    """
+
+    def from_db_value(self, value, expression, connection):
+        # SimpleJSONField saves None as the text null
+        if value is None or value == "null":
+            return None
+        return RawJSON(value)
+
+
+class DataVersion(models.Model):
+    """
+    The current version of some data that's kept built or cached in memory or on disk - see
+    support.reference_cache. It's in the database so every process sees a new version, not just the one that
+    made the change.
+    """
+
+    name = models.CharField(max_length=255, primary_key=True)
+    token = models.CharField(max_length=32)
+
+    def __str__(self):
+        return "{}: {}".format(self.name, self.token)
+
+
 class Crop(models.Model):
     # crop types
     SWAT_CROP = 0
@@ -88,6 +133,40 @@ class CropGroup(models.Model):
     level = models.CharField(max_length=255)
 
 
+class GeometryBlob(models.Model):
+    """
+    A region geometry, stored once under the SHA-256 of its JSON. Regions refer to it instead of holding the
+    geometry themselves, and since a blob never changes, it can be served with immutable caching.
+    """
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    geometry = RawJSONField()
+    # the geometry's JSON gzipped, so it can be served without compressing it per request
+    geometry_gzip = models.BinaryField(editable=False)
+
+    @staticmethod
+    def hash_text(text):
+        """the SHA-256 a geometry's JSON text is stored under"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get_or_create_for(cls, value):
+        """
+                The blob for a geometry, making it if there isn't one yet
+        :param value: GeoJSON, parsed or as JSON text
+        """
+        text = cls._meta.get_field("geometry").get_prep_value(value)
+        sha256 = cls.hash_text(text)
+        blob, _ = cls.objects.get_or_create(
+            sha256=sha256,
+            defaults={
+                "geometry": text,
+                "geometry_gzip": gzip.compress(text.encode("utf-8")),
+            },
+        )
+        return blob
+
+
 class Region(models.Model):
     """
     Used for the various location models - this will let us have a groupings class
@@ -126,15 +205,153 @@ class Region(models.Model):
     active_in_mantis = models.BooleanField(
         default=True
     )  # Is this region actually ready to be selected?
-    geometry = SimpleJSONField(null=True, blank=True)  #
+    # the geometry is kept in its own table, so queries on regions don't carry it around - see the geometry property
+    geometry_blob = models.ForeignKey(
+        "GeometryBlob",
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        related_name="regions",
+    )
     external_id = models.CharField(null=True, max_length=255, blank=True)
     region_type = models.PositiveSmallIntegerField(
         choices=REGION_TYPE
     )  # is it a county, a B118 Basin, etc? we'll need to have some kind of code for this
+    # the geometry's bounding box in degrees, worked out when the region is saved, for finding regions by location
+    bbox_west = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    bbox_south = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    bbox_east = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    bbox_north = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    # also worked out when the region is saved - the centroid in degrees and the area in square kilometers
+    centroid_longitude = models.FloatField(null=True, blank=True, editable=False)
+    centroid_latitude = models.FloatField(null=True, blank=True, editable=False)
+    area = models.FloatField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
+    @property
+    def geometry(self):
+        """
+        The region's GeoJSON - from its GeometryBlob as RawJSON text, or as it was set if it's been set since the
+        region was loaded. Use select_related("geometry_blob") when reading it from many regions.
+        """
+        if "_geometry" in self.__dict__:
+            return self._geometry
+        if self.geometry_blob_id is None:
+            return None
+        return self.geometry_blob.geometry
+
+    @geometry.setter
+    def geometry(self, value):
+        # stored when the region is saved
+        self._geometry = value
+
+    @property
+    def geometry_sha256(self):
+        """
+        The SHA-256 of the region's geometry - its GeometryBlob's key, or worked out from the geometry if it's been
+        set since the region was loaded. None if the region doesn't have a geometry.
+        """
+        if "_geometry" in self.__dict__:
+            if self._geometry is None:
+                return None
+            field = GeometryBlob._meta.get_field("geometry")
+            return GeometryBlob.hash_text(field.get_prep_value(self._geometry))
+        return self.geometry_blob_id
+
+    def save(self, *args, **kwargs):
+        previous_blob = self.geometry_blob_id
+        if "_geometry" in self.__dict__:
+            if self._geometry is None:
+                self.geometry_blob = None
+                self.bbox_west = self.bbox_south = None
+                self.bbox_east = self.bbox_north = None
+                self.centroid_longitude = self.centroid_latitude = self.area = None
+            else:
+                self.geometry_blob = GeometryBlob.get_or_create_for(self._geometry)
+                (
+                    self.bbox_west,
+                    self.bbox_south,
+                    self.bbox_east,
+                    self.bbox_north,
+                ) = geometry.geometry_bounds(self._geometry)
+                (
+                    self.centroid_longitude,
+                    self.centroid_latitude,
+                ) = geometry.geometry_centroid(self._geometry)
+                self.area = geometry.geometry_area(self._geometry)
+        super().save(*args, **kwargs)
+        if self.geometry_blob_id != previous_blob:
+            self.update_simplified_geometries()
+            if previous_blob is not None:
+                # nothing else may be using the old geometry
+                GeometryBlob.objects.filter(sha256=previous_blob, regions=None).delete()
+        # the region's name, geometry or whether it's active may have changed
+        topology.remove_topology(self.region_type)
+        tiles.remove_tiles(self.region_type)
+
+    def update_simplified_geometries(self):
+        """
+                Remakes the region's simplified geometries - one for each level in settings.GeometrySimplifyLevels,
+                each simplified to that level's tolerance and rounded to its number of decimals
+        """
+        self.simplified_geometries.all().delete()
+        if self.geometry is None:
+            return
+        simplified_geometries = []
+        for level, (tolerance, digits) in settings.GeometrySimplifyLevels.items():
+            simplified = geometry.simplify_geometry(
+                self.geometry, tolerance, digits=digits
+            )
+            simplified_geometries.append(
+                SimplifiedGeometry(
+                    region=self,
+                    level=level,
+                    geometry=json.dumps(simplified, separators=(",", ":")),
+                )
+            )
+        SimplifiedGeometry.objects.bulk_create(simplified_geometries)
+
+
+class SimplifiedGeometry(models.Model):
+    """
+    A lighter copy of a Region's geometry for drawing on maps - made by Region.update_simplified_geometries
+    whenever the region's geometry changes
+    """
+
+    class Meta:
+        unique_together = ["region", "level"]
+
+    region = models.ForeignKey(
+        Region, on_delete=models.CASCADE, related_name="simplified_geometries"
+    )
+    # a key of settings.GeometrySimplifyLevels
+    level = models.PositiveSmallIntegerField()
+    geometry = RawJSONField()
+
+
+class RegionContainment(models.Model):
+    """
+    How much of one region (the child) lies inside a region of another type (the parent) - worked out for every
+    overlapping pair by support.containment when regions are loaded
+    """
+
+    class Meta:
+        unique_together = ["parent", "child"]
+        indexes = [models.Index(fields=["parent", "child_region_type"])]
+
+    parent = models.ForeignKey(
+        Region, on_delete=models.CASCADE, related_name="child_containments"
+    )
+    child = models.ForeignKey(
+        Region, on_delete=models.CASCADE, related_name="parent_containments"
+    )
+    # copied from the child, so a parent's children of one type come straight from the index
+    child_region_type = models.PositiveSmallIntegerField(choices=Region.REGION_TYPE)
+    # fraction of the child's area that's inside the parent, from 0 to 1
+    overlap = models.FloatField()
+
 
 class Scenario(models.Model):
     """
@@ -281,6 +498,21 @@ class ModelRun(models.Model):
     # resulting metadata from mantis
     n_wells = models.IntegerField(null=True, blank=True)
 
+    # what made the results - they mean different things. Mantis gives percentiles of the concentrations across
+    # the wells it sampled, saved as ResultPercentiles, while the Python engine gives the total loading arriving
+    # across the run's regions each year, saved in loading_totals
+    RESULTS_MANTIS = 0
+    RESULTS_PYTHON_ENGINE = 1
+    RESULTS_SOURCES = [
+        (RESULTS_MANTIS, "Mantis - concentration percentiles across wells"),
+        (RESULTS_PYTHON_ENGINE, "Python engine - loading arriving across the regions"),
+    ]
+    results_source = models.PositiveSmallIntegerField(
+        choices=RESULTS_SOURCES, null=True, blank=True
+    )
+    # the Python engine's loading arriving across the regions for each year, as a list
+    loading_totals = SimpleJSONField(null=True, blank=True)
+
     # visibility to the public
     public = models.BooleanField(null=False, blank=False, default=False)
 
@@ -295,15 +527,47 @@ class ModelRun(models.Model):
 
     def run(self):
         """
-                Runs Mantis and sets the status codes. Saves automatically at the end
+                Runs the in-process Python engine and sets the status codes. Saves automatically at the end.
+                The engine gives the spatial sum for each year across the run's regions. That's a loading total,
+                not a concentration at wells like Mantis gives, so it's saved in loading_totals rather than as
+                ResultPercentiles, results_source records it came from the engine, and n_wells is 0 since no
+                wells were sampled.
         :return:
         """
+        # mantis imports this module, so import it at run time
+        from npsat_manager import mantis
+
         try:
-            # TODO: Fix below
-            results = None  # mantis.run_mantis(self.modifications.all())
-            self.load_result(values=results)
+            unsaturated_zone = None
+            if self.water_content or self.unsaturated_zone_travel_time is not None:
+                unsaturated_zone = mantis.UnsaturatedZone(
+                    scenario=self.unsat_scenario.mantis_id,
+                    water_content=float(self.water_content),
+                    travel_time=(
+                        float(self.unsaturated_zone_travel_time)
+                        if self.unsaturated_zone_travel_time is not None
+                        else None
+                    ),
+                )
+            results = mantis.run_mantis(
+                self.modifications.all(),
+                regions=list(self.regions.select_related("geometry_blob")),
+                crop_code_field=self.load_scenario.get_crop_code_field_display()
+                or "caml_code",
+                unsaturated_zone=unsaturated_zone,
+                schedule=mantis.ReductionSchedule(
+                    start_year=self.reduction_start_year,
+                    end_year=self.reduction_end_year,
+                    sim_end_year=self.sim_end_year,
+                ),
+                state_file=self.engine_state_file,
+            )
+            self.n_wells = 0
+            self.results_source = self.RESULTS_PYTHON_ENGINE
+            self.loading_totals = [float(str(value)) for value in results]
             self.status = self.COMPLETED
             self.status_message = "Successfully run"
+            self.date_completed = arrow.utcnow().datetime
         except:
             log.error(
                 "Failed to run Mantis. Error was: {}".format(traceback.format_exc())
@@ -313,6 +577,79 @@ class ModelRun(models.Model):
 
         self.save()
 
+    @property
+    def can_run_locally(self):
+        """
+                Whether the in-process Python engine can handle this run instead of a Mantis server. The engine
+                computes the loading that arrives across a small set of regions with the configured Ngw rasters
+                and URFs. It delays loadings through the unsaturated zone when there's a travel time or the unsat
+                scenario's depth raster is configured, but it doesn't filter wells, so runs that need that go
+                to Mantis. There's only one set of URFs, so only runs on the flow scenario they were made for
+                can use it.
+        """
+        if not compatibility.PY_MANTIS:
+            return False
+        if settings.UnitResponseFunctionRaster is None:
+            return False
+        if self.load_scenario.mantis_id != settings.EngineLoadScenario:
+            return False
+        if self.flow_scenario.mantis_id != settings.EngineFlowScenario:
+            return False
+        if (
+            self.water_content
+            and self.unsaturated_zone_travel_time is None
+            and (
+                settings.RechargeRaster is None
+                or self.unsat_scenario.mantis_id not in settings.UnsatDepthRasters
+            )
+        ):
+            return False
+        if self.applied_simulation_filter:
+            return False
+
+        regions = list(self.regions.select_related("geometry_blob"))
+        if not regions or any(region.geometry is None for region in regions):
+            return False
+        raster_info = compatibility.get_raster_info(
+            settings.NgwRasters[min(settings.NgwRasters)]
+        )
+        runs = region_masks.region_masks.union_runs(regions, raster_info)
+        window = region_masks.runs_window(runs, raster_info)
+        pixels = region_masks.runs_to_mask(runs, window).sum()
+        return 0 < pixels <= settings.LocalEngineMaxPixels
+
+    @property
+    def engine_state_file(self):
+        """
+                Where the Python engine keeps this run's state for extending it later. The file is named for
+                everything about the run except sim_end_year, so any later run that only moves sim_end_year
+                finds it. Regions go in with the hash of their geometry, so editing a boundary doesn't reuse
+                state from the old one.
+        """
+        config = {
+            "modifications": sorted(
+                [modification.crop_id, str(modification.proportion)]
+                for modification in self.modifications.all()
+            ),
+            "regions": sorted(
+                [region_id, geometry_blob_id]
+                for region_id, geometry_blob_id in self.regions.values_list(
+                    "id", "geometry_blob_id"
+                )
+            ),
+            "flow_scenario": self.flow_scenario_id,
+            "load_scenario": self.load_scenario_id,
+            "unsat_scenario": self.unsat_scenario_id,
+            "water_content": str(self.water_content),
+            "unsaturated_zone_travel_time": str(self.unsaturated_zone_travel_time),
+            "reduction_start_year": self.reduction_start_year,
+            "reduction_end_year": self.reduction_end_year,
+        }
+        key = hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8"))
+        return os.path.join(
+            settings.EngineStateFolder, "{}.npz".format(key.hexdigest())
+        )
+
     @property
     def input_message(self):
         msg = f"endSimYear {str(self.sim_end_year)}"
@@ -332,7 +669,6 @@ class ModelRun(models.Model):
             msg += f" {region.mantis_id}"
 
         modifications = self.modifications.all()
-        crop_code_field = self.load_scenario.get_crop_code_field_display()
 
         # use a hash map to store all explicit modifications
         explicit_modifications = {}
@@ -345,32 +681,20 @@ class ModelRun(models.Model):
             else:
                 explicit_modifications[modification.crop.id] = modification.proportion
 
-        # retrieve all crop within this load scen
-        crop_list = [
-            Crop.GENERAL_CROP,
-            Crop.ALL_OTHER_CROPS
+        # codes of the modified crops within this load scen, in crop id order
+        crop_codes = scenario_crops.get_map().codes[self.load_scenario.id]
+        crops_belonged_to_load_scen = [
+            (crop_id, code)
+            for crop_id, code in crop_codes.items()
+            if crop_id in explicit_modifications
         ]
-        if int(self.load_scenario.crop_code_field) == Scenario.GNLM_CROP:
-            crop_list.append(Crop.GNLM_CROP)
-        elif int(self.load_scenario.crop_code_field) == Scenario.SWAT_CROP:
-            crop_list.append(Crop.SWAT_CROP)
-
-        crops_belonged_to_load_scen = Crop.objects.filter(
-            crop_type__in=crop_list,
-            id__in=explicit_modifications.keys()
-        )
-        msg += f" Ncrops {len(list(crops_belonged_to_load_scen)) + 1}"
+        msg += f" Ncrops {len(crops_belonged_to_load_scen) + 1}"
 
         # add the default "-9" all other crops
         msg += f" -9 {all_other_crop_value}"
-        ### TEMPORARY
-        #
-        # crop_code_field = "caml_code"
-        #
-        ### TEMPORARY
 
-        for crop in crops_belonged_to_load_scen:
-            msg += f" {int(getattr(crop, crop_code_field))} {explicit_modifications[crop.id]}"
+        for crop_id, code in crops_belonged_to_load_scen:
+            msg += f" {int(code)} {explicit_modifications[crop_id]}"
 
         # add applied region filters
         if self.applied_simulation_filter:
@@ -437,9 +761,18 @@ class MantisServer(models.Model):
     it will be available for use.
     """
 
+    # macros for where runs sent to this server are processed
+    TCP = 0
+    PYTHON_ENGINE = 1
+    BACKEND_TYPES = [
+        (TCP, "External Mantis server over TCP"),
+        (PYTHON_ENGINE, "In-process Python engine"),
+    ]
+
     host = models.CharField(max_length=255)
     port = models.PositiveSmallIntegerField(default=1234)
     online = models.BooleanField(default=False)
+    backend = models.PositiveSmallIntegerField(choices=BACKEND_TYPES, default=TCP)
 
     async def get_status(self):
         stream_reader, stream_writer = asyncio.open_connection(self.host, self.port)
@@ -457,7 +790,10 @@ class MantisServer(models.Model):
         self.save()
 
     def startup(self):
-        pass
+        if self.backend == self.PYTHON_ENGINE:
+            # nothing to connect to - the engine is online if it can read its rasters
+            self.online = compatibility.PY_MANTIS
+            self.save()
 
     # self.get_status()  # saves the object once it determines if the server is online
 
@@ -470,6 +806,11 @@ class MantisServer(models.Model):
         model_run.status = ModelRun.RUNNING
         model_run.save()
 
+        if self.backend == self.PYTHON_ENGINE:
+            log.debug("Running model run {} in process".format(model_run.id))
+            model_run.run()  # handles its own errors and saves the run
+            return
+
         log.debug("Connecting to server to send command")
         try:
             self._non_async_send(model_run)
@@ -521,12 +862,28 @@ class MantisServer(models.Model):
         log.info("Results saved")
 
 
-def process_results(results, model_run):
+def nanpercentile_nearest(values, percentiles):
     """
-            Given the model results,
-    :param results:
-    :param model_run:
-    :return:
+            Percentiles down the first axis that skip nans and pick the nearest actual value instead of interpolating,
+            keeping the dtype of the values. numpy 1.22 renamed the interpolation argument to method.
+    """
+    try:
+        return numpy.nanpercentile(values, q=percentiles, method="nearest", axis=0)
+    except TypeError:
+        return numpy.nanpercentile(
+            values, q=percentiles, interpolation="nearest", axis=0
+        )
+
+
+class MantisResultsError(ValueError):
+    """Mantis reported an error or sent results we can't make sense of"""
+
+
+def parse_results(results):
+    """
+            Parses Mantis' output into a 2D array where every row is a well and every column is a year
+    :param results: bytes Mantis sent back, starting with its status, the number of wells and the number of years
+    :return: 2D numpy array in settings.EngineDtype
     """
     # This line will only appeared if used provided Test Client
     # status_message = "Client sent hello message\n"
@@ -535,50 +892,69 @@ def process_results(results, model_run):
     results_values = results.split(b" ")
     if (
         results_values[0] == b"0"
-    ):  # Yes, a string 0 because of parsing. It means Mantis failed, store the error message
-        model_run.status_message = results_values
-        log.error(f"Mantis Error: {results}")
-        model_run.status = ModelRun.ERROR
-        model_run.save()
-        return
+    ):  # Yes, a string 0 because of parsing. It means Mantis failed, pass along the error message
+        raise MantisResultsError(results.decode("utf-8", errors="replace"))
     # otherwise, Mantis ran, so let's process everything
     # slice off any blanks
     results_values = [
         value for value in results_values if value not in (b"", b"\n")
     ]  # drop any extra empty values we got because they make the total number go off
-    model_run.n_wells = int(results_values[1])
+    n_wells = int(results_values[1])
     n_years = int(results_values[2])
     results_values = results_values[
         3:-1
     ]  # first value is status message, second value is number of wells, third is number of years, last is "EndOfMsg"
     # we need to have a number of results divisible by the number of wells and the number of years, so do some checks
-    if (
-        len(results_values) % n_years != 0
-        or (len(results_values) / model_run.n_wells) != n_years
-    ):
-        error_message = "Got an incorrect number of results from model run. Cannot reliably process to percentiles. You may try again"
-        model_run.status = ModelRun.ERROR
-        model_run.status_message = error_message
-        log.error(
-            error_message
-        )  # log it as an error too so it goes to all the appropriate handlers
-        return
+    if len(results_values) % n_years != 0 or (len(results_values) / n_wells) != n_years:
+        raise MantisResultsError(
+            "Got an incorrect number of results from model run. Cannot reliably process to percentiles. You may try again"
+        )
     # OK, now we should be safe to proceed
-    # we're going to make a 2 dimensional numpy array where every row is a well and every column is a year
-    # start by making it a numpy array and convert to float by default
-    results_array = numpy.array(results_values, dtype=numpy.float)
-    results_2d = results_array.reshape(model_run.n_wells, n_years)
+    # start by making it a numpy array of floats in the engine's dtype - float32 halves the memory for big runs
+    results_array = numpy.array(results_values, dtype=settings.EngineDtype)
+    return results_array.reshape(n_wells, n_years)
+
+
+def save_result_percentiles(results_2d, model_run):
+    """
+            Saves a ResultPercentile for each of settings.PERCENTILE_CALCULATIONS across the wells, then saves
+            the model run
+    :param results_2d: 2D numpy array where every row is a well and every column is a year
+    :param model_run: the ModelRun the results belong to
+    """
     # get the percentiles - when a percentile would be between 2 values, get the nearest actual value in the dataset
     # instead of interpolating between them, mostly because numpy throws errors when we try that.
     # skip all nan in the mantis output
-    percentiles = numpy.nanpercentile(
-        results_2d, q=settings.PERCENTILE_CALCULATIONS, interpolation="nearest", axis=0
-    )
+    percentiles = nanpercentile_nearest(results_2d, settings.PERCENTILE_CALCULATIONS)
     for index, percentile in enumerate(settings.PERCENTILE_CALCULATIONS):
+        # str() gives the shortest text that round trips in the array's own dtype, so float32 values are saved
+        # as the numbers Mantis sent rather than picking up float32 rounding noise
         current_percentiles = json.dumps(
-            percentiles[index].tolist()
+            [float(str(value)) for value in percentiles[index]]
         )  # coerce from numpy to list, then dump as JSON to a string
         ResultPercentile(
             model=model_run, percentile=percentile, values=current_percentiles
         ).save()
     model_run.save()
+
+
+def process_results(results, model_run):
+    """
+            Given the model results from Mantis, stores the percentiles across wells for the model run, or marks
+            it as an error if Mantis failed
+    :param results: bytes Mantis sent back
+    :param model_run: the ModelRun the results belong to
+    :return:
+    """
+    try:
+        results_2d = parse_results(results)
+    except MantisResultsError as e:
+        log.error(f"Mantis Error: {e}")
+        model_run.status = ModelRun.ERROR
+        model_run.status_message = str(e)[:2048]
+        model_run.save()
+        return
+
+    model_run.n_wells = results_2d.shape[0]
+    model_run.results_source = ModelRun.RESULTS_MANTIS
+    save_result_percentiles(results_2d, model_run)
@@ -1,3 +1,8 @@
+"""
+	Scratch script for timing numba against the engine on this machine's data - run it directly with
+	python -m npsat_manager.numba_convolve. It configures Django and runs the engine, so it must never be imported.
+"""
+
 from numba import njit
 import numpy
 
@@ -5,12 +10,6 @@ import django
 
 import os
 
-os.environ["DJANGO_SETTINGS_MODULE"] = "npsat_backend.settings"
-django.setup()
-
-from npsat_manager import mantis
-from npsat_manager import models
-
 
 @njit
 def numba_sum():
@@ -19,8 +18,15 @@ def numba_sum():
     return array.sum()
 
 
-test = numba_sum()
+if __name__ == "__main__":
+    os.environ["DJANGO_SETTINGS_MODULE"] = "npsat_backend.settings"
+    django.setup()
+
+    from npsat_manager import mantis
+    from npsat_manager import models
+
+    test = numba_sum()
 
-mods = models.Modification.objects.all()
+    mods = models.Modification.objects.all()
 
-mantis.run_mantis(mods)
+    mantis.run_mantis(mods)
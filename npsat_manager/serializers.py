@@ -3,6 +3,7 @@ from django.core.exceptions import PermissionDenied, ValidationError
 from rest_framework import serializers
 
 from npsat_manager import models
+from npsat_manager.support import scenario_crops
 from npsat_backend import local_settings
 from django.db.models import Q
 from django.contrib.auth.models import User
@@ -30,12 +31,39 @@ class NestedCropSerializer(serializers.ModelSerializer):
         }
 
 
+class RawJSONField(serializers.Field):
+    """read only field for values that are already JSON text, like Region.geometry - it's passed through as is"""
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return value
+
+
 class RegionSerializer(serializers.ModelSerializer):
-    geometry = serializers.JSONField(read_only=True, binary=False)
+    geometry = RawJSONField()
+    # fetches the geometry from /api/geometry/<geometry_hash>/, which can be cached forever
+    geometry_hash = serializers.CharField(source="geometry_blob_id", read_only=True)
 
     class Meta:
         model = models.Region
-        fields = ("id", "external_id", "name", "mantis_id", "geometry", "region_type")
+        fields = (
+            "id",
+            "external_id",
+            "name",
+            "mantis_id",
+            "geometry",
+            "geometry_hash",
+            "region_type",
+        )
+
+
+class SimplifiedRegionSerializer(RegionSerializer):
+    """regions with one of their simplified geometries, annotated on as simplified_geometry, as their geometry"""
+
+    geometry = RawJSONField(source="simplified_geometry")
 
 
 class NestedRegionSerializer(
@@ -130,6 +158,7 @@ class CompletedRunResultWithValuesSerializer(serializers.ModelSerializer):
         super().__init__(**kwargs)
 
     results = serializers.SerializerMethodField("get_results")
+    loading_totals = serializers.JSONField(read_only=True, binary=False)
 
     def get_results(self, model_run):
         query_set = models.ResultPercentile.objects.filter(
@@ -155,6 +184,8 @@ class CompletedRunResultWithValuesSerializer(serializers.ModelSerializer):
             "reduction_end_year",
             "results",
             "n_wells",
+            "results_source",
+            "loading_totals",
             "public",
             "is_base",
         )
@@ -171,6 +202,7 @@ class RunResultSerializer(serializers.ModelSerializer):
     load_scenario = ScenarioSerializer(many=False, read_only=False, allow_null=True)
     flow_scenario = ScenarioSerializer(many=False, read_only=False, allow_null=True)
     results = NestedResultPercentileSerializer(many=True, read_only=True)
+    loading_totals = serializers.JSONField(read_only=True, binary=False)
 
     class Meta:
         model = models.ModelRun
@@ -193,6 +225,8 @@ class RunResultSerializer(serializers.ModelSerializer):
             "is_base",
             "results",
             "n_wells",
+            "results_source",
+            "loading_totals",
             "public",
             "load_scenario",
             "flow_scenario",
@@ -207,6 +241,29 @@ class RunResultSerializer(serializers.ModelSerializer):
         extra_kwargs = {"user": {"required": False}}
 
     def validate(self, data):
+        """
+        Checks the load scenario and the modified crops exist. Modifications of crops the load scenario doesn't
+        use are kept as they were submitted - the model run's input message skips them.
+        """
+        load_scenario = data.get("load_scenario")
+        modifications = data.get("modifications")
+        if not load_scenario or modifications is None:
+            return data
+
+        crop_map = scenario_crops.get_map()
+        if load_scenario.get("id") not in crop_map.codes:
+            raise serializers.ValidationError(
+                {"load_scenario": "No scenario {}".format(load_scenario.get("id"))}
+            )
+        unknown_crops = [
+            modification["crop"].get("id")
+            for modification in modifications
+            if modification["crop"].get("id") not in crop_map.crop_ids
+        ]
+        if unknown_crops:
+            raise serializers.ValidationError(
+                {"modifications": "No crops {}".format(unknown_crops)}
+            )
         return data
 
     def create(self, validated_data):
@@ -0,0 +1,249 @@
+"""
+	Compact storage for unit response functions. Most pixels' URFs are zero except for a short window after the
+	travel time lag, so instead of a dense (years into the future, rows, cols) cube we keep, for each pixel, the lag
+	its window starts at, the window's length and its values packed end to end with every other pixel's.
+"""
+
+import json
+import os
+
+import numpy
+
+# folder in the raster store that ingest_rasters writes the compact copy of the URFs to
+STORE_FOLDER_NAME = "unit_response_functions_sparse"
+
+# how many pixels from_dense scans at once - bounds the temporary arrays when compacting a big memory-mapped cube
+FROM_DENSE_CHUNK_PIXELS = 65536
+
+
+def _ranges(starts, lengths):
+    """
+            Vectorized concatenation of numpy.arange(start, start + length) for every start and length pair
+    :return: tuple of (index into starts of the range each value came from, values)
+    """
+    owners = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(
+        numpy.cumsum(lengths) - lengths, lengths
+    )
+    return owners, starts[owners] + offsets
+
+
+class SparseURF(object):
+    """
+    Unit response functions for a block of pixels stored as one window of nonzero values per pixel.
+
+    Pixels are numbered in row major order. starts and lengths are per pixel, pointers[p] is where pixel p's
+    values begin in the packed values array, and pointers[-1] is the total number of stored values.
+    """
+
+    def __init__(self, shape, starts, lengths, pointers, values):
+        self.shape = tuple(
+            shape
+        )  # (lags, rows, cols) of the dense cube this represents
+        self.starts = starts
+        self.lengths = lengths
+        self.pointers = pointers
+        self.values = values
+        self._by_lag = None
+
+    @property
+    def n_lags(self):
+        """lags actually needed - one past the end of the latest window"""
+        if len(self.lengths) == 0 or self.lengths.max() == 0:
+            return 0
+        return int((self.starts + self.lengths)[self.lengths > 0].max())
+
+    @property
+    def nbytes(self):
+        return (
+            self.starts.nbytes
+            + self.lengths.nbytes
+            + self.pointers.nbytes
+            + self.values.nbytes
+        )
+
+    @classmethod
+    def from_dense(cls, unit_response_functions, threshold=0.0):
+        """
+                Compacts a dense (lags, rows, cols) URF cube. Values at or below the threshold at the start and end
+                of each pixel's URF are dropped - values inside the window are all kept, zeros included.
+        :param unit_response_functions: numpy array, possibly memory-mapped - it's scanned in chunks of pixels
+        :param threshold: absolute values at or below this count as zero
+        :return: SparseURF
+        """
+        n_lags = unit_response_functions.shape[0]
+        flat = unit_response_functions.reshape(n_lags, -1)
+        n_pixels = flat.shape[1]
+
+        starts = numpy.zeros(n_pixels, dtype=numpy.int32)
+        lengths = numpy.zeros(n_pixels, dtype=numpy.int32)
+        packed = []
+        for chunk_start in range(0, n_pixels, FROM_DENSE_CHUNK_PIXELS):
+            chunk = numpy.asarray(
+                flat[:, chunk_start : chunk_start + FROM_DENSE_CHUNK_PIXELS]
+            )
+            nonzero = numpy.abs(chunk) > threshold
+            has_values = nonzero.any(axis=0)
+            first = numpy.argmax(nonzero, axis=0)
+            last = n_lags - 1 - numpy.argmax(nonzero[::-1], axis=0)
+            chunk_lengths = numpy.where(has_values, last - first + 1, 0)
+
+            chunk_slice = slice(chunk_start, chunk_start + chunk.shape[1])
+            starts[chunk_slice] = numpy.where(has_values, first, 0)
+            lengths[chunk_slice] = chunk_lengths
+
+            pixels, lags = _ranges(first, chunk_lengths)
+            packed.append(chunk[lags, pixels])
+
+        pointers = numpy.zeros(n_pixels + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=pointers[1:])
+        values = (
+            numpy.concatenate(packed)
+            if packed
+            else numpy.zeros(0, dtype=unit_response_functions.dtype)
+        )
+        return cls(unit_response_functions.shape, starts, lengths, pointers, values)
+
+    def astype(self, dtype):
+        """the same URFs with their values in another dtype - returns itself if they already are"""
+        if self.values.dtype == dtype:
+            return self
+        return SparseURF(
+            self.shape,
+            self.starts,
+            self.lengths,
+            self.pointers,
+            self.values.astype(dtype),
+        )
+
+    def delay(self, delays):
+        """
+                URFs for water that takes longer to reach the model - each pixel's window moves later by that
+                pixel's delay. Whole years of delay just move where the window starts. The fractional part
+                splits every value between the two lags it falls between, which makes each window one lag longer.
+        :param delays: per pixel delays in years, in the same order as the pixels. Pixels with nan or
+                                        infinite delays never deliver anything, so their windows are dropped.
+        :return: SparseURF
+        """
+        delays = numpy.asarray(delays, dtype=numpy.float64).ravel()
+        arrives = numpy.isfinite(delays) & (self.lengths > 0)
+        delays = numpy.where(arrives, numpy.maximum(delays, 0), 0)
+        whole_years = numpy.floor(delays).astype(numpy.int64)
+        fraction = delays - whole_years
+
+        values = numpy.asarray(self.values)
+        lengths = numpy.where(arrives, self.lengths + 1, 0)
+        pointers = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=pointers[1:])
+
+        # every kept value goes to its own position in the new window and, by the fraction, to the next one
+        owners, value_indices = _ranges(
+            numpy.asarray(self.pointers[:-1]), numpy.where(arrives, self.lengths, 0)
+        )
+        positions = value_indices - self.pointers[owners] + pointers[owners]
+        delayed = numpy.zeros(pointers[-1], dtype=values.dtype)
+        delayed[positions] += (1 - fraction[owners]) * values[value_indices]
+        delayed[positions + 1] += fraction[owners] * values[value_indices]
+
+        starts = numpy.where(arrives, self.starts + whole_years, 0)
+        n_lags = int((starts + lengths)[arrives].max()) if arrives.any() else 0
+        return SparseURF(
+            (max(n_lags, self.shape[0]),) + tuple(self.shape[1:]),
+            starts,
+            lengths,
+            pointers,
+            delayed,
+        )
+
+    def to_dense(self):
+        """expands back into a (lags, rows, cols) cube"""
+        n_lags, rows, cols = self.shape
+        dense = numpy.zeros((n_lags, rows * cols), dtype=self.values.dtype)
+        pixels, lags = _ranges(self.starts, self.lengths)
+        dense[lags, pixels] = self.values
+        return dense.reshape(self.shape)
+
+    def window(self, window):
+        """
+                URFs for just the pixels in a window of the grid, for running a single tile
+        :param window: compatibility.Window
+        :return: SparseURF of (lags, window.height, window.width)
+        """
+        _, rows, cols = self.shape
+        pixel_rows = numpy.arange(window.row_off, window.row_off + window.height)
+        pixel_cols = numpy.arange(window.col_off, window.col_off + window.width)
+        pixels = (pixel_rows[:, None] * cols + pixel_cols[None, :]).ravel()
+        return self.select(pixels, (window.height, window.width))
+
+    def select(self, pixels, shape=None):
+        """
+                URFs for an arbitrary set of pixels, in the order given
+        :param pixels: flat (row major) indices of the pixels to keep
+        :param shape: (rows, cols) the selected pixels make up - defaults to a single row of them
+        :return: SparseURF
+        """
+        if shape is None:
+            shape = (1, len(pixels))
+        lengths = numpy.asarray(self.lengths[pixels])
+        _, value_indices = _ranges(numpy.asarray(self.pointers[pixels]), lengths)
+        pointers = numpy.zeros(len(pixels) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=pointers[1:])
+        return SparseURF(
+            (self.shape[0],) + tuple(shape),
+            numpy.asarray(self.starts[pixels]),
+            lengths,
+            pointers,
+            numpy.asarray(self.values[value_indices]),
+        )
+
+    def _lag_groups(self):
+        """
+        The stored values regrouped by lag - for each lag, which pixels have a value there and what it is.
+        Computed once and reused for every block of loadings.
+        """
+        if self._by_lag is None:
+            pixels, lags = _ranges(self.starts, self.lengths)
+            order = numpy.argsort(lags, kind="stable")
+            sorted_lags = lags[order]
+            unique_lags, group_starts = numpy.unique(sorted_lags, return_index=True)
+            group_ends = numpy.append(group_starts[1:], len(sorted_lags))
+            sorted_pixels = pixels[order]
+            sorted_values = numpy.asarray(self.values)[order]
+            self._by_lag = [
+                (int(lag), sorted_pixels[start:end], sorted_values[start:end])
+                for lag, start, end in zip(unique_lags, group_starts, group_ends)
+            ]
+        return self._by_lag
+
+    def lag_products(self, flat_loadings):
+        """
+                The sparse equivalent of flat_loadings @ dense_urfs.T - for every loading year and every lag, the sum
+                across pixels of the loading times the URF value at that lag. Only stored values are multiplied.
+        :param flat_loadings: (years, pixels) array
+        :return: (years, n_lags) array
+        """
+        products = numpy.zeros(
+            (flat_loadings.shape[0], self.n_lags),
+            dtype=numpy.result_type(flat_loadings, self.values),
+        )
+        for lag, pixels, values in self._lag_groups():
+            products[:, lag] = flat_loadings[:, pixels] @ values
+        return products
+
+    def save(self, folder):
+        """writes the arrays as .npy files in a folder, so load can memory-map them"""
+        os.makedirs(folder, exist_ok=True)
+        for name in ("starts", "lengths", "pointers", "values"):
+            numpy.save(os.path.join(folder, "{}.npy".format(name)), getattr(self, name))
+        with open(os.path.join(folder, "shape.json"), "w") as shape_file:
+            json.dump(list(self.shape), shape_file)
+
+    @classmethod
+    def load(cls, folder, mmap_mode="r"):
+        with open(os.path.join(folder, "shape.json"), "r") as shape_file:
+            shape = json.load(shape_file)
+        arrays = [
+            numpy.load(os.path.join(folder, "{}.npy".format(name)), mmap_mode=mmap_mode)
+            for name in ("starts", "lengths", "pointers", "values")
+        ]
+        return cls(shape, *arrays)
@@ -1,7 +1,11 @@
+import collections
 import logging
 
 import numpy
 
+from npsat_backend import settings
+from npsat_manager.support import raster_store
+
 log = logging.getLogger("npsat.support.compatibility")
 
 ARCPY = False
@@ -21,33 +25,222 @@ try:
 except ImportError:
     pass
 
+RASTER_STORE = raster_store.get_raster_store(settings.RasterStoreFolder)
+
 if not ARCPY and not GDAL:
-    PY_MANTIS = False
-    log.warning(
-        "Both arcpy and GDAL are missing - won't be able to run Mantis via Python - make sure at least one is available for processing"
-    )
+    # rasters that were ingested into the raster store can still be read without either of them
+    PY_MANTIS = len(RASTER_STORE.manifest["rasters"]) > 0
+    if not PY_MANTIS:
+        log.warning(
+            "Both arcpy and GDAL are missing - won't be able to run Mantis via Python - make sure at least one is available for processing, or run the ingest_rasters command where they are"
+        )
 else:
     PY_MANTIS = True
 
 
-def raster_to_numpy_array(raster):
+class Window(
+    collections.namedtuple("Window", ["col_off", "row_off", "width", "height"])
+):
+    """
+    A rectangular block of pixels in a raster - offsets are from the upper left corner, in the same order
+    GDAL's ReadAsArray takes them
     """
-            Provides a compatibility layer for loading rasters into numpy arrays using either arcpy or GDAL.
 
-            Not totally great since this means our testing and live environments could be different, but right now
-            the flexibility is nice. We'll want to make sure we run the actual tests on the production machine. It's
-            possible that the data types from the different methods of loading could be different. Be careful!
+    @property
+    def slices(self):
+        """(row slice, column slice) for indexing the matching block out of a full raster array"""
+        return (
+            slice(self.row_off, self.row_off + self.height),
+            slice(self.col_off, self.col_off + self.width),
+        )
 
-            GDAL method via https://gis.stackexchange.com/a/33070/1955
-    :param raster: Full path to a raster on disk - reads only the first band when using GDAL
-    :return: numpy array representing the values in the raster
+
+# arcpy doesn't expose the internal block size of a raster - file geodatabase rasters are stored
+# in 128 x 128 tiles by default, so that's what we align arcpy reads to
+ARCPY_BLOCK_SHAPE = (128, 128)
+
+RasterInfo = collections.namedtuple(
+    "RasterInfo", ["shape", "geotransform", "block_shape", "nodata"]
+)
+RasterInfo.__doc__ = """
+    Metadata about a raster that can be read without loading its values. shape and block_shape are
+    (rows, cols), and geotransform is in GDAL's order - (x of upper left corner, pixel width, 0,
+    y of upper left corner, 0, negative pixel height) for a north up raster.
+"""
+
+
+def get_raster_info(raster):
+    """
+            Reads the size, georeferencing, internal block size and nodata value of a raster, without
+            reading any of its values
+    :param raster: Full path to a raster on disk
+    :return: RasterInfo
+    """
+    name, entry = RASTER_STORE.find(raster)
+    if name is not None:
+        return RasterInfo(
+            shape=tuple(entry["shape"][-2:]),
+            geotransform=tuple(entry["geotransform"]),
+            block_shape=tuple(entry["block_shape"]),
+            nodata=entry["nodata"],
+        )
+
+    if ARCPY:
+        arcpy_raster = arcpy.Raster(raster)
+        return RasterInfo(
+            shape=(arcpy_raster.height, arcpy_raster.width),
+            geotransform=(
+                arcpy_raster.extent.XMin,
+                arcpy_raster.meanCellWidth,
+                0.0,
+                arcpy_raster.extent.YMax,
+                0.0,
+                -arcpy_raster.meanCellHeight,
+            ),
+            block_shape=ARCPY_BLOCK_SHAPE,
+            nodata=arcpy_raster.noDataValue,
+        )
+    elif GDAL:
+        raster_source = gdal.Open(raster)
+        band = raster_source.GetRasterBand(1)
+        block_cols, block_rows = band.GetBlockSize()
+        return RasterInfo(
+            shape=(raster_source.RasterYSize, raster_source.RasterXSize),
+            geotransform=tuple(raster_source.GetGeoTransform()),
+            block_shape=(block_rows, block_cols),
+            nodata=band.GetNoDataValue(),
+        )
+    else:
+        raise RuntimeError(
+            "Both arcpy and GDAL are unavailable - can't read raster metadata. Please install Arcpy or GDAL with Python bindings in the current interpreter"
+        )
+
+
+def full_window(shape):
+    """Window covering the whole of a raster with the given (rows, cols) shape"""
+    rows, cols = shape
+    return Window(0, 0, cols, rows)
+
+
+def align_window(window, block_shape, shape):
+    """
+            Grows a window outward to the edges of the raster's internal blocks, so that reading it never
+            decodes a block only to throw part of it away, then clips it to the raster
+    :param window: Window to align
+    :param block_shape: (rows, cols) of the raster's internal blocks
+    :param shape: (rows, cols) of the whole raster
+    :return: Window
     """
+    block_rows, block_cols = block_shape
+    rows, cols = shape
+    row_start = (window.row_off // block_rows) * block_rows
+    col_start = (window.col_off // block_cols) * block_cols
+    row_end = -(-(window.row_off + window.height) // block_rows) * block_rows
+    col_end = -(-(window.col_off + window.width) // block_cols) * block_cols
+    return clip_window(
+        Window(col_start, row_start, col_end - col_start, row_end - row_start), shape
+    )
+
+
+def clip_window(window, shape):
+    """Trims a window so it doesn't extend outside a raster of the given (rows, cols) shape"""
+    rows, cols = shape
+    row_start = min(max(window.row_off, 0), rows)
+    col_start = min(max(window.col_off, 0), cols)
+    row_end = min(max(window.row_off + window.height, row_start), rows)
+    col_end = min(max(window.col_off + window.width, col_start), cols)
+    return Window(col_start, row_start, col_end - col_start, row_end - row_start)
+
+
+def read_raster_window(raster, window=None, dtype=None):
+    """
+            Reads a block of the first band of a raster into a numpy array - only the requested block is read
+            from disk. With GDAL, this is ReadAsArray(xoff, yoff, xsize, ysize). arcpy addresses the block by its
+            lower left corner in map units and a number of columns and rows instead, so the window is converted.
+    :param raster: Full path to a raster on disk
+    :param window: Window to read - None reads the whole raster
+    :param dtype: optional numpy dtype to convert the values to
+    :return: numpy array of (window.height, window.width)
+    """
+    # ingested rasters are read straight out of the memory-mapped copy
+    name, _ = RASTER_STORE.find(raster)
+    if name is not None:
+        stored = RASTER_STORE.open(name)
+        if window is not None:
+            stored = stored[window.slices]
+        return numpy.array(stored, dtype=dtype)
+
     if ARCPY:
-        return arcpy.RasterToNumPyArray(arcpy.Raster(raster))
+        arcpy_raster = arcpy.Raster(raster)
+        if window is None:
+            array = arcpy.RasterToNumPyArray(arcpy_raster)
+        else:
+            lower_left = arcpy.Point(
+                arcpy_raster.extent.XMin + window.col_off * arcpy_raster.meanCellWidth,
+                arcpy_raster.extent.YMax
+                - (window.row_off + window.height) * arcpy_raster.meanCellHeight,
+            )
+            array = arcpy.RasterToNumPyArray(
+                arcpy_raster, lower_left, window.width, window.height
+            )
     elif GDAL:
         raster_source = gdal.Open(raster)
-        return numpy.array(raster_source.GetRasterBand(1).ReadAsArray())
+        band = raster_source.GetRasterBand(1)
+        if window is None:
+            array = numpy.array(band.ReadAsArray())
+        else:
+            array = numpy.array(band.ReadAsArray(*window))
+    else:
+        raise RuntimeError(
+            "Both arcpy and GDAL are unavailable - can't load raster into numpy array. Please install Arcpy or GDAL with Python bindings in the current interpreter"
+        )
+
+    if dtype is not None:
+        array = array.astype(dtype, copy=False)
+    return array
+
+
+def read_raster_bands(raster, dtype=None):
+    """
+            Reads every band of a multiband raster, such as the unit response functions where each band is
+            another year into the future
+    :param raster: Full path to a raster on disk
+    :param dtype: optional numpy dtype to convert the values to
+    :return: numpy array of (bands, rows, cols)
+    """
+    name, _ = RASTER_STORE.find(raster)
+    if name is not None:
+        return numpy.array(RASTER_STORE.open(name), dtype=dtype)
+
+    if ARCPY:
+        array = arcpy.RasterToNumPyArray(arcpy.Raster(raster))
+    elif GDAL:
+        array = numpy.array(gdal.Open(raster).ReadAsArray())
     else:
         raise RuntimeError(
             "Both arcpy and GDAL are unavailable - can't load raster into numpy array. Please install Arcpy or GDAL with Python bindings in the current interpreter"
         )
+
+    if array.ndim == 2:  # single band rasters come back without the band axis
+        array = array[numpy.newaxis, ...]
+    if dtype is not None:
+        array = array.astype(dtype, copy=False)
+    return array
+
+
+def raster_to_numpy_array(raster, window=None, dtype=None):
+    """
+            Provides a compatibility layer for loading rasters into numpy arrays using either arcpy or GDAL.
+
+            Not totally great since this means our testing and live environments could be different, but right now
+            the flexibility is nice. We'll want to make sure we run the actual tests on the production machine. It's
+            possible that the data types from the different methods of loading could be different. Be careful!
+            Passing a dtype makes the result the same type either way.
+
+            GDAL method via https://gis.stackexchange.com/a/33070/1955
+    :param raster: Full path to a raster on disk - reads only the first band when using GDAL
+    :param window: optional Window - when provided, only that block of the raster is read from disk
+    :param dtype: optional numpy dtype to convert the values to
+    :return: numpy array representing the values in the raster
+    """
+    return read_raster_window(raster, window=window, dtype=dtype)
@@ -0,0 +1,135 @@
+"""
+	Which regions of one type lie inside regions of another - townships in a county, B118 basins in a sub basin and
+	so on. Region types come from separate datasets whose boundaries don't line up exactly, so instead of a yes or
+	no, each pair gets the fraction of the child region's area that's inside the parent.
+
+	Fractions are estimated from a grid of sample points inside each child, tested against the parents all at once
+	with spatial_index.points_in_polygon. Only parents whose bounding boxes overlap the child's are tested. It's
+	all worked out when regions are loaded (or by the compute_containment command) and kept as
+	RegionContainment rows, so requests only read them.
+"""
+
+import logging
+import math
+
+import numpy
+from django.db import transaction
+
+from npsat_backend import settings
+from npsat_manager import models
+from npsat_manager.support import geometry, spatial_index
+
+log = logging.getLogger("npsat.support.containment")
+
+
+def sample_points(polygons, bounds, count):
+    """
+            Points spread evenly across a region, for estimating how much of it is inside another one - the
+            centers of a grid of about count cells over its bounding box, keeping the ones inside the region. A
+            region too thin for any of them to land inside gets its vertices instead.
+    :param polygons: the region's polygons, as given by geometry.iterate_polygons
+    :param bounds: (west, south, east, north) of the region
+    :return: (P, 2) array
+    """
+    west, south, east, north = bounds
+    side = max(int(math.ceil(math.sqrt(count))), 1)
+    x = west + (numpy.arange(side) + 0.5) * (east - west) / side
+    y = south + (numpy.arange(side) + 0.5) * (north - south) / side
+    x, y = [axis.ravel() for axis in numpy.meshgrid(x, y)]
+
+    inside = numpy.zeros(len(x), dtype=bool)
+    for polygon in polygons:
+        inside |= spatial_index.points_in_polygon(polygon, x, y)
+    if not inside.any():
+        return numpy.concatenate([polygon[0] for polygon in polygons])
+    return numpy.stack([x[inside], y[inside]], axis=1)
+
+
+def overlap_fraction(points, polygons, bounds):
+    """fraction of a child region's sample points that are inside a parent with these polygons and bounds"""
+    west, south, east, north = bounds
+    # only points inside the parent's bounding box need the full test
+    candidates = (
+        (points[:, 0] >= west)
+        & (points[:, 0] <= east)
+        & (points[:, 1] >= south)
+        & (points[:, 1] <= north)
+    )
+    inside = numpy.zeros(candidates.sum(), dtype=bool)
+    for polygon in polygons:
+        inside |= spatial_index.points_in_polygon(
+            polygon, points[candidates, 0], points[candidates, 1]
+        )
+    return float(inside.sum()) / len(points)
+
+
+def compute_containment(regions, samples, minimum_overlap):
+    """
+            Overlap fractions between every pair of regions of different types
+    :param regions: iterable of npsat_manager.models.Region with geometry
+    :param samples: about how many sample points to spread across each child region
+    :param minimum_overlap: smallest fraction worth keeping - pairs that only touch along an edge come out as
+                                    slightly more than 0, since the boundaries don't match exactly
+    :return: list of (parent id, child id, child region_type, fraction of the child inside the parent)
+    """
+    regions = [region for region in regions if region.geometry is not None]
+    polygons = [list(geometry.iterate_polygons(region.geometry)) for region in regions]
+    bounds = numpy.array(
+        [geometry.geometry_bounds(region.geometry) for region in regions]
+    ).reshape(-1, 4)
+    region_types = numpy.array([region.region_type for region in regions])
+
+    containment = []
+    for child_index, child in enumerate(regions):
+        west, south, east, north = bounds[child_index]
+        parents = numpy.flatnonzero(
+            (bounds[:, 0] <= east)
+            & (bounds[:, 2] >= west)
+            & (bounds[:, 1] <= north)
+            & (bounds[:, 3] >= south)
+            & (region_types != child.region_type)
+        )
+        if not len(parents):
+            continue
+
+        points = sample_points(polygons[child_index], bounds[child_index], samples)
+        for parent_index in parents:
+            overlap = overlap_fraction(
+                points, polygons[parent_index], bounds[parent_index]
+            )
+            if overlap >= minimum_overlap:
+                containment.append(
+                    (regions[parent_index].id, child.id, child.region_type, overlap)
+                )
+    return containment
+
+
+def update_containment():
+    """
+            Works out the containment between every pair of active regions again and replaces the stored
+            RegionContainment rows with it
+    :return: number of rows stored
+    """
+    containment = compute_containment(
+        models.Region.objects.filter(active_in_mantis=True)
+        .exclude(geometry_blob=None)
+        .select_related("geometry_blob"),
+        settings.RegionContainmentSamples,
+        settings.RegionContainmentMinimumOverlap,
+    )
+    with transaction.atomic():
+        models.RegionContainment.objects.all().delete()
+        models.RegionContainment.objects.bulk_create(
+            [
+                models.RegionContainment(
+                    parent_id=parent_id,
+                    child_id=child_id,
+                    child_region_type=child_region_type,
+                    overlap=overlap,
+                )
+                for parent_id, child_id, child_region_type, overlap in containment
+            ],
+            batch_size=1000,
+        )
+    log.info("Stored containment for {} pairs of regions".format(len(containment)))
+    return len(containment)
@@ -0,0 +1,267 @@
+"""
+	Small numpy helpers for working with the GeoJSON geometries stored on Regions, so that we don't need
+	GDAL or arcpy just to ask where a Region is.
+"""
+
+import json
+
+import numpy
+
+# NAD 1983 California (Teale) Albers - the projection of the model grid. Parameters come from
+# npsat_manager/data/B118/B118_filtered_2018.prj. Region geometries are stored as longitude/latitude,
+# and the difference between NAD83 and WGS84 coordinates is well under a pixel, so it's ignored.
+TEALE_ALBERS = {
+    "semi_major_axis": 6378137.0,
+    "inverse_flattening": 298.257222101,
+    "standard_parallel_1": 34.0,
+    "standard_parallel_2": 40.5,
+    "latitude_of_origin": 0.0,
+    "central_meridian": -120.0,
+    "false_easting": 0.0,
+    "false_northing": -4000000.0,
+}
+
+
+def load_geometry(geometry):
+    """
+            Accepts a GeoJSON Feature or geometry, either already parsed or as JSON text, and returns the
+            parsed geometry object (the part with "type" and "coordinates")
+    """
+    if isinstance(geometry, (str, bytes)):
+        geometry = json.loads(geometry)
+    if geometry.get("type") == "Feature":
+        geometry = geometry["geometry"]
+    return geometry
+
+
+def iterate_polygons(geometry):
+    """
+            Yields each polygon in a Polygon or MultiPolygon as a list of (N, 2) coordinate arrays - the
+            exterior ring first, then any holes
+    """
+    geometry = load_geometry(geometry)
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        raise ValueError(
+            "Only Polygon and MultiPolygon geometries are supported, not {}".format(
+                geometry["type"]
+            )
+        )
+
+    for polygon in polygons:
+        yield [numpy.asarray(ring, dtype=numpy.float64)[:, :2] for ring in polygon]
+
+
+def geometry_coordinates(geometry):
+    """all of the vertices of a Polygon or MultiPolygon as a single (N, 2) array"""
+    return numpy.concatenate(
+        [ring for polygon in iterate_polygons(geometry) for ring in polygon]
+    )
+
+
+def geometry_bounds(geometry):
+    """(min_x, min_y, max_x, max_y) of a geometry, in its own coordinates"""
+    coordinates = geometry_coordinates(geometry)
+    min_x, min_y = coordinates.min(axis=0)
+    max_x, max_y = coordinates.max(axis=0)
+    return float(min_x), float(min_y), float(max_x), float(max_y)
+
+
+def _albers_q(sin_latitude, eccentricity):
+    e_sin = eccentricity * sin_latitude
+    return (1 - eccentricity**2) * (
+        sin_latitude / (1 - e_sin**2)
+        - (1 / (2 * eccentricity)) * numpy.log((1 - e_sin) / (1 + e_sin))
+    )
+
+
+def project_albers(longitude, latitude, parameters=TEALE_ALBERS):
+    """
+            Projects longitude/latitude in degrees into Albers Equal Area coordinates, using the ellipsoidal
+            formulas from Snyder, Map Projections - A Working Manual (1987), p. 101
+    :param longitude: array of longitudes
+    :param latitude: array of latitudes
+    :param parameters: projection parameters - defaults to the model grid's projection
+    :return: tuple of (x, y) arrays in meters
+    """
+    a = parameters["semi_major_axis"]
+    flattening = 1 / parameters["inverse_flattening"]
+    eccentricity = numpy.sqrt(2 * flattening - flattening**2)
+
+    def m(phi):
+        return numpy.cos(phi) / numpy.sqrt(1 - (eccentricity * numpy.sin(phi)) ** 2)
+
+    def q(phi):
+        return _albers_q(numpy.sin(phi), eccentricity)
+
+    phi_1 = numpy.radians(parameters["standard_parallel_1"])
+    phi_2 = numpy.radians(parameters["standard_parallel_2"])
+    phi_0 = numpy.radians(parameters["latitude_of_origin"])
+
+    n = (m(phi_1) ** 2 - m(phi_2) ** 2) / (q(phi_2) - q(phi_1))
+    c = m(phi_1) ** 2 + n * q(phi_1)
+    rho_0 = a * numpy.sqrt(c - n * q(phi_0)) / n
+
+    phi = numpy.radians(numpy.asarray(latitude, dtype=numpy.float64))
+    rho = a * numpy.sqrt(c - n * q(phi)) / n
+    theta = n * numpy.radians(
+        numpy.asarray(longitude, dtype=numpy.float64) - parameters["central_meridian"]
+    )
+
+    x = rho * numpy.sin(theta) + parameters["false_easting"]
+    y = rho_0 - rho * numpy.cos(theta) + parameters["false_northing"]
+    return x, y
+
+
+def projected_bounds(geometry, parameters=TEALE_ALBERS):
+    """
+            (min_x, min_y, max_x, max_y) of a longitude/latitude geometry once it's projected. Every vertex is
+            projected, since the edges of a longitude/latitude box aren't straight lines in Albers.
+    """
+    coordinates = geometry_coordinates(geometry)
+    x, y = project_albers(coordinates[:, 0], coordinates[:, 1], parameters=parameters)
+    return float(x.min()), float(y.min()), float(x.max()), float(y.max())
+
+
+def _ring_area_and_centroid(x, y):
+    """signed shoelace area of a closed ring and its centroid - the area is negative for clockwise rings"""
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, float(x.mean()), float(y.mean())
+    centroid_x = ((x[:-1] + x[1:]) * cross).sum() / (6 * area)
+    centroid_y = ((y[:-1] + y[1:]) * cross).sum() / (6 * area)
+    return float(area), float(centroid_x), float(centroid_y)
+
+
+def geometry_area(geometry, parameters=TEALE_ALBERS):
+    """
+            Area of a longitude/latitude Polygon or MultiPolygon in square kilometers, measured in Albers Equal
+            Area so it's the same wherever the geometry is. Holes are taken out, whichever way the rings wind.
+    """
+    area = 0.0
+    for polygon in iterate_polygons(geometry):
+        for index, ring in enumerate(polygon):
+            x, y = project_albers(ring[:, 0], ring[:, 1], parameters=parameters)
+            ring_area = abs(_ring_area_and_centroid(x, y)[0])
+            area += ring_area if index == 0 else -ring_area
+    return area / 1e6
+
+
+def geometry_centroid(geometry):
+    """
+            (x, y) of the area weighted centroid of a Polygon or MultiPolygon, in its own coordinates, with holes
+            taken out. Degenerate geometries with no area get the mean of their vertices.
+    """
+    total_area = total_x = total_y = 0.0
+    for polygon in iterate_polygons(geometry):
+        for index, ring in enumerate(polygon):
+            area, x, y = _ring_area_and_centroid(ring[:, 0], ring[:, 1])
+            area = abs(area) if index == 0 else -abs(area)
+            total_area += area
+            total_x += area * x
+            total_y += area * y
+    if total_area == 0:
+        x, y = geometry_coordinates(geometry).mean(axis=0)
+        return float(x), float(y)
+    return total_x / total_area, total_y / total_area
+
+
+def simplify_line(coordinates, tolerance):
+    """
+            Douglas-Peucker simplification of a line - the first and last vertices are kept, along with any vertex
+            that's further than the tolerance from the line through the kept vertices around it. Each segment's
+            distances are measured for all of its vertices at once.
+    :param coordinates: (N, 2) array
+    :param tolerance: in the units of the coordinates
+    :return: boolean array of which vertices to keep
+    """
+    keep = numpy.zeros(len(coordinates), dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, len(coordinates) - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+        offsets = coordinates[start + 1 : end] - coordinates[start]
+        direction = coordinates[end] - coordinates[start]
+        length = numpy.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = numpy.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = (
+                numpy.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0])
+                / length
+            )
+        furthest = int(numpy.argmax(distances))
+        if distances[furthest] > tolerance:
+            middle = start + 1 + furthest
+            keep[middle] = True
+            segments.append((start, middle))
+            segments.append((middle, end))
+    return keep
+
+
+def simplify_ring(ring, tolerance, digits=None):
+    """
+            Simplifies a closed ring, splitting it at the vertex furthest from its start so Douglas-Peucker has
+            a line to work with on each side. Rings always keep at least a triangle, so no polygon disappears.
+    :param ring: (N, 2) array with the first vertex repeated at the end
+    :param tolerance: in the units of the coordinates
+    :param digits: optional number of decimals to round the kept vertices to - repeated vertices left by
+                                    the rounding are dropped
+    :return: (M, 2) array, closed
+    """
+    if len(ring) < 5:
+        simplified = ring
+    else:
+        split = int(numpy.argmax(numpy.hypot(*(ring - ring[0]).T)))
+        keep = numpy.zeros(len(ring), dtype=bool)
+        keep[: split + 1] = simplify_line(ring[: split + 1], tolerance)
+        keep[split:] |= simplify_line(ring[split:], tolerance)
+        if keep.sum() < 4:
+            # just the start, the split and the closing vertex - add the vertex furthest off the line between them
+            offsets = ring - ring[0]
+            direction = ring[split] - ring[0]
+            areas = numpy.abs(
+                direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]
+            )
+            keep[numpy.argmax(areas)] = True
+        simplified = ring[keep]
+
+    if digits is not None:
+        rounded = numpy.round(simplified, digits)
+        changes = numpy.any(rounded[1:] != rounded[:-1], axis=1)
+        deduplicated = rounded[numpy.concatenate([[True], changes])]
+        simplified = deduplicated if len(deduplicated) >= 4 else rounded
+    return simplified
+
+
+def simplify_geometry(geometry, tolerance, digits=None):
+    """
+            A lighter copy of a Polygon or MultiPolygon for drawing - every ring simplified by simplify_ring, and
+            coordinates rounded to the given number of decimals. A Feature comes back as a Feature with the
+            simplified geometry but none of its properties.
+    :param geometry: GeoJSON Feature or geometry, parsed or as text
+    :param tolerance: in degrees for longitude/latitude geometries
+    :param digits: optional number of decimals to keep
+    :return: parsed GeoJSON
+    """
+    if isinstance(geometry, (str, bytes)):
+        geometry = json.loads(geometry)
+    polygons = [
+        [simplify_ring(ring, tolerance, digits).tolist() for ring in polygon]
+        for polygon in iterate_polygons(geometry)
+    ]
+    parsed = load_geometry(geometry)
+    if parsed["type"] == "Polygon":
+        simplified = {"type": "Polygon", "coordinates": polygons[0]}
+    else:
+        simplified = {"type": "MultiPolygon", "coordinates": polygons}
+
+    if geometry.get("type") == "Feature":
+        return {"type": "Feature", "properties": {}, "geometry": simplified}
+    return simplified
@@ -0,0 +1,141 @@
+"""
+	Process-wide cache of decoded raster arrays. The Ngw and land use rasters never change between runs, so once a
+	worker has decoded a block of one, later runs can reuse it instead of going back to arcpy or GDAL.
+"""
+
+import collections
+import logging
+import os
+import threading
+
+import numpy
+
+from npsat_backend import settings
+from npsat_manager.support import compatibility, raster_store
+
+log = logging.getLogger("npsat.support.raster_cache")
+
+
+class RasterCache(object):
+    """
+    Least recently used cache of decoded raster arrays with a byte budget. Entries are keyed by the raster's path,
+    its modification time, the window read and the dtype - so a raster that gets replaced on disk is decoded again
+    instead of being served stale.
+
+    Cached arrays are shared between every caller, so they're returned read only - copy one before modifying it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._arrays = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, raster, window=None, dtype=None):
+        """
+                Same as compatibility.read_raster_window, but served from the cache when possible
+        :param raster: Full path to a raster on disk
+        :param window: optional compatibility.Window to read
+        :param dtype: optional numpy dtype to convert the values to
+        :return: read only numpy array
+        """
+        key = (
+            os.path.abspath(raster),
+            raster_store.modification_time(raster),
+            tuple(window) if window is not None else None,
+            numpy.dtype(dtype).str if dtype is not None else None,
+        )
+        array = self.get(key)
+        if array is not None:
+            return array
+
+        array = compatibility.read_raster_window(raster, window=window, dtype=dtype)
+        array.flags.writeable = False
+        self.add(key, array)
+        return array
+
+    def read_derived(self, name, rasters, compute, window=None):
+        """
+                Caches an array computed from one or more rasters, like a ratio of two of them, under the same
+                rules as read - it's computed again if any of the rasters changes on disk
+        :param name: name for what compute makes, to tell it apart from other arrays made from the same rasters
+        :param rasters: list of full paths to the rasters the array is made from
+        :param compute: function taking the window and returning the array
+        :param window: optional compatibility.Window the array covers
+        :return: read only numpy array
+        """
+        key = (
+            name,
+            tuple(
+                (os.path.abspath(raster), raster_store.modification_time(raster))
+                for raster in rasters
+            ),
+            tuple(window) if window is not None else None,
+        )
+        array = self.get(key)
+        if array is not None:
+            return array
+
+        array = compute(window)
+        array.flags.writeable = False
+        self.add(key, array)
+        return array
+
+    def get(self, key):
+        """returns the cached array for a key and marks it as recently used, or None on a miss"""
+        with self._lock:
+            if key in self._arrays:
+                self._arrays.move_to_end(key)
+                self.hits += 1
+                return self._arrays[key]
+            self.misses += 1
+            return None
+
+    def add(self, key, array):
+        """
+                Stores an array, evicting the least recently used arrays until it fits in the budget. Arrays bigger
+                than the whole budget aren't stored at all.
+        """
+        if array.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._arrays:
+                return
+            self._arrays[key] = array
+            self.current_bytes += array.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def resize(self, max_bytes):
+        """changes the budget, evicting the least recently used arrays until the cache fits in it"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self.current_bytes = 0
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._arrays),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+raster_cache = RasterCache(settings.RasterCacheBytes)
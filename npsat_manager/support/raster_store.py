@@ -0,0 +1,160 @@
+"""
+	A folder of .npy files plus a JSON manifest that holds copies of the engine's input rasters. The ingest_rasters
+	management command fills it once from the original GDB/TIFF rasters, then workers open the arrays with
+	numpy.load(mmap_mode="r") - that takes microseconds, only pages in the blocks a run touches, and doesn't need
+	arcpy or GDAL at run time.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy
+
+log = logging.getLogger("npsat.support.raster_store")
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _source_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def store_name(source):
+    """
+            Name to store a source raster under - its file name, followed by a hash of its full path, so rasters
+            with the same file name in different folders don't replace each other
+    """
+    stem = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.sha1(_source_key(source).encode("utf-8")).hexdigest()
+    return "{}_{}".format(stem, digest[:12])
+
+
+def modification_time(path):
+    """
+            Modification time of a source raster. Rasters inside a file geodatabase aren't files of their own,
+            so this falls back to the closest parent path that exists (the .gdb folder).
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return os.stat(path).st_mtime_ns
+
+
+class RasterStore(object):
+    """
+    Memory-mappable copies of rasters. Each entry records the source raster it was made from, along with the
+    metadata we'd otherwise need GIS libraries to read - shape, dtype, geotransform, nodata value and the block
+    shape reads should be aligned to.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._manifest = None
+        self._manifest_mtime = None
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.folder, MANIFEST_NAME)
+
+    @property
+    def manifest(self):
+        """the parsed manifest - reloaded whenever another process rewrites it"""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return {"rasters": {}}
+
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                with open(self.manifest_path, "r") as manifest_file:
+                    self._manifest = json.load(manifest_file)
+                self._manifest_mtime = mtime
+                self._arrays = {}  # files may have been replaced too, so map them again
+            return self._manifest
+
+    def find(self, source):
+        """
+                Finds the store's entry for a source raster path. Entries whose source raster changed on disk
+                after it was ingested are ignored so we don't serve stale values.
+        :return: (name, entry dict) or (None, None)
+        """
+        key = _source_key(source)
+        for name, entry in self.manifest["rasters"].items():
+            if entry["source"] != key:
+                continue
+            if entry.get("source_mtime") not in (
+                None,
+                modification_time(source),
+            ):
+                log.warning(
+                    "{} changed after it was ingested into the raster store - ignoring the stored copy".format(
+                        source
+                    )
+                )
+                continue  # a copy ingested again under another name may still be current
+            return name, entry
+        return None, None
+
+    def open(self, name):
+        """
+                Opens a stored array read only, memory-mapped. Each process maps a file once and reuses the mapping.
+        """
+        entry = self.manifest["rasters"][name]
+        with self._lock:
+            if name not in self._arrays:
+                self._arrays[name] = numpy.load(
+                    os.path.join(self.folder, entry["file"]), mmap_mode="r"
+                )
+            return self._arrays[name]
+
+    def add(self, name, array, source, geotransform, nodata, block_shape):
+        """
+                Writes an array into the store and records it in the manifest. The array is written to a temporary
+                file first and moved into place, so readers never see a half written file.
+        :param name: name of the entry - also used for its file name
+        :param array: numpy array of values - 2D for single band rasters, (bands, rows, cols) for URFs
+        :param source: path of the raster the array was read from
+        :param geotransform: GDAL style geotransform of the source raster
+        :param nodata: nodata value of the source raster
+        :param block_shape: (rows, cols) that windowed reads should be aligned to
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        file_name = "{}.npy".format(name)
+        temporary_path = os.path.join(self.folder, "{}.tmp.npy".format(name))
+        numpy.save(temporary_path, numpy.ascontiguousarray(array))
+        os.replace(temporary_path, os.path.join(self.folder, file_name))
+
+        manifest = dict(self.manifest)
+        manifest["rasters"] = dict(manifest["rasters"])
+        manifest["rasters"][name] = {
+            "file": file_name,
+            "source": _source_key(source),
+            "source_mtime": modification_time(source),
+            "shape": list(array.shape),
+            "dtype": array.dtype.str,
+            "geotransform": list(geotransform) if geotransform is not None else None,
+            "nodata": nodata,
+            "block_shape": list(block_shape),
+        }
+        temporary_manifest = self.manifest_path + ".tmp"
+        with open(temporary_manifest, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(temporary_manifest, self.manifest_path)
+
+
+_stores = {}
+
+
+def get_raster_store(folder):
+    """one RasterStore per folder per process, so the manifest and the mapped files are shared"""
+    if folder not in _stores:
+        _stores[folder] = RasterStore(folder)
+    return _stores[folder]
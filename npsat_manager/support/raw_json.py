@@ -0,0 +1,55 @@
+"""
+	JSON that's already encoded, passed through to responses as is. Region geometries are stored as GeoJSON text,
+	and parsing megabytes of it only to encode it again for every response is most of the work of listing regions,
+	so the text is wrapped in RawJSON instead and spliced into the rendered response body unchanged.
+"""
+
+import re
+import uuid
+
+from rest_framework.renderers import JSONRenderer
+
+
+class RawJSON(str):
+    """
+    Text that's already valid JSON. It's still a str, so anything that parses geometry text (like
+    geometry.load_geometry) takes it as is.
+    """
+
+
+class RawJSONRenderer(JSONRenderer):
+    """
+    Renders like JSONRenderer, except that RawJSON values are written into the output as the JSON they already
+    are, instead of as strings. Each one is swapped for a placeholder string, the rest of the data is encoded as
+    usual, then the placeholders are replaced with the original text.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        fragments = []
+        # a new prefix each time, so no string in the data can be mistaken for a placeholder
+        prefix = "\x00{}:".format(uuid.uuid4().hex)
+
+        def swap(value):
+            if isinstance(value, RawJSON):
+                fragments.append(value.encode("utf-8"))
+                return "{}{}".format(prefix, len(fragments) - 1)
+            if isinstance(value, dict):
+                return {key: swap(item) for key, item in value.items()}
+            if isinstance(value, (list, tuple)):
+                return [swap(item) for item in value]
+            return value
+
+        rendered = super().render(
+            swap(data),
+            accepted_media_type=accepted_media_type,
+            renderer_context=renderer_context,
+        )
+        if not fragments:
+            return rendered
+
+        # the NUL at the start of each placeholder is always escaped as \u0000 in the encoded output
+        placeholder = re.compile(rb'"\\u0000' + prefix[1:].encode("ascii") + rb'(\d+)"')
+        pieces = placeholder.split(rendered)
+        # split puts each placeholder's index between the text around it
+        pieces[1::2] = [fragments[int(index)] for index in pieces[1::2]]
+        return b"".join(pieces)
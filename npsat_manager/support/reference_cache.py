@@ -0,0 +1,109 @@
+"""
+	Cached responses for reference data - crops, scenarios and regions - which only change when an admin edits them
+	or the initial data is loaded. Rendered list responses are kept in Django's cache under the current reference
+	data version, and saving or deleting any reference data bumps the version, so everything cached before it is
+	never read again (the cache evicts it as it fills up).
+
+	Versions live in the database (as DataVersion rows) rather than the cache, so every process sees a change as
+	soon as it's committed, whichever process made it - the local memory cache each process has by default only
+	ever holds things keyed by a version. Besides the version for all reference data, crops and scenarios, and
+	regions, have versions of their own, so things built from just one of them aren't rebuilt for the others.
+"""
+
+import hashlib
+import logging
+import uuid
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+log = logging.getLogger("npsat.support.reference_cache")
+
+REFERENCE = "reference"
+CROPS = "crops"
+REGIONS = "regions"
+
+# models whose changes show up in reference responses, and the versions their changes bump besides REFERENCE -
+# given as names since the models import this module
+REFERENCE_MODELS = {
+    "npsat_manager.Crop": [CROPS],
+    "npsat_manager.CropGroup": [],
+    "npsat_manager.Scenario": [CROPS],
+    "npsat_manager.Region": [REGIONS],
+    "npsat_manager.SimplifiedGeometry": [],
+    "npsat_manager.RegionContainment": [],
+}
+
+
+def get_version(name=REFERENCE):
+    """
+            The current version of some data, as the database has it - an empty string until the data first
+            changes
+    :param name: REFERENCE, CROPS, REGIONS, or any other name callers bump
+    """
+    # imported here since the models import this module
+    from npsat_manager import models
+
+    token = (
+        models.DataVersion.objects.filter(name=name)
+        .values_list("token", flat=True)
+        .first()
+    )
+    return token or ""
+
+
+def bump_version(name=REFERENCE):
+    """
+            Moves some data to a new version, so nothing kept under the old one is used again, in any process.
+            Versions are random rather than counted, so one a rolled back transaction handed out is never
+            handed out again.
+    :return: the new version
+    """
+    # imported here since the models import this module
+    from npsat_manager import models
+
+    token = uuid.uuid4().hex
+    models.DataVersion.objects.update_or_create(name=name, defaults={"token": token})
+    return token
+
+
+def response_key(url, query_params, media_type):
+    """
+            Cache key for a response under the current version
+    :param url: the request's absolute URL without its query string
+    :param query_params: the request's QueryDict - parameters are sorted, so their order doesn't matter
+    :param media_type: the media type the response is rendered as
+    """
+    parameters = sorted(
+        (key, value) for key, values in query_params.lists() for value in values
+    )
+    digest = hashlib.sha1(
+        repr((url, parameters, media_type)).encode("utf-8")
+    ).hexdigest()
+    return "npsat:reference:{}:{}".format(get_version(), digest)
+
+
+def get_response(key):
+    """(content, content_type, etag) cached under the key, or None"""
+    return cache.get(key)
+
+
+def set_response(key, content, content_type):
+    """
+            Caches a rendered response
+    :return: tuple of (content, content_type, etag) - the ETag is the content's hash, so it's a strong one
+    """
+    cached = (content, content_type, '"{}"'.format(hashlib.sha1(content).hexdigest()))
+    cache.set(key, cached, timeout=None)
+    return cached
+
+
+def _reference_data_changed(sender, **kwargs):
+    bump_version()
+    for name in REFERENCE_MODELS[sender._meta.label]:
+        bump_version(name)
+
+
+for _model in REFERENCE_MODELS:
+    post_save.connect(_reference_data_changed, sender=_model)
+    post_delete.connect(_reference_data_changed, sender=_model)
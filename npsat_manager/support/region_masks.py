@@ -0,0 +1,189 @@
+"""
+	Region geometries rasterized onto the model grid. A mask is stored as row runs - an (N, 3) array of
+	(row, first column, column after the last) for each stretch of pixels inside the region - which is tiny next to
+	a full grid sized bitmask and is quick to turn back into a mask for just the window a run needs.
+
+	Masks are made once per region and cached as .npy files alongside the raster store, keyed by the hash of the
+	region's geometry and the grid, so editing a region's geometry or changing the grid just makes a new mask.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy
+
+from npsat_backend import settings
+from npsat_manager.support import compatibility, geometry
+
+log = logging.getLogger("npsat.support.region_masks")
+
+
+def rasterize_geometry(region_geometry, raster_info):
+    """
+            Finds the pixels of the model grid whose centers fall inside a longitude/latitude Polygon or
+            MultiPolygon, with an even-odd scanline fill - so holes are left out. Every edge's crossings with
+            every pixel row's center line are found at once, then sorted along each row and paired up.
+    :param region_geometry: GeoJSON geometry or Feature, parsed or as text
+    :param raster_info: compatibility.RasterInfo for the model grid
+    :return: (N, 3) int32 array of (row, first column, column after the last) runs
+    """
+    rows, cols = raster_info.shape
+    origin_x, pixel_width, _, origin_y, _, pixel_height = raster_info.geotransform
+
+    crossing_rows = []
+    crossing_cols = []
+    for polygon in geometry.iterate_polygons(region_geometry):
+        for ring in polygon:
+            x, y = geometry.project_albers(ring[:, 0], ring[:, 1])
+            ring_cols = (x - origin_x) / pixel_width
+            ring_rows = (y - origin_y) / pixel_height
+            # each edge runs from a vertex to the next one, with the last vertex joined back to the first
+            start_rows, end_rows = ring_rows, numpy.roll(ring_rows, -1)
+            start_cols, end_cols = ring_cols, numpy.roll(ring_cols, -1)
+
+            # an edge crosses the center line (row + 0.5) of every row from low up to, but not including, high.
+            # Horizontal edges cross nothing, and rows outside the grid are skipped entirely.
+            low = numpy.maximum(
+                numpy.ceil(numpy.minimum(start_rows, end_rows) - 0.5), 0
+            ).astype(numpy.int64)
+            high = numpy.minimum(
+                numpy.ceil(numpy.maximum(start_rows, end_rows) - 0.5), rows
+            ).astype(numpy.int64)
+            counts = numpy.maximum(high - low, 0)
+
+            edges = numpy.repeat(numpy.arange(len(counts)), counts)
+            edge_rows = low[edges] + (
+                numpy.arange(counts.sum())
+                - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            )
+            fraction = (edge_rows + 0.5 - start_rows[edges]) / (
+                end_rows[edges] - start_rows[edges]
+            )
+            crossing_rows.append(edge_rows)
+            crossing_cols.append(
+                start_cols[edges] + fraction * (end_cols[edges] - start_cols[edges])
+            )
+
+    if not crossing_rows:
+        return numpy.zeros((0, 3), dtype=numpy.int32)
+    crossing_rows = numpy.concatenate(crossing_rows)
+    crossing_cols = numpy.concatenate(crossing_cols)
+    order = numpy.lexsort((crossing_cols, crossing_rows))
+    crossing_rows = crossing_rows[order]
+    crossing_cols = crossing_cols[order]
+
+    # closed rings cross every row an even number of times, so consecutive crossings along a row pair up into
+    # inside stretches. Pixel centers (col + 0.5) from the first crossing up to the second are inside.
+    run_rows = crossing_rows[0::2]
+    run_starts = numpy.clip(numpy.ceil(crossing_cols[0::2] - 0.5), 0, cols)
+    run_ends = numpy.clip(numpy.ceil(crossing_cols[1::2] - 0.5), 0, cols)
+    runs = numpy.stack([run_rows, run_starts, run_ends], axis=1).astype(numpy.int32)
+    return runs[runs[:, 2] > runs[:, 1]]
+
+
+def runs_to_mask(runs, window):
+    """
+            Expands row runs into a boolean mask for a window of the grid. Overlapping runs, like those from
+            combining several regions, are fine.
+    :param runs: (N, 3) array of runs, as made by rasterize_geometry
+    :param window: compatibility.Window of the grid to make the mask for
+    :return: (window.height, window.width) boolean array
+    """
+    rows = runs[:, 0] - window.row_off
+    starts = numpy.clip(runs[:, 1] - window.col_off, 0, window.width)
+    ends = numpy.clip(runs[:, 2] - window.col_off, 0, window.width)
+    keep = (rows >= 0) & (rows < window.height) & (ends > starts)
+
+    # +1 where each run starts and -1 where it ends, then a running sum along each row counts the runs covering
+    # each pixel
+    changes = numpy.zeros((window.height, window.width + 1), dtype=numpy.int32)
+    numpy.add.at(changes, (rows[keep], starts[keep]), 1)
+    numpy.add.at(changes, (rows[keep], ends[keep]), -1)
+    return numpy.cumsum(changes, axis=1)[:, : window.width] > 0
+
+
+def runs_window(runs, raster_info):
+    """
+            The smallest block of the grid covering a set of runs, grown out to the raster's internal blocks
+            so no block is decoded twice
+    :return: compatibility.Window - empty if there aren't any runs
+    """
+    if len(runs) == 0:
+        return compatibility.Window(0, 0, 0, 0)
+    window = compatibility.Window(
+        int(runs[:, 1].min()),
+        int(runs[:, 0].min()),
+        int(runs[:, 2].max() - runs[:, 1].min()),
+        int(runs[:, 0].max() + 1 - runs[:, 0].min()),
+    )
+    return compatibility.align_window(
+        window, raster_info.block_shape, raster_info.shape
+    )
+
+
+class RegionMaskCache(object):
+    """
+    Rasterized region masks, on disk and in memory. Files are named for the region's id plus a hash of its
+    geometry and the grid it was rasterized onto.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def mask_key(region, raster_info):
+        """
+                Hash of everything the mask depends on. The geometry goes in as the region's geometry_sha256, so
+                the geometry itself isn't parsed or serialized for every lookup.
+        """
+        key_source = json.dumps(
+            {
+                "geometry": region.geometry_sha256,
+                "shape": list(raster_info.shape),
+                "geotransform": list(raster_info.geotransform),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+
+    def get_runs(self, region, raster_info):
+        """
+                The region's mask as row runs - rasterized and saved the first time it's asked for
+        :param region: npsat_manager.models.Region with geometry
+        :param raster_info: compatibility.RasterInfo for the model grid
+        :return: (N, 3) array of runs
+        """
+        file_name = "{}_{}.npy".format(region.id, self.mask_key(region, raster_info))
+        with self._lock:
+            if file_name in self._runs:
+                return self._runs[file_name]
+
+        path = os.path.join(self.folder, file_name)
+        if os.path.exists(path):
+            runs = numpy.load(path)
+        else:
+            log.info("Rasterizing region {}".format(region.id))
+            runs = rasterize_geometry(region.geometry, raster_info)
+            os.makedirs(self.folder, exist_ok=True)
+            temporary_path = os.path.join(self.folder, "{}.tmp.npy".format(file_name))
+            numpy.save(temporary_path, runs)
+            os.replace(temporary_path, path)
+
+        with self._lock:
+            self._runs[file_name] = runs
+        return runs
+
+    def union_runs(self, regions, raster_info):
+        """runs covering every pixel in any of the regions - runs may overlap, which runs_to_mask handles"""
+        return numpy.concatenate(
+            [numpy.zeros((0, 3), dtype=numpy.int32)]
+            + [self.get_runs(region, raster_info) for region in regions]
+        )
+
+
+region_masks = RegionMaskCache(settings.RegionMaskFolder)
@@ -0,0 +1,118 @@
+"""
+	Which crops each scenario uses. A scenario's crop_code_field says whether its crops are identified by their CAML
+	or SWAT code, so it uses the crops of that type, along with the crops that are in both and the special "all
+	other crops" one. The crop list view, model run validation and the model run input message all need this, so
+	it's worked out once for every scenario and kept in memory.
+
+	The map is kept under the crops version from reference_cache, which is in the database - saving or deleting a
+	crop or scenario in any process bumps it, so the next use in every process builds the map again.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+
+from npsat_manager.support import reference_cache
+
+log = logging.getLogger("npsat.support.scenario_crops")
+
+_map_lock = threading.Lock()
+_map = None  # (crops version, ScenarioCropMap)
+
+
+def crop_types_for(crop_code_field):
+    """
+            Crop types a scenario uses
+    :param crop_code_field: the scenario's crop_code_field - Scenario.GNLM_CROP, Scenario.SWAT_CROP or None
+    :return: list of Crop crop types
+    """
+    # imported here since the models import this module
+    from npsat_manager import models
+
+    crop_types = [models.Crop.ALL_OTHER_CROPS, models.Crop.GENERAL_CROP]
+    if crop_code_field == models.Scenario.GNLM_CROP:
+        crop_types.append(models.Crop.GNLM_CROP)
+    elif crop_code_field == models.Scenario.SWAT_CROP:
+        crop_types.append(models.Crop.SWAT_CROP)
+    return crop_types
+
+
+class ScenarioCropMap(object):
+    """
+    Crops every scenario uses, and the codes they go by in it. Crops are kept in id order, whether they're
+    active or not, since model runs can still refer to inactive ones.
+    """
+
+    def __init__(self, scenarios, crops):
+        """
+        :param scenarios: iterable of (id, crop_code_field)
+        :param crops: iterable of (id, crop_type, caml_code, swat_code, active_in_mantis), in id order
+        """
+        # imported here since the models import this module
+        from npsat_manager import models
+
+        code_field_names = dict(models.Scenario.CROP_CODE_TYPE)
+        crops = list(crops)
+        self.crop_ids = set(crop[0] for crop in crops)
+
+        self.code_fields = {}
+        self.crop_types = {}
+        self.codes = {}  # scenario id -> {crop id: code in the scenario}
+        self.active_crop_ids = {}
+        for scenario_id, crop_code_field in scenarios:
+            code_field = code_field_names.get(crop_code_field)
+            crop_types = crop_types_for(crop_code_field)
+            scenario_crops = [crop for crop in crops if crop[1] in crop_types]
+            self.code_fields[scenario_id] = code_field
+            self.crop_types[scenario_id] = crop_types
+            self.codes[scenario_id] = {}
+            for crop_id, _, caml_code, swat_code, _ in scenario_crops:
+                codes = {"caml_code": caml_code, "swat_code": swat_code}
+                self.codes[scenario_id][crop_id] = codes.get(code_field)
+            self.active_crop_ids[scenario_id] = [
+                crop[0] for crop in scenario_crops if crop[4]
+            ]
+
+        self.content = json.dumps(self.matrix(), separators=(",", ":")).encode("utf-8")
+        self.etag = '"{}"'.format(hashlib.sha1(self.content).hexdigest())
+
+    def matrix(self):
+        """every scenario with the code field it uses and its active crops, for the scenario_crops endpoint"""
+        return [
+            {
+                "scenario": scenario_id,
+                "crop_code_field": self.code_fields[scenario_id],
+                "crop_types": self.crop_types[scenario_id],
+                "crops": [
+                    {"id": crop_id, "code": self.codes[scenario_id][crop_id]}
+                    for crop_id in self.active_crop_ids[scenario_id]
+                ],
+            }
+            for scenario_id in sorted(self.codes)
+        ]
+
+
+def build_map():
+    """builds a ScenarioCropMap from every scenario and crop"""
+    # imported here since the models import this module
+    from npsat_manager import models
+
+    crop_map = ScenarioCropMap(
+        models.Scenario.objects.values_list("id", "crop_code_field"),
+        models.Crop.objects.order_by("id").values_list(
+            "id", "crop_type", "caml_code", "swat_code", "active_in_mantis"
+        ),
+    )
+    log.debug("Mapped crops for {} scenarios".format(len(crop_map.codes)))
+    return crop_map
+
+
+def get_map():
+    """the ScenarioCropMap for the current crops and scenarios, building it again if they've changed"""
+    global _map
+    version = reference_cache.get_version(reference_cache.CROPS)
+    with _map_lock:
+        if _map is None or _map[0] != version:
+            _map = (version, build_map())
+        return _map[1]
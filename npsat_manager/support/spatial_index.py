@@ -0,0 +1,195 @@
+"""
+	Finding regions by location without going through every geometry. Each region's bounding box is worked out when
+	it's saved and kept in indexed columns, and this module keeps an in-memory grid over those boxes - a point only
+	has to be tested against the regions whose boxes share its grid cell, and only the ones whose boxes hold it get
+	the exact point in polygon test.
+
+	The index is kept under the regions version from reference_cache, which is in the database and which saving
+	or deleting a region in any process bumps, so every process builds it again on its next lookup after regions
+	change. Geometries are only parsed for regions that a lookup actually needs to test exactly, then kept.
+"""
+
+import logging
+import math
+import threading
+
+import numpy
+
+from npsat_backend import settings
+from npsat_manager.support import geometry, reference_cache
+
+log = logging.getLogger("npsat.support.spatial_index")
+
+_index_lock = threading.Lock()
+_index = None  # (regions version, RegionIndex)
+
+
+def points_in_polygon(polygon, x, y):
+    """
+            Even-odd test of which points are inside a polygon - counts how many of the polygon's edges a ray
+            running east from each point crosses, for every edge and point at once. Since every ring counts,
+            points in holes come out as outside.
+    :param polygon: list of (N, 2) closed rings, as given by geometry.iterate_polygons
+    :param x: (P,) array of x coordinates
+    :param y: (P,) array of y coordinates
+    :return: (P,) boolean array
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    crossings = numpy.zeros(x.shape, dtype=numpy.int64)
+    if not len(x):
+        return crossings.astype(bool)
+    for ring in polygon:
+        starts = ring[:-1]
+        ends = ring[1:]
+        # only edges level with some point, and not entirely west of them all, can be crossed - for a few
+        # points in a large polygon, that's a small part of its edges
+        nearby = (
+            (numpy.minimum(starts[:, 1], ends[:, 1]) <= y.max())
+            & (numpy.maximum(starts[:, 1], ends[:, 1]) >= y.min())
+            & (numpy.maximum(starts[:, 0], ends[:, 0]) >= x.min())
+        )
+        starts = starts[nearby, :, None]
+        ends = ends[nearby, :, None]
+        # (edges, points) - edges with one end above the point and the other at or below it
+        spans = (starts[:, 1] > y) != (ends[:, 1] > y)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = starts[:, 0] + (y - starts[:, 1]) * (
+                ends[:, 0] - starts[:, 0]
+            ) / (ends[:, 1] - starts[:, 1])
+        crossings += numpy.count_nonzero(spans & (crossing_x > x), axis=0)
+    return crossings % 2 == 1
+
+
+def point_in_polygon(polygon, x, y):
+    """whether a single point is inside a polygon - see points_in_polygon"""
+    return bool(points_in_polygon(polygon, [x], [y])[0])
+
+
+class RegionIndex(object):
+    """
+    Grid of active regions' bounding boxes. Each cell (settings.RegionIndexCellSize degrees across) holds the
+    regions whose boxes overlap it.
+    """
+
+    def __init__(self, regions, cell_size):
+        """
+        :param regions: iterable of (id, region_type, (west, south, east, north)) for regions with geometry
+        :param cell_size: width and height of the grid cells, in degrees
+        """
+        regions = list(regions)
+        self.cell_size = cell_size
+        self.ids = numpy.array([region[0] for region in regions], dtype=numpy.int64)
+        self.region_types = numpy.array(
+            [region[1] for region in regions], dtype=numpy.int64
+        )
+        self.bounds = numpy.array(
+            [region[2] for region in regions], dtype=numpy.float64
+        ).reshape(-1, 4)
+
+        cells = {}
+        for index, (west, south, east, north) in enumerate(self.bounds):
+            for column in range(self._cell(west), self._cell(east) + 1):
+                for row in range(self._cell(south), self._cell(north) + 1):
+                    cells.setdefault((column, row), []).append(index)
+        self.cells = {
+            cell: numpy.array(indices, dtype=numpy.int64)
+            for cell, indices in cells.items()
+        }
+
+        self._polygons = {}
+        self._polygons_lock = threading.Lock()
+
+    def _cell(self, coordinate):
+        return math.floor(coordinate / self.cell_size)
+
+    def _get_polygons(self, region_ids):
+        """parsed polygons of regions, loading the ones that haven't been needed before"""
+        # imported here since the models import this module
+        from npsat_manager import models
+
+        with self._polygons_lock:
+            missing = [
+                region_id for region_id in region_ids if region_id not in self._polygons
+            ]
+            if missing:
+                for region_id, region_geometry in models.Region.objects.filter(
+                    id__in=missing
+                ).values_list("id", "geometry_blob__geometry"):
+                    self._polygons[region_id] = list(
+                        geometry.iterate_polygons(region_geometry)
+                    )
+            return [self._polygons[region_id] for region_id in region_ids]
+
+    def regions_at(self, longitude, latitude, region_type=None):
+        """
+                Ids of the regions containing a point
+        :param region_type: optional region type to limit the regions to
+        :return: list of region ids
+        """
+        candidates = self.cells.get(
+            (self._cell(longitude), self._cell(latitude)),
+            numpy.empty(0, dtype=numpy.int64),
+        )
+        bounds = self.bounds[candidates]
+        inside = (
+            (bounds[:, 0] <= longitude)
+            & (bounds[:, 2] >= longitude)
+            & (bounds[:, 1] <= latitude)
+            & (bounds[:, 3] >= latitude)
+        )
+        if region_type is not None:
+            inside &= self.region_types[candidates] == region_type
+        region_ids = [int(region_id) for region_id in self.ids[candidates[inside]]]
+
+        return [
+            region_id
+            for region_id, polygons in zip(region_ids, self._get_polygons(region_ids))
+            if any(
+                point_in_polygon(polygon, longitude, latitude) for polygon in polygons
+            )
+        ]
+
+
+def build_index():
+    """builds a RegionIndex of the active regions from their bounding box columns"""
+    # imported here since the models import this module
+    from npsat_manager import models
+
+    regions = []
+    for region in (
+        models.Region.objects.filter(active_in_mantis=True)
+        .exclude(geometry_blob=None)
+        .only(
+            "id",
+            "region_type",
+            "geometry_blob",
+            "bbox_west",
+            "bbox_south",
+            "bbox_east",
+            "bbox_north",
+        )
+    ):
+        if region.bbox_west is None:
+            # saved before bounding boxes were kept - work it out from the geometry, for now
+            bounds = geometry.geometry_bounds(region.geometry)
+        else:
+            bounds = (
+                region.bbox_west,
+                region.bbox_south,
+                region.bbox_east,
+                region.bbox_north,
+            )
+        regions.append((region.id, region.region_type, bounds))
+    log.debug("Indexed {} regions".format(len(regions)))
+    return RegionIndex(regions, settings.RegionIndexCellSize)
+
+
+def get_index():
+    """the RegionIndex for the current regions, building it again if they've changed"""
+    global _index
+    version = reference_cache.get_version(reference_cache.REGIONS)
+    with _index_lock:
+        if _index is None or _index[0] != version:
+            _index = (version, build_index())
+        return _index[1]
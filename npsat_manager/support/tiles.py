@@ -0,0 +1,364 @@
+"""
+	Region geometry cut into web mercator tiles, so a map only fetches the regions in view at the detail its zoom can
+	show. Each tile is a GeoJSON FeatureCollection of the regions overlapping it - simplified to about a pixel at the
+	tile's zoom, then clipped to the tile (with a small buffer, so outlines don't stop short at tile edges).
+
+	Tiles are kept on disk as JSON, gzipped JSON and a strong ETag, either made ahead of time by the
+	pregenerate_tiles command or on their first request. Each region type has a tiles version in reference_cache,
+	which is in the database, and its tiles are kept in a folder for the version. Saving or deleting a region
+	removes its type's tiles and moves it to a new version, so every process renders its tiles again from the
+	regions as they are now - and a process still rendering from older regions writes into a folder that's no
+	longer read. The parsed regions tiles are rendered from are kept in memory under the same version.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+
+import numpy
+from django.db.models.signals import post_delete
+
+from npsat_backend import settings
+from npsat_manager.support import geometry, reference_cache
+
+log = logging.getLogger("npsat.support.tiles")
+
+TILE_SIZE = 256  # pixels along each side of a tile, for working out how much detail it can show
+BUFFER_PIXELS = 4  # how far past its edges a tile's geometry runs
+
+_shapes_lock = threading.Lock()
+_shapes = {}  # region_type -> (tiles version, _RegionShapes)
+
+
+class _RegionShapes(object):
+    """parsed polygons and bounds of a region type's active regions, shared by every tile of the type"""
+
+    def __init__(self, regions):
+        regions = [region for region in regions if region.geometry is not None]
+        self.ids = [region.id for region in regions]
+        self.properties = [
+            {
+                "name": region.name,
+                "mantis_id": region.mantis_id,
+                "external_id": region.external_id,
+                "region_type": region.region_type,
+            }
+            for region in regions
+        ]
+        self.polygons = [
+            list(geometry.iterate_polygons(region.geometry)) for region in regions
+        ]
+        self.bounds = numpy.array(
+            [geometry.geometry_bounds(region.geometry) for region in regions]
+        ).reshape(-1, 4)
+
+    def overlapping(self, bounds):
+        """indices of the regions whose bounds overlap (west, south, east, north) bounds"""
+        west, south, east, north = bounds
+        return numpy.flatnonzero(
+            (self.bounds[:, 0] <= east)
+            & (self.bounds[:, 2] >= west)
+            & (self.bounds[:, 1] <= north)
+            & (self.bounds[:, 3] >= south)
+        )
+
+
+def get_version(region_type):
+    """the current tiles version of a region type"""
+    # the folder needs a name before the first change too
+    return reference_cache.get_version("tiles:{}".format(region_type)) or "initial"
+
+
+def _get_shapes(region_type, version=None):
+    """
+            The _RegionShapes of a region type at a tiles version, loading them if they're from an older one
+    :param version: the tiles version - the current one if it's None
+    """
+    # imported here since the models import this module
+    from npsat_manager import models
+
+    if version is None:
+        version = get_version(region_type)
+    with _shapes_lock:
+        if region_type not in _shapes or _shapes[region_type][0] != version:
+            _shapes[region_type] = (
+                version,
+                _RegionShapes(
+                    models.Region.objects.filter(
+                        region_type=region_type, active_in_mantis=True
+                    )
+                    .select_related("geometry_blob")
+                    .order_by("name")
+                ),
+            )
+        return _shapes[region_type][1]
+
+
+def tile_exists(z, x, y):
+    """whether z/x/y is a tile we serve"""
+    return 0 <= z <= settings.TileMaxZoom and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def tile_bounds(z, x, y):
+    """(west, south, east, north) of a tile in degrees - tile rows count down from the north"""
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / 2**z))))
+
+    return (
+        x / 2**z * 360 - 180,
+        latitude(y + 1),
+        (x + 1) / 2**z * 360 - 180,
+        latitude(y),
+    )
+
+
+def tiles_covering(bounds, z):
+    """(x, y) of every tile at zoom z overlapping (west, south, east, north) bounds"""
+    west, south, east, north = bounds
+
+    def column(longitude):
+        return min(max(int((longitude + 180) / 360 * 2**z), 0), 2**z - 1)
+
+    def row(latitude):
+        latitude = math.radians(latitude)
+        fraction = (1 - math.asinh(math.tan(latitude)) / math.pi) / 2
+        return min(max(int(fraction * 2**z), 0), 2**z - 1)
+
+    for x in range(column(west), column(east) + 1):
+        for y in range(row(north), row(south) + 1):
+            yield x, y
+
+
+def _detail(z):
+    """
+            Simplification tolerance and decimals to round to at a zoom level - about a pixel of a tile, measured
+            along the equator, so it's a little finer than needed further north
+    """
+    pixel = 360 / 2**z / TILE_SIZE
+    return pixel, max(0, math.ceil(-math.log10(pixel))) + 1
+
+
+def _clip_ring_edge(points, axis, value, keep_below):
+    """
+            One Sutherland-Hodgman step - clips an open ring to one side of a line of constant x (axis 0) or y
+            (axis 1). Every vertex and every edge crossing the line are handled at once.
+    :param points: (N, 2) array, without the first vertex repeated at the end
+    :return: (M, 2) array, also open
+    """
+    previous = numpy.roll(points, 1, axis=0)
+    if keep_below:
+        inside = points[:, axis] <= value
+    else:
+        inside = points[:, axis] >= value
+    crossing = inside != numpy.roll(inside, 1)
+
+    change = points[:, axis] - previous[:, axis]
+    fraction = numpy.divide(
+        value - previous[:, axis],
+        change,
+        out=numpy.zeros(len(points)),
+        where=crossing & (change != 0),
+    )
+    crossings = previous + fraction[:, None] * (points - previous)
+    crossings[:, axis] = value
+
+    # for each edge, the point where it crosses the line (if it does), then its end vertex (if it's inside)
+    candidates = numpy.stack([crossings, points], axis=1)
+    return candidates[numpy.stack([crossing, inside], axis=1)]
+
+
+def clip_ring(ring, bounds):
+    """
+            Clips a closed ring to a rectangle. Parts of a concave ring that leave the rectangle and come back in
+            are joined along its edge, which doesn't show when the polygon is filled.
+    :param ring: (N, 2) array with the first vertex repeated at the end
+    :param bounds: (west, south, east, north)
+    :return: (M, 2) array, closed, or None if nothing of the ring is left
+    """
+    west, south, east, north = bounds
+    points = ring[:-1]
+    for axis, value, keep_below in (
+        (0, west, False),
+        (0, east, True),
+        (1, south, False),
+        (1, north, True),
+    ):
+        points = _clip_ring_edge(points, axis, value, keep_below)
+        if len(points) < 3:
+            return None
+    return numpy.concatenate([points, points[:1]])
+
+
+def _round_ring(ring, digits):
+    """rounds a ring, dropping vertices the rounding lands on the one before - None if it collapses"""
+    rounded = numpy.round(ring, digits)
+    changes = numpy.any(rounded[1:] != rounded[:-1], axis=1)
+    rounded = rounded[numpy.concatenate([[True], changes])]
+    return rounded if len(rounded) >= 4 else None
+
+
+def _simplify_polygons(polygons, z):
+    tolerance, _ = _detail(z)
+    return [
+        [geometry.simplify_ring(ring, tolerance) for ring in polygon]
+        for polygon in polygons
+    ]
+
+
+def render_tile(shapes, z, x, y, simplified=None):
+    """
+            Makes the GeoJSON FeatureCollection for a tile
+    :param shapes: _RegionShapes of the tile's region type
+    :param simplified: optional dict of region index -> its polygons already simplified for zoom z, so
+                                    regions spanning many tiles are only simplified once
+    :return: parsed GeoJSON
+    """
+    west, south, east, north = tile_bounds(z, x, y)
+    buffer_x = (east - west) * BUFFER_PIXELS / TILE_SIZE
+    buffer_y = (north - south) * BUFFER_PIXELS / TILE_SIZE
+    bounds = (west - buffer_x, south - buffer_y, east + buffer_x, north + buffer_y)
+    _, digits = _detail(z)
+
+    features = []
+    for index in shapes.overlapping(bounds):
+        if simplified is not None and index in simplified:
+            polygons = simplified[index]
+        else:
+            polygons = _simplify_polygons(shapes.polygons[index], z)
+            if simplified is not None:
+                simplified[index] = polygons
+
+        clipped_polygons = []
+        for polygon in polygons:
+            clipped = [clip_ring(ring, bounds) for ring in polygon]
+            clipped = [
+                None if ring is None else _round_ring(ring, digits) for ring in clipped
+            ]
+            if clipped[0] is None:
+                continue
+            clipped_polygons.append(
+                [ring.tolist() for ring in clipped if ring is not None]
+            )
+        if not clipped_polygons:
+            continue
+
+        features.append(
+            {
+                "type": "Feature",
+                "id": shapes.ids[index],
+                "properties": shapes.properties[index],
+                "geometry": {"type": "MultiPolygon", "coordinates": clipped_polygons},
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def tile_path(region_type, z, x, y, version=None):
+    """
+            Where a tile is kept - the gzipped copy and its ETag have .gz and .etag on the end
+    :param version: the tiles version - the current one if it's None
+    """
+    if version is None:
+        version = get_version(region_type)
+    return os.path.join(
+        settings.TileFolder,
+        str(region_type),
+        version,
+        str(z),
+        str(x),
+        "{}.geojson".format(y),
+    )
+
+
+def write_tile(region_type, z, x, y, collection, version):
+    """
+            Saves a rendered tile along with its gzipped copy and ETag, replacing any older one
+    :param version: the tiles version the tile was rendered at
+    :return: path of the tile
+    """
+    text = json.dumps(collection, separators=(",", ":")).encode("utf-8")
+    etag = hashlib.sha1(text).hexdigest()
+
+    path = tile_path(region_type, z, x, y, version)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the ETag goes last, since it's the one get_tile checks for
+    for file_path, content in (
+        (path, text),
+        (path + ".gz", gzip.compress(text)),
+        (path + ".etag", etag.encode("ascii")),
+    ):
+        temporary_path = file_path + ".tmp"
+        with open(temporary_path, "wb") as output:
+            output.write(content)
+        os.replace(temporary_path, file_path)
+    return path
+
+
+def get_tile(region_type, z, x, y, compressed=False):
+    """
+            A tile's file and its ETag, rendering the tile first if it hasn't been yet
+    :return: tuple of (path, quoted strong ETag) - the gzipped copy has its own ETag, since its bytes differ
+    """
+    version = get_version(region_type)
+    path = tile_path(region_type, z, x, y, version)
+    if not os.path.exists(path + ".etag"):
+        shapes = _get_shapes(region_type, version)
+        write_tile(region_type, z, x, y, render_tile(shapes, z, x, y), version)
+    with open(path + ".etag") as etag_file:
+        etag = etag_file.read()
+    if compressed:
+        return path + ".gz", '"{}-gzip"'.format(etag)
+    return path, '"{}"'.format(etag)
+
+
+def pregenerate_tiles(region_type, zooms):
+    """
+            Renders every tile of a region type that has any region in it
+    :param zooms: iterable of zoom levels
+    :return: number of tiles written
+    """
+    version = get_version(region_type)
+    shapes = _get_shapes(region_type, version)
+    count = 0
+    for z in zooms:
+        simplified = {}
+        tiles = set()
+        for bounds in shapes.bounds:
+            tiles.update(tiles_covering(bounds, z))
+        for x, y in sorted(tiles):
+            collection = render_tile(shapes, z, x, y, simplified)
+            write_tile(region_type, z, x, y, collection, version)
+            count += 1
+        log.info(
+            "Wrote {} tiles for region type {} at zoom {}".format(
+                len(tiles), region_type, z
+            )
+        )
+    return count
+
+
+def remove_tiles(region_type):
+    """
+            Moves a region type to a new tiles version and removes its tiles, so they're rendered again from the
+            regions as they are now, in every process
+    """
+    reference_cache.bump_version("tiles:{}".format(region_type))
+    with _shapes_lock:
+        _shapes.pop(region_type, None)
+    shutil.rmtree(
+        os.path.join(settings.TileFolder, str(region_type)), ignore_errors=True
+    )
+
+
+def _region_deleted(sender, instance, **kwargs):
+    remove_tiles(instance.region_type)
+
+
+# given as a name since the models import this module
+post_delete.connect(_region_deleted, sender="npsat_manager.Region")
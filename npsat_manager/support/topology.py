@@ -0,0 +1,252 @@
+"""
+	TopoJSON for a whole region type. Townships, counties and basins share most of their boundaries, so instead of
+	sending every polygon separately, each boundary is stored once as an arc that every region touching it refers to.
+	Coordinates are quantized to integers and each arc after its first point is stored as deltas, which keeps the
+	numbers short.
+
+	Topologies are built once and kept on disk as JSON and gzipped JSON, ready to be sent as they are, with ETags
+	from the files. Saving a region removes its type's topology, and the next request builds it again.
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+
+import numpy
+
+from npsat_backend import settings
+from npsat_manager.support import geometry
+
+log = logging.getLogger("npsat.support.topology")
+
+# quantized coordinates run from 0 to QUANTIZATION - 1 across the topology's extent on each axis
+QUANTIZATION = 100000
+
+_build_lock = threading.Lock()
+
+
+def _quantize_ring(ring, translate, scale):
+    """
+            Quantizes a ring, dropping vertices that quantize onto the one before them
+    :return: (N, 2) int64 array, or None if the ring collapses to less than a triangle
+    """
+    quantized = numpy.round((ring - translate) / scale).astype(numpy.int64)
+    changes = numpy.any(quantized[1:] != quantized[:-1], axis=1)
+    quantized = quantized[numpy.concatenate([[True], changes])]
+    return quantized if len(quantized) >= 4 else None
+
+
+def _quantized_rings(regions, translate, scale):
+    """
+            Quantizes every ring of every region. Polygons whose exterior ring collapses are left out.
+    :return: tuple of (list of rings as (N, 2) int64 arrays, list of each region's polygons as lists of
+                    indices into the rings)
+    """
+    rings = []
+    region_polygons = []
+    for region in regions:
+        polygons = []
+        for polygon in geometry.iterate_polygons(region.geometry):
+            quantized = [_quantize_ring(ring, translate, scale) for ring in polygon]
+            if quantized[0] is None:
+                continue
+            kept = [ring for ring in quantized if ring is not None]
+            polygons.append(list(range(len(rings), len(rings) + len(kept))))
+            rings.extend(kept)
+        region_polygons.append(polygons)
+    return rings, region_polygons
+
+
+def _edge_sharing(rings):
+    """
+            For every edge of every ring, which rings the edge is part of - found for all edges at once by sorting
+            them on their endpoints, whichever direction they run
+    :return: list of (edges, 2) int64 arrays, one per ring, of the lowest and highest ring index using each edge
+    """
+    starts = numpy.concatenate([ring[:-1] for ring in rings])
+    ends = numpy.concatenate([ring[1:] for ring in rings])
+    edge_rings = numpy.repeat(
+        numpy.arange(len(rings)), [len(ring) - 1 for ring in rings]
+    )
+
+    # an undirected key for each edge - the lower endpoint first
+    swap = (starts[:, 0] > ends[:, 0]) | (
+        (starts[:, 0] == ends[:, 0]) & (starts[:, 1] > ends[:, 1])
+    )
+    low = numpy.where(swap[:, None], ends, starts)
+    high = numpy.where(swap[:, None], starts, ends)
+    keys = numpy.stack([low[:, 0], low[:, 1], high[:, 0], high[:, 1]], axis=1)
+    _, edge_ids = numpy.unique(keys, axis=0, return_inverse=True)
+    edge_ids = edge_ids.ravel()
+
+    lowest = numpy.full(edge_ids.max() + 1, len(rings), dtype=numpy.int64)
+    highest = numpy.full(edge_ids.max() + 1, -1, dtype=numpy.int64)
+    numpy.minimum.at(lowest, edge_ids, edge_rings)
+    numpy.maximum.at(highest, edge_ids, edge_rings)
+    sharing = numpy.stack([lowest[edge_ids], highest[edge_ids]], axis=1)
+
+    boundaries = numpy.cumsum([len(ring) - 1 for ring in rings])[:-1]
+    return numpy.split(sharing, boundaries)
+
+
+def _cut_arcs(rings):
+    """
+            Cuts each ring into arcs wherever the rings sharing its edges change, so a boundary between two
+            regions is one arc, and stores each distinct arc once
+    :return: tuple of (list of arcs as (N, 2) arrays, list of each ring's arc references - an index into the
+                    arcs, or its ones' complement for an arc that's followed backwards)
+    """
+    arcs = []
+    arc_index = {}
+    ring_arcs = []
+    for ring, sharing in zip(rings, _edge_sharing(rings)):
+        changes = numpy.flatnonzero(
+            numpy.any(sharing != numpy.roll(sharing, 1, axis=0), axis=1)
+        )
+        if len(changes):
+            # start at a cut, so no arc wraps around the ring's first vertex
+            ring = numpy.concatenate([ring[changes[0] : -1], ring[: changes[0] + 1]])
+            cuts = list(changes - changes[0]) + [len(ring) - 1]
+        else:
+            cuts = [0, len(ring) - 1]
+
+        references = []
+        for start, end in zip(cuts[:-1], cuts[1:]):
+            arc = ring[start : end + 1]
+            key = arc.tobytes()
+            if key in arc_index:
+                references.append(arc_index[key])
+                continue
+            reverse_key = arc[::-1].tobytes()
+            if reverse_key in arc_index:
+                references.append(~arc_index[reverse_key])
+                continue
+            arc_index[key] = len(arcs)
+            references.append(len(arcs))
+            arcs.append(arc)
+        ring_arcs.append(references)
+    return arcs, ring_arcs
+
+
+def build_topology(regions, object_name="regions"):
+    """
+            Makes a TopoJSON topology out of regions' geometries
+    :param regions: iterable of npsat_manager.models.Region with geometry
+    :param object_name: name of the GeometryCollection in the topology's objects
+    :return: parsed TopoJSON
+    """
+    regions = [region for region in regions if region.geometry is not None]
+    if not regions:
+        return {
+            "type": "Topology",
+            "objects": {object_name: {"type": "GeometryCollection", "geometries": []}},
+            "arcs": [],
+        }
+
+    bounds = numpy.array(
+        [geometry.geometry_bounds(region.geometry) for region in regions]
+    )
+    translate = bounds[:, :2].min(axis=0)
+    extent = bounds[:, 2:].max(axis=0) - translate
+    scale = numpy.where(extent > 0, extent / (QUANTIZATION - 1), 1)
+
+    rings, region_polygons = _quantized_rings(regions, translate, scale)
+    arcs, ring_arcs = _cut_arcs(rings) if rings else ([], [])
+
+    geometries = []
+    for region, polygons in zip(regions, region_polygons):
+        polygon_arcs = [[ring_arcs[ring] for ring in polygon] for polygon in polygons]
+        properties = {
+            "name": region.name,
+            "mantis_id": region.mantis_id,
+            "external_id": region.external_id,
+            "region_type": region.region_type,
+        }
+        if len(polygon_arcs) == 1:
+            shape = {"type": "Polygon", "arcs": polygon_arcs[0]}
+        else:
+            shape = {"type": "MultiPolygon", "arcs": polygon_arcs}
+        shape.update({"id": region.id, "properties": properties})
+        geometries.append(shape)
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": scale.tolist(), "translate": translate.tolist()},
+        "objects": {
+            object_name: {"type": "GeometryCollection", "geometries": geometries}
+        },
+        # the first point of each arc, then the change from each point to the next
+        "arcs": [
+            numpy.concatenate([arc[:1], numpy.diff(arc, axis=0)]).tolist()
+            for arc in arcs
+        ],
+    }
+
+
+def topology_path(region_type):
+    """where the topology for a region type is kept - the gzipped copy has .gz on the end"""
+    return os.path.join(settings.TopologyFolder, "{}.topojson".format(region_type))
+
+
+def write_topology(region_type):
+    """
+            Builds the topology of a region type's active regions and saves it, replacing any older one
+    :return: path of the topology
+    """
+    # imported here since the models import this module
+    from npsat_manager import models
+
+    regions = (
+        models.Region.objects.filter(region_type=region_type, active_in_mantis=True)
+        .select_related("geometry_blob")
+        .order_by("name")
+    )
+    topology = build_topology(
+        regions, object_name=dict(models.Region.REGION_TYPE)[region_type]
+    )
+    text = json.dumps(topology, separators=(",", ":")).encode("utf-8")
+
+    path = topology_path(region_type)
+    os.makedirs(settings.TopologyFolder, exist_ok=True)
+    for file_path, content in ((path, text), (path + ".gz", gzip.compress(text))):
+        temporary_path = file_path + ".tmp"
+        with open(temporary_path, "wb") as output:
+            output.write(content)
+        os.replace(temporary_path, file_path)
+    log.info("Built the topology for region type {}".format(region_type))
+    return path
+
+
+def get_topology_path(region_type, compressed=False):
+    """path of the region type's topology, building it first if there isn't one"""
+    path = topology_path(region_type)
+    with _build_lock:
+        if not os.path.exists(path + ".gz"):
+            write_topology(region_type)
+    return path + ".gz" if compressed else path
+
+
+def topology_etag(topology_file, compressed=False):
+    """
+            ETag of an open topology file, from its modification time and size. A topology is only ever replaced
+            by a new file, so an open one stays the same and the ETag matches what's sent from it.
+    :return: quoted ETag - the gzipped copy's has -gzip on the end, like tiles
+    """
+    stat = os.fstat(topology_file.fileno())
+    etag = "{:x}-{:x}".format(stat.st_mtime_ns, stat.st_size)
+    if compressed:
+        return '"{}-gzip"'.format(etag)
+    return '"{}"'.format(etag)
+
+
+def remove_topology(region_type):
+    """removes a region type's topology, so the next request builds it again"""
+    path = topology_path(region_type)
+    # the gzipped copy goes first, since that's the one get_topology_path checks for
+    for file_path in (path + ".gz", path):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
@@ -6,10 +6,29 @@ Note:
     2. several data should be loaded prior to the testing; see setUpClass for details
 """
 
+import gzip
+import json
+import os
+import tempfile
+from unittest import mock
+
+import numpy
+
+from django.core.cache import cache
 from django.test import TestCase
+from rest_framework import status
 from rest_framework.test import APIClient
 from npsat_manager import models
+from npsat_manager.support import (
+    containment,
+    geometry,
+    reference_cache,
+    spatial_index,
+    tiles,
+    topology,
+)
 from npsat_manager.tests import utils
+from npsat_backend import local_settings, settings
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import User
 
@@ -72,6 +91,483 @@ class APITestCase(TestCase):
                 models.Region.objects.filter(region_type=region_code).count(),
             )
 
+    def test_region_geometry(self):
+        """geometries should come back as the GeoJSON that was stored, in lists and gzipped on their own"""
+        region = models.Region.objects.exclude(geometry_blob=None).first()
+        stored = json.loads(region.geometry)
+        client = APIClient()
+
+        res = client.get(
+            "/api/region/?region_type={}&limit=1000".format(region.region_type)
+        )
+        listed = {result["id"]: result for result in json.loads(res.content)["results"]}
+        self.assertEqual(listed[region.id]["geometry"], stored)
+        self.assertEqual(listed[region.id]["name"], region.name)
+
+        res = client.get(
+            "/api/region/{}/geometry/".format(region.id), HTTP_ACCEPT_ENCODING="gzip"
+        )
+        self.assertEqual(res["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(res.content)), stored)
+        res = client.get("/api/region/{}/geometry/".format(region.id))
+        self.assertFalse(res.has_header("Content-Encoding"))
+        self.assertEqual(json.loads(res.content), stored)
+
+    def test_region_simplify(self):
+        """simplified geometries should be valid, smaller versions of the full ones"""
+        region = models.Region.objects.exclude(geometry_blob=None).first()
+        client = APIClient()
+        full_url = "/api/region/?region_type={}&limit=1000".format(region.region_type)
+        full = client.get(full_url)
+        self.assertEqual(
+            client.get(full_url + "&simplify=banana").status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+        previous_size = len(full.content)
+        for level in sorted(settings.GeometrySimplifyLevels):
+            simplified = client.get(full_url + "&simplify={}".format(level))
+            self.assertEqual(simplified.status_code, status.HTTP_200_OK)
+            self.assertLess(len(simplified.content), previous_size)
+            previous_size = len(simplified.content)
+
+            results = json.loads(simplified.content)["results"]
+            self.assertEqual(len(results), len(json.loads(full.content)["results"]))
+            for result in results:
+                self.assertEqual(result["geometry"]["properties"], {})
+                for polygon in geometry.iterate_polygons(result["geometry"]):
+                    for ring in polygon:
+                        self.assertGreaterEqual(len(ring), 4)
+                        numpy.testing.assert_array_equal(ring[0], ring[-1])
+
+        res = client.get("/api/region/{}/geometry/?simplify=1".format(region.id))
+        self.assertEqual(
+            json.loads(res.content),
+            json.loads(region.simplified_geometries.get(level=1).geometry),
+        )
+
+    def test_geometry_blobs(self):
+        """geometries should be stored once per content, and served by hash with immutable caching"""
+        square = {
+            "type": "Polygon",
+            "coordinates": [
+                [[-120, 36], [-119, 36], [-119, 37], [-120, 37], [-120, 36]]
+            ],
+        }
+        first = models.Region.objects.create(
+            name="first", region_type=models.Region.COUNTY, geometry=square
+        )
+        second = models.Region.objects.create(
+            name="second", region_type=models.Region.TOWNSHIPS, geometry=square
+        )
+        self.assertEqual(first.geometry_blob_id, second.geometry_blob_id)
+        self.assertAlmostEqual(first.centroid_longitude, -119.5)
+        self.assertAlmostEqual(first.centroid_latitude, 36.5)
+        # a degree square around 36.5N is about 111 km tall and 89 km wide
+        self.assertAlmostEqual(first.area, 111 * 89.4, delta=100)
+
+        # the geometry still reads like a field, from the blob once the region is loaded again
+        loaded = models.Region.objects.get(id=first.id)
+        self.assertEqual(json.loads(loaded.geometry), square)
+
+        client = APIClient()
+        url = "/api/geometry/{}/".format(first.geometry_blob_id)
+        res = client.get(url)
+        self.assertEqual(json.loads(res.content), square)
+        self.assertIn("immutable", res["Cache-Control"])
+        res = client.get(url, HTTP_IF_NONE_MATCH=res["ETag"])
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        res = client.get("/api/region/{}/".format(first.id))
+        self.assertEqual(res.data["geometry_hash"], first.geometry_blob_id)
+
+        # changing a geometry only removes the old blob once no region uses it
+        old_blob = first.geometry_blob_id
+        first.geometry = dict(square, coordinates=[square["coordinates"][0][::-1]])
+        first.save()
+        self.assertTrue(models.GeometryBlob.objects.filter(sha256=old_blob).exists())
+        second.geometry = None
+        second.save()
+        self.assertFalse(models.GeometryBlob.objects.filter(sha256=old_blob).exists())
+        self.assertIsNone(second.area)
+
+    def test_region_topology(self):
+        """shared boundaries should be stored once, and the topology should decode back to the regions"""
+        squares = [
+            models.Region(
+                id=index,
+                name=str(index),
+                region_type=models.Region.COUNTY,
+                geometry={
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [-120 + index, 36],
+                            [-119 + index, 36],
+                            [-119 + index, 37],
+                            [-120 + index, 37],
+                            [-120 + index, 36],
+                        ]
+                    ],
+                },
+            )
+            for index in range(2)
+        ]
+        built = topology.build_topology(squares)
+        # each square's outside edges, plus the edge they share
+        self.assertEqual(len(built["arcs"]), 3)
+
+        transform = built["transform"]
+        arcs = [
+            numpy.cumsum(arc, axis=0) * transform["scale"] + transform["translate"]
+            for arc in built["arcs"]
+        ]
+        for square, shape in zip(squares, built["objects"]["regions"]["geometries"]):
+            (ring_arcs,) = shape["arcs"]
+            ring = numpy.concatenate(
+                [
+                    (arcs[index] if index >= 0 else arcs[~index][::-1])[
+                        0 if position == 0 else 1 :
+                    ]
+                    for position, index in enumerate(ring_arcs)
+                ]
+            )
+            numpy.testing.assert_allclose(ring[0], ring[-1])
+            # the decoded ring may start at another corner, and is only as exact as the quantization
+            expected = {tuple(point) for point in square.geometry["coordinates"][0]}
+            self.assertEqual({tuple(point) for point in numpy.round(ring, 3)}, expected)
+
+        region_type = (
+            models.Region.objects.exclude(geometry_blob=None).first().region_type
+        )
+        with tempfile.TemporaryDirectory() as folder:
+            with mock.patch.object(settings, "TopologyFolder", folder):
+                client = APIClient()
+                res = client.get("/api/region_topology/{}/".format(region_type))
+                parsed = json.loads(b"".join(res.streaming_content))
+                res = client.get(
+                    "/api/region_topology/{}/".format(region_type),
+                    HTTP_ACCEPT_ENCODING="gzip",
+                )
+                self.assertEqual(res["Content-Encoding"], "gzip")
+                compressed = gzip.decompress(b"".join(res.streaming_content))
+                self.assertEqual(json.loads(compressed), parsed)
+                etag = res["ETag"]
+                self.assertTrue(etag.endswith('-gzip"'))
+
+                res = client.get(
+                    "/api/region_topology/{}/".format(region_type),
+                    HTTP_ACCEPT_ENCODING="gzip",
+                    HTTP_IF_NONE_MATCH=etag,
+                )
+                self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(res["ETag"], etag)
+
+                # a region saved between finding the topology and opening it removes it - it's built again
+                found = topology.get_topology_path(region_type)
+                with mock.patch.object(
+                    topology,
+                    "get_topology_path",
+                    side_effect=[found + ".removed", found],
+                ):
+                    res = client.get("/api/region_topology/{}/".format(region_type))
+                self.assertEqual(json.loads(b"".join(res.streaming_content)), parsed)
+                self.assertNotEqual(res["ETag"], etag)
+                self.assertEqual(
+                    client.get("/api/region_topology/99/").status_code,
+                    status.HTTP_404_NOT_FOUND,
+                )
+
+        self.assertEqual(parsed["type"], "Topology")
+        (collection,) = parsed["objects"].values()
+        self.assertEqual(
+            sorted(shape["id"] for shape in collection["geometries"]),
+            sorted(
+                models.Region.objects.filter(
+                    region_type=region_type, active_in_mantis=True
+                )
+                .exclude(geometry_blob=None)
+                .values_list("id", flat=True)
+            ),
+        )
+
+    def test_region_tiles(self):
+        """tiles should hold the regions clipped to them, and be revalidated by ETag"""
+        square = numpy.array([[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]], dtype=float)
+        clipped = tiles.clip_ring(square, (1, -1, 3, 1))
+        self.assertEqual(
+            {tuple(point) for point in clipped}, {(1, 0), (2, 0), (2, 1), (1, 1)}
+        )
+        numpy.testing.assert_array_equal(clipped[0], clipped[-1])
+        self.assertIsNone(tiles.clip_ring(square, (3, 3, 4, 4)))
+
+        region = models.Region.objects.exclude(geometry_blob=None).first()
+        west, south, east, north = geometry.geometry_bounds(region.geometry)
+        z = 8
+        x, y = next(
+            tiles.tiles_covering(((west + east) / 2, (south + north) / 2) * 2, z)
+        )
+        url = "/api/region_tiles/{}/{}/{}/{}/".format(region.region_type, z, x, y)
+
+        with tempfile.TemporaryDirectory() as folder:
+            with mock.patch.object(settings, "TileFolder", folder):
+                client = APIClient()
+                res = client.get(url)
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                collection = json.loads(b"".join(res.streaming_content))
+                etag = res["ETag"]
+
+                res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(res["ETag"], etag)
+
+                res = client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+                self.assertEqual(res["Content-Encoding"], "gzip")
+                self.assertNotEqual(res["ETag"], etag)
+                compressed = gzip.decompress(b"".join(res.streaming_content))
+                self.assertEqual(json.loads(compressed), collection)
+
+                # pregenerating the zoom should make the same tile
+                with open(tiles.tile_path(region.region_type, z, x, y), "rb") as tile:
+                    served = tile.read()
+                tiles.remove_tiles(region.region_type)
+                self.assertGreater(tiles.pregenerate_tiles(region.region_type, [z]), 0)
+                with open(tiles.tile_path(region.region_type, z, x, y), "rb") as tile:
+                    self.assertEqual(tile.read(), served)
+
+                # when another process moves the type to a new tiles version, regions are loaded again and
+                # tiles are rendered into a new folder, even though no region was saved here
+                shapes = tiles._get_shapes(region.region_type)
+                self.assertIs(tiles._get_shapes(region.region_type), shapes)
+                path = tiles.tile_path(region.region_type, z, x, y)
+                models.DataVersion.objects.update_or_create(
+                    name="tiles:{}".format(region.region_type),
+                    defaults={"token": "another process"},
+                )
+                self.assertIsNot(tiles._get_shapes(region.region_type), shapes)
+                self.assertNotEqual(tiles.tile_path(region.region_type, z, x, y), path)
+                res = client.get(url)
+                self.assertEqual(
+                    json.loads(b"".join(res.streaming_content)), collection
+                )
+                self.assertTrue(
+                    os.path.exists(tiles.tile_path(region.region_type, z, x, y))
+                )
+
+                self.assertEqual(
+                    client.get(
+                        "/api/region_tiles/{}/{}/0/0/".format(
+                            region.region_type, settings.TileMaxZoom + 1
+                        )
+                    ).status_code,
+                    status.HTTP_404_NOT_FOUND,
+                )
+
+        self.assertIn(region.id, [feature["id"] for feature in collection["features"]])
+        tile_west, tile_south, tile_east, tile_north = tiles.tile_bounds(z, x, y)
+        margin = (tile_east - tile_west) * tiles.BUFFER_PIXELS / tiles.TILE_SIZE + 1e-3
+        for feature in collection["features"]:
+            points = numpy.concatenate(
+                [
+                    numpy.array(ring)
+                    for polygon in feature["geometry"]["coordinates"]
+                    for ring in polygon
+                ]
+            )
+            self.assertTrue(numpy.all(points[:, 0] >= tile_west - margin))
+            self.assertTrue(numpy.all(points[:, 0] <= tile_east + margin))
+            self.assertTrue(numpy.all(points[:, 1] >= tile_south - margin))
+            self.assertTrue(numpy.all(points[:, 1] <= tile_north + margin))
+
+    def test_region_location(self):
+        """regions should be found by bounding box and by the point they contain"""
+        outer = numpy.array([[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]], dtype=float)
+        hole = numpy.array([[1, 1], [3, 1], [3, 3], [1, 3], [1, 1]], dtype=float)
+        self.assertTrue(spatial_index.point_in_polygon([outer, hole], 0.5, 2))
+        self.assertFalse(spatial_index.point_in_polygon([outer, hole], 2, 2))
+        self.assertFalse(spatial_index.point_in_polygon([outer, hole], 5, 2))
+
+        # so the index is built from this test's regions
+        reference_cache.bump_version(reference_cache.REGIONS)
+        client = APIClient()
+        region = models.Region.objects.exclude(geometry_blob=None).first()
+        polygons = list(geometry.iterate_polygons(region.geometry))
+        self.assertEqual(
+            (region.bbox_west, region.bbox_south, region.bbox_east, region.bbox_north),
+            geometry.geometry_bounds(region.geometry),
+        )
+
+        res = client.get(
+            "/api/region/?limit=1000&bbox={},{},{},{}".format(
+                region.bbox_west, region.bbox_south, region.bbox_east, region.bbox_north
+            )
+        )
+        self.assertIn(region.id, [result["id"] for result in res.data["results"]])
+        res = client.get("/api/region/?bbox=0,0,1,1")
+        self.assertEqual(res.data["results"], [])
+        res = client.get("/api/region/?bbox=0,0,1")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # a point inside the region, from a grid across its bounding box
+        longitudes = numpy.linspace(region.bbox_west, region.bbox_east, 21)[1:-1]
+        latitudes = numpy.linspace(region.bbox_south, region.bbox_north, 21)[1:-1]
+        longitude, latitude = next(
+            (longitude, latitude)
+            for longitude in longitudes
+            for latitude in latitudes
+            if any(
+                spatial_index.point_in_polygon(polygon, longitude, latitude)
+                for polygon in polygons
+            )
+        )
+        # every region containing the point, testing them all
+        expected = [
+            other.id
+            for other in models.Region.objects.filter(active_in_mantis=True).exclude(
+                geometry_blob=None
+            )
+            if any(
+                spatial_index.point_in_polygon(polygon, longitude, latitude)
+                for polygon in geometry.iterate_polygons(other.geometry)
+            )
+        ]
+        res = client.get("/api/region/at/?lon={}&lat={}".format(longitude, latitude))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn(region.id, expected)
+        self.assertEqual(sorted(result["id"] for result in res.data), sorted(expected))
+
+        res = client.get(
+            "/api/region/at/?lon={}&lat={}&region_type={}".format(
+                longitude, latitude, region.region_type
+            )
+        )
+        self.assertEqual(
+            [result["id"] for result in res.data],
+            [
+                other
+                for other in expected
+                if models.Region.objects.get(id=other).region_type == region.region_type
+            ],
+        )
+        res = client.get("/api/region/at/?lon={}".format(longitude))
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # regions another process changed show up once the version it left in the database is seen
+        models.Region.objects.filter(id=region.id).update(active_in_mantis=False)
+        index = spatial_index.get_index()
+        self.assertIn(region.id, index.regions_at(longitude, latitude))
+        models.DataVersion.objects.update_or_create(
+            name=reference_cache.REGIONS, defaults={"token": "another process"}
+        )
+        self.assertIsNot(spatial_index.get_index(), index)
+        self.assertNotIn(
+            region.id, spatial_index.get_index().regions_at(longitude, latitude)
+        )
+
+    def test_region_children(self):
+        """regions should list the regions of other types inside them"""
+
+        def square(region_id, region_type, west, south, size):
+            return models.Region(
+                id=region_id,
+                name=str(region_id),
+                region_type=region_type,
+                geometry={
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [west, south],
+                            [west + size, south],
+                            [west + size, south + size],
+                            [west, south + size],
+                            [west, south],
+                        ]
+                    ],
+                },
+            )
+
+        county = square(1, models.Region.COUNTY, 0, 0, 4)
+        inside = square(2, models.Region.TOWNSHIPS, 1, 1, 1)
+        half = square(3, models.Region.TOWNSHIPS, 3.5, 1, 1)
+        outside = square(4, models.Region.TOWNSHIPS, 10, 10, 1)
+        overlaps = {
+            (parent, child): overlap
+            for parent, child, _, overlap in containment.compute_containment(
+                [county, inside, half, outside], samples=400, minimum_overlap=0.01
+            )
+        }
+        self.assertEqual(set(overlaps), {(1, 2), (1, 3), (2, 1), (3, 1)})
+        self.assertEqual(overlaps[(1, 2)], 1)
+        self.assertAlmostEqual(overlaps[(1, 3)], 0.5, places=2)
+        self.assertAlmostEqual(overlaps[(2, 1)], 1 / 16, places=2)
+
+        containment.update_containment()
+        central_valley = models.Region.objects.get(
+            region_type=models.Region.CENTRAL_VALLEY
+        )
+        client = APIClient()
+        res = client.get(
+            "/api/region/{}/children/?region_type={}".format(
+                central_valley.id, models.Region.TOWNSHIPS
+            )
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertGreater(len(res.data), 0)
+        for child in res.data:
+            self.assertEqual(child["region_type"], models.Region.TOWNSHIPS)
+            self.assertGreaterEqual(child["overlap"], 0.5)
+            # most of each township should be inside the central valley
+            self.assertTrue(
+                models.RegionContainment.objects.filter(
+                    parent=central_valley, child_id=child["id"], overlap__gte=0.5
+                ).exists()
+            )
+
+    def test_region_index(self):
+        """the region index should list regions without geometry, and geometries should come in batches"""
+        client = APIClient()
+        res = client.get(
+            "/api/region_index/?region_type={}".format(models.Region.COUNTY)
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        counties = models.Region.objects.filter(
+            region_type=models.Region.COUNTY, active_in_mantis=True
+        )
+        self.assertEqual(len(res.data), counties.count())
+        self.assertEqual(
+            set(res.data[0]),
+            {"id", "external_id", "name", "mantis_id", "region_type", "geometry_hash"},
+        )
+
+        regions = list(models.Region.objects.exclude(geometry_blob=None)[:3])
+        ids = ",".join(str(region.id) for region in regions)
+        res = client.get("/api/region_geometry/?ids={}".format(ids))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        parsed = json.loads(res.content)
+        self.assertEqual(
+            [shape["id"] for shape in parsed],
+            sorted(region.id for region in regions),
+        )
+        for shape in parsed:
+            region = models.Region.objects.get(id=shape["id"])
+            self.assertEqual(shape["geometry"], json.loads(region.geometry))
+
+        res = client.get("/api/region_geometry/?ids={}&simplify=3".format(ids))
+        for shape in json.loads(res.content):
+            self.assertEqual(
+                shape["geometry"],
+                json.loads(
+                    models.SimplifiedGeometry.objects.get(
+                        region_id=shape["id"], level=3
+                    ).geometry
+                ),
+            )
+
+        res = client.get("/api/region_geometry/?ids=1,a")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        with mock.patch.object(local_settings, "RegionGeometryBatchSize", 2):
+            res = client.get("/api/region_geometry/?ids={}".format(ids))
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_scenario_read(self):
         """
         Test all scenarios read
@@ -122,6 +618,43 @@ class APITestCase(TestCase):
                 models.Scenario.objects.filter(scenario_type=scenario_code).count(),
             )
 
+    def test_reference_cache(self):
+        """reference lists should be served from the cache until reference data changes"""
+        cache.clear()
+        client = APIClient()
+        first = client.get("/api/crop/?limit=1000")
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        etag = first["ETag"]
+
+        # only the version is looked up
+        with self.assertNumQueries(1):
+            second = client.get("/api/crop/?limit=1000")
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["ETag"], etag)
+        self.assertEqual(len(second.data["results"]), models.Crop.objects.count())
+        # parameter order doesn't matter
+        self.assertEqual(
+            client.get("/api/crop/?limit=1000&offset=0")["ETag"],
+            client.get("/api/crop/?offset=0&limit=1000")["ETag"],
+        )
+
+        res = client.get("/api/crop/?limit=1000", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res.content, b"")
+
+        crop = models.Crop.objects.order_by("name").first()
+        crop.name = "Zzz renamed"
+        crop.save()
+        res = client.get("/api/crop/?limit=1000", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res["ETag"], etag)
+        self.assertEqual(res.data["results"][-1]["name"], "Zzz renamed")
+
+        # the browsable API isn't cached
+        res = client.get("/api/crop/", HTTP_ACCEPT="text/html")
+        self.assertFalse(res.has_header("ETag"))
+        cache.clear()
+
     def test_crop_read(self):
         """
         Test all crop read
@@ -180,6 +713,70 @@ class APITestCase(TestCase):
             ).count(),
         )
 
+        res = client_no_login.get("/api/crop/?flow_scenario=999999")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_scenario_crops(self):
+        """the scenario crop matrix should match the crop list of each scenario, and follow crop changes"""
+        client = APIClient()
+        res = client.get("/api/scenario_crops/")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        matrix = {entry["scenario"]: entry for entry in json.loads(res.content)}
+        self.assertEqual(
+            set(matrix), set(models.Scenario.objects.values_list("id", flat=True))
+        )
+
+        GNLM_scen = models.Scenario.objects.get(mantis_id="GNLM")
+        crops = client.get(
+            "/api/crop/?limit=1000&flow_scenario={}".format(GNLM_scen.id)
+        ).data["results"]
+        self.assertEqual(matrix[GNLM_scen.id]["crop_code_field"], "caml_code")
+        self.assertEqual(
+            sorted(crop["id"] for crop in matrix[GNLM_scen.id]["crops"]),
+            sorted(crop["id"] for crop in crops),
+        )
+        self.assertTrue(
+            all(
+                crop["code"] == models.Crop.objects.get(id=crop["id"]).caml_code
+                for crop in matrix[GNLM_scen.id]["crops"]
+            )
+        )
+
+        # built once - later requests only look up the version
+        etag = res["ETag"]
+        with self.assertNumQueries(1):
+            res = client.get("/api/scenario_crops/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        swat_crop = models.Crop.objects.filter(crop_type=models.Crop.SWAT_CROP).first()
+        swat_crop.crop_type = models.Crop.GENERAL_CROP
+        swat_crop.save()
+        res = client.get("/api/scenario_crops/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        matrix = {entry["scenario"]: entry for entry in json.loads(res.content)}
+        self.assertIn(
+            swat_crop.id, [crop["id"] for crop in matrix[GNLM_scen.id]["crops"]]
+        )
+
+        # a scenario another process added shows up once the version it left in the database is seen
+        models.Scenario.objects.bulk_create(
+            [
+                models.Scenario(
+                    name="Added elsewhere",
+                    mantis_id="ELSEWHERE",
+                    scenario_type=models.Scenario.TYPE_LOAD,
+                    crop_code_field=models.Scenario.SWAT_CROP,
+                )
+            ]
+        )
+        models.DataVersion.objects.update_or_create(
+            name=reference_cache.CROPS, defaults={"token": "another process"}
+        )
+        scenario = models.Scenario.objects.get(name="Added elsewhere")
+        res = client.get("/api/scenario_crops/")
+        matrix = {entry["scenario"]: entry for entry in json.loads(res.content)}
+        self.assertEqual(matrix[scenario.id]["crop_code_field"], "swat_code")
+
     """
     Below are the tests of endpoints of model run. Each focuses on a specific feature.
     ====================================
@@ -343,6 +940,11 @@ class APITestCase(TestCase):
 
         res = client_logged_in.post("/api/model_run/", data, format="json")
         self.assertEqual(res.status_code, 201)
+        # every modification is stored as submitted, even for crops the load scenario doesn't use
+        self.assertEqual(
+            models.Modification.objects.filter(model_run_id=res.data["id"]).count(),
+            crops.count(),
+        )
 
         # check if the model and the BAU model is created
         self.assertEqual(models.ModelRun.objects.filter(name="BAU model").count(), 1)
@@ -358,6 +960,16 @@ class APITestCase(TestCase):
         # check if the model and the BAU model is created; it should not because we already have one
         self.assertEqual(models.ModelRun.objects.filter(name="BAU model").count(), 1)
 
+        # crops and load scenarios that don't exist are rejected
+        unknown = dict(
+            data, modifications=[{"crop": {"id": 999999}, "proportion": 0.5}]
+        )
+        res = client_logged_in.post("/api/model_run/", unknown, format="json")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        unknown = dict(data, load_scenario={"id": 999999})
+        res = client_logged_in.post("/api/model_run/", unknown, format="json")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
         # test with empty modifications
         data["modifications"] = []
         res = client_logged_in.post("/api/model_run/", data, format="json")
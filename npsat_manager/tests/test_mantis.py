@@ -0,0 +1,712 @@
+"""
+test files for the Python Mantis engine
+====================================================
+Note:
+    1. these tests run the engine's array code on small synthetic rasters - the real Ngw and land use
+        rasters aren't part of the repository, so nothing here reads them
+"""
+
+import io
+import os
+import tempfile
+from unittest import mock
+
+import numpy
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from npsat_manager import mantis, models
+from npsat_manager.sparse_urf import SparseURF
+from npsat_manager.support import (
+    compatibility,
+    geometry,
+    raster_cache,
+    raster_store,
+    region_masks,
+)
+
+
+def make_test_loadings(shape=(3, 4)):
+    """data year -> loading band, with a different random band for each year"""
+    random_state = numpy.random.RandomState(42)
+    return {
+        year: random_state.uniform(0, 100, shape) for year in (1945, 1960, 1975, 1990)
+    }
+
+
+class AnnualLoadingsTestCase(SimpleTestCase):
+    """
+    Tests for interpolating the annual loadings between the data years
+    """
+
+    def test_iterate_annual_loadings(self):
+        """blocks should match a straight linear interpolation, whatever the block size"""
+        loadings = make_test_loadings()
+        n_years = mantis.count_annual_years(loadings)
+        self.assertEqual(n_years, 1990 - 1945 + 1)
+
+        expected = numpy.empty((n_years, 3, 4))
+        for index, year in enumerate(range(1945, 1991)):
+            previous_year = max(y for y in loadings if y <= year)
+            if previous_year == 1990:
+                expected[index] = loadings[1990]
+                continue
+            next_year = min(y for y in loadings if y > year)
+            fraction = (year - previous_year) / (next_year - previous_year)
+            expected[index] = (1 - fraction) * loadings[
+                previous_year
+            ] + fraction * loadings[next_year]
+
+        for block_size in (1, 7, 15, 100):
+            annual = numpy.empty_like(expected)
+            for year_index, block in mantis.iterate_annual_loadings(
+                loadings, block_size=block_size
+            ):
+                self.assertLessEqual(block.shape[0], block_size)
+                annual[year_index : year_index + block.shape[0]] = block
+            numpy.testing.assert_allclose(annual, expected)
+
+    def test_convolve_and_sum_streaming(self):
+        """streamed convolution should equal convolving each pixel separately, then summing in space"""
+        loadings = make_test_loadings()
+        n_years = mantis.count_annual_years(loadings)
+        urfs = numpy.random.RandomState(7).uniform(0, 1, (20, 3, 4))
+
+        annual = numpy.concatenate(
+            [block.copy() for _, block in mantis.iterate_annual_loadings(loadings)]
+        )
+        expected = numpy.zeros(n_years)
+        for row in range(3):
+            for col in range(4):
+                expected += numpy.convolve(annual[:, row, col], urfs[:, row, col])[
+                    :n_years
+                ]
+
+        results = mantis.convolve_and_sum_streaming(
+            mantis.iterate_annual_loadings(loadings, block_size=6),
+            n_years=n_years,
+            unit_response_functions=urfs,
+        )
+        numpy.testing.assert_allclose(results, expected)
+
+
+class TilingTestCase(SimpleTestCase):
+    """
+    Tests for the pieces the engine runs on each spatial tile
+    """
+
+    def test_iterate_tiles(self):
+        """tiles should cover every pixel exactly once, including trimmed edge tiles"""
+        shape = (1000, 730)
+        coverage = numpy.zeros(shape, dtype=numpy.int64)
+        full_window = compatibility.full_window(shape)
+        for window in mantis.iterate_tiles(full_window, tile_size=256):
+            self.assertLessEqual(window.width, 256)
+            self.assertLessEqual(window.height, 256)
+            coverage[window.slices] += 1
+        self.assertTrue((coverage == 1).all())
+
+        self.assertEqual(
+            list(mantis.iterate_tiles(full_window, tile_size=None)),
+            [compatibility.Window(0, 0, 730, 1000)],
+        )
+
+        # tiles of a smaller window stay inside it
+        coverage[...] = 0
+        window = compatibility.Window(100, 50, 300, 520)
+        for tile in mantis.iterate_tiles(window, tile_size=256):
+            coverage[tile.slices] += 1
+        self.assertEqual(coverage.sum(), 300 * 520)
+        self.assertTrue((coverage[window.slices] == 1).all())
+
+    def test_apply_weight_lookup(self):
+        """modified codes get their weight, everything else gets the all other crops weight"""
+        land_use = numpy.array([[1, 2, 3], [-9999, 2, 5000]])
+        weights = mantis.apply_weight_lookup(land_use, {2: 0.5, 5000: 0.25})
+        numpy.testing.assert_array_equal(weights, [[1, 0.5, 1], [1, 0.5, 0.25]])
+
+        weights = mantis.apply_weight_lookup(
+            land_use, {2: 0.5, mantis.ALL_OTHER_CROPS_CODE: 0.8}
+        )
+        numpy.testing.assert_array_equal(weights, [[0.8, 0.5, 0.8], [0.8, 0.5, 0.8]])
+
+    def test_share_array(self):
+        """worker processes should see the same values whether URFs are in memory or memory-mapped"""
+        urfs = numpy.random.RandomState(3).uniform(0, 1, (5, 4, 3))
+
+        descriptor, block = mantis.share_array(urfs)
+        try:
+            shared, worker_block = mantis.attach_shared_array(descriptor)
+            numpy.testing.assert_array_equal(shared, urfs)
+            self.assertFalse(shared.flags.writeable)
+            del shared
+            worker_block.close()
+        finally:
+            block.close()
+            block.unlink()
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "urfs.npy")
+            numpy.save(path, urfs)
+            mapped = numpy.load(path, mmap_mode="r")
+            descriptor, block = mantis.share_array(mapped)
+            self.assertIsNone(block)
+            shared, _ = mantis.attach_shared_array(descriptor)
+            numpy.testing.assert_array_equal(shared, urfs)
+            del shared, mapped
+
+
+class RasterWindowTestCase(SimpleTestCase):
+    """
+    Tests for finding the block of the model grid a run needs to read
+    """
+
+    def test_align_window(self):
+        """aligned windows start and end on block edges, but never leave the raster"""
+        window = compatibility.Window(130, 10, 20, 300)
+        aligned = compatibility.align_window(window, (128, 128), (400, 200))
+        self.assertEqual(aligned, compatibility.Window(128, 0, 72, 384))
+
+    def test_project_albers(self):
+        """spot check against known California Teale Albers coordinates"""
+        x, y = geometry.project_albers(-119.0, 36.2)
+        self.assertAlmostEqual(float(x), 89806.626, places=2)
+        self.assertAlmostEqual(float(y), -201419.689, places=2)
+        x, y = geometry.project_albers(-120.0, 0.0)
+        self.assertAlmostEqual(float(x), 0, places=4)
+        self.assertAlmostEqual(float(y), -4000000, places=4)
+
+    def test_raster_cache_eviction(self):
+        """the cache should stay in its budget, evicting the least recently used arrays first"""
+        cache = raster_cache.RasterCache(max_bytes=3 * 800)
+        arrays = {name: numpy.zeros(100) for name in "abcd"}  # 800 bytes each
+        for name in "abc":
+            cache.add(name, arrays[name])
+        self.assertEqual(cache.current_bytes, 3 * 800)
+
+        self.assertIs(
+            cache.get("a"), arrays["a"]
+        )  # touch "a" so "b" becomes the oldest
+        cache.add("d", arrays["d"])
+        self.assertIsNone(cache.get("b"))
+        for name in "cad":
+            self.assertIs(cache.get(name), arrays[name])
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(cache.stats["hits"], 4)
+        self.assertEqual(cache.stats["misses"], 1)
+        self.assertLessEqual(cache.current_bytes, cache.max_bytes)
+
+        cache.add("too big", numpy.zeros(1000))
+        self.assertIsNone(cache.get("too big"))
+
+        # shrinking the budget, like worker processes do, evicts the oldest arrays
+        cache.resize(800)
+        self.assertLessEqual(cache.current_bytes, 800)
+        self.assertIs(cache.get("d"), arrays["d"])
+        self.assertIsNone(cache.get("c"))
+
+    def test_rasterize_geometry(self):
+        """scanline masks should match testing each pixel center on its own, holes included"""
+        origin_x, origin_y = geometry.project_albers(-120.0, 36.0)
+        raster_info = compatibility.RasterInfo(
+            (40, 30),
+            (float(origin_x), 100.0, 0.0, float(origin_y), 0.0, -100.0),
+            (8, 8),
+            None,
+        )
+        polygon = {
+            "type": "Polygon",
+            "coordinates": [
+                [
+                    [-119.998, 35.999],
+                    [-119.972, 35.995],
+                    [-119.985, 35.962],
+                    [-119.998, 35.999],
+                ],
+                [
+                    [-119.99, 35.99],
+                    [-119.982, 35.99],
+                    [-119.986, 35.98],
+                    [-119.99, 35.99],
+                ],
+            ],
+        }
+        runs = region_masks.rasterize_geometry(polygon, raster_info)
+        mask = region_masks.runs_to_mask(runs, compatibility.full_window((40, 30)))
+
+        # plain even-odd ray casting for every pixel center
+        rings = []
+        for ring in next(geometry.iterate_polygons(polygon)):
+            x, y = geometry.project_albers(ring[:, 0], ring[:, 1])
+            rings.append(((x - origin_x) / 100.0, (y - origin_y) / -100.0))
+        expected = numpy.zeros((40, 30), dtype=bool)
+        for row in range(40):
+            for col in range(30):
+                inside = False
+                for ring_cols, ring_rows in rings:
+                    for i in range(len(ring_cols) - 1):
+                        r0, r1 = ring_rows[i], ring_rows[i + 1]
+                        if (r0 <= row + 0.5) != (r1 <= row + 0.5):
+                            crossing = ring_cols[i] + (row + 0.5 - r0) / (r1 - r0) * (
+                                ring_cols[i + 1] - ring_cols[i]
+                            )
+                            if crossing <= col + 0.5:
+                                inside = not inside
+                expected[row, col] = inside
+
+        self.assertTrue(expected.sum() > 100)
+        numpy.testing.assert_array_equal(mask, expected)
+
+
+class EngineTestCase(SimpleTestCase):
+    """
+    Runs the whole engine against rasters in a temporary raster store
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        sources = os.path.join(self.folder.name, "sources")
+        os.makedirs(sources)
+        self.store = raster_store.RasterStore(os.path.join(self.folder.name, "store"))
+
+        random_state = numpy.random.RandomState(11)
+        shape = (37, 29)
+        # put the grid's upper left corner at a known longitude/latitude so test regions can land on it
+        origin_x, origin_y = geometry.project_albers(-120.0, 36.0)
+        geotransform = (float(origin_x), 100.0, 0.0, float(origin_y), 0.0, -100.0)
+        self.geotransform = geotransform
+        ngw_rasters = {}
+        land_use_rasters = {}
+        for year in (1945, 1960, 1975, 1990, 2005, 2020, 2035, 2050):
+            ngw_rasters[year] = os.path.join(sources, "Ngw_{}.tif".format(year))
+            land_use_rasters[year] = os.path.join(sources, "LU_{}.tif".format(year))
+            self.store.add(
+                "Ngw_{}".format(year),
+                random_state.uniform(0, 50, shape).astype(numpy.float32),
+                ngw_rasters[year],
+                geotransform,
+                None,
+                (8, 8),
+            )
+            self.store.add(
+                "LU_{}".format(year),
+                random_state.randint(0, 4, shape).astype(numpy.int16),
+                land_use_rasters[year],
+                geotransform,
+                None,
+                (8, 8),
+            )
+        self.urfs = random_state.uniform(0, 1, (30,) + shape)
+
+        self.patches = [
+            mock.patch.object(compatibility, "RASTER_STORE", self.store),
+            mock.patch.object(
+                region_masks.region_masks,
+                "folder",
+                os.path.join(self.folder.name, "region_masks"),
+            ),
+            mock.patch.dict(mantis.settings.NgwRasters, ngw_rasters, clear=True),
+            mock.patch.dict(
+                mantis.settings.LandUseRasters, land_use_rasters, clear=True
+            ),
+        ]
+        for patch in self.patches:
+            patch.start()
+        raster_cache.raster_cache.clear()
+
+    def tearDown(self):
+        mantis.shutdown_executor()  # workers were forked with the patched settings
+        for patch in reversed(self.patches):
+            patch.stop()
+        raster_cache.raster_cache.clear()
+        self.folder.cleanup()
+
+    def test_tiles_match_whole_raster(self):
+        """tiling and running the tiles in other processes shouldn't change the results"""
+        weight_lookup = {1: 0.5, 3: 0.2}
+        expected = mantis.run_tile(
+            weight_lookup,
+            compatibility.Window(0, 0, 29, 37),
+            unit_response_functions=self.urfs,
+        )
+        for tile_size, processes in ((None, 1), (10, 1), (8, 2)):
+            with mock.patch.object(
+                mantis, "make_weight_lookup", return_value=weight_lookup
+            ):
+                results = mantis.run_mantis(
+                    [],
+                    unit_response_functions=self.urfs,
+                    tile_size=tile_size,
+                    processes=processes,
+                )
+            numpy.testing.assert_allclose(results, expected)
+
+    def test_sparse_urfs_match_dense(self):
+        """compact URFs should give the same results as the dense cube they were made from"""
+        random_state = numpy.random.RandomState(5)
+        lags = numpy.arange(self.urfs.shape[0])[:, None, None]
+        starts = random_state.randint(0, 25, self.urfs.shape[1:])
+        lengths = random_state.randint(0, 6, self.urfs.shape[1:])
+        urfs = numpy.where((lags >= starts) & (lags < starts + lengths), self.urfs, 0.0)
+
+        sparse = SparseURF.from_dense(urfs)
+        numpy.testing.assert_array_equal(sparse.to_dense(), urfs)
+        self.assertLess(sparse.nbytes, urfs.nbytes / 2)
+        window = compatibility.Window(3, 5, 10, 12)
+        numpy.testing.assert_array_equal(
+            sparse.window(window).to_dense(), urfs[(slice(None),) + window.slices]
+        )
+
+        sparse_folder = os.path.join(self.folder.name, "sparse")
+        sparse.save(sparse_folder)
+        weight_lookup = {1: 0.5, 3: 0.2}
+        expected = mantis.run_tile(
+            weight_lookup,
+            compatibility.Window(0, 0, 29, 37),
+            unit_response_functions=urfs,
+        )
+        for tile_size, processes in ((None, 1), (8, 2)):
+            with mock.patch.object(
+                mantis, "make_weight_lookup", return_value=weight_lookup
+            ):
+                results = mantis.run_mantis(
+                    [],
+                    unit_response_functions=SparseURF.load(sparse_folder),
+                    tile_size=tile_size,
+                    processes=processes,
+                )
+            numpy.testing.assert_allclose(results, expected)
+
+    def test_region_masks(self):
+        """region runs should only count the pixels inside the regions"""
+        regions = [
+            models.Region(
+                id=1,
+                geometry={
+                    "type": "Polygon",
+                    "coordinates": [
+                        [[-119.995, 35.995], [-119.975, 35.99], [-119.99, 35.972]]
+                    ],
+                },
+            ),
+            models.Region(
+                id=2,
+                geometry={
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "MultiPolygon",
+                        "coordinates": [
+                            [[[-119.98, 35.98], [-119.98, 35.97], [-119.977, 35.97]]]
+                        ],
+                    },
+                },
+            ),
+        ]
+        raster_info = compatibility.get_raster_info(mantis.settings.NgwRasters[1945])
+        runs = region_masks.region_masks.union_runs(regions, raster_info)
+        mask = region_masks.runs_to_mask(runs, compatibility.full_window((37, 29)))
+        self.assertTrue(0 < mask.sum() < mask.size / 2)
+
+        weight_lookup = {1: 0.5, 3: 0.2}
+        expected = mantis.run_tile(
+            weight_lookup,
+            compatibility.Window(0, 0, 29, 37),
+            unit_response_functions=self.urfs * mask,
+        )
+        for urfs, tile_size, processes in (
+            (self.urfs, None, 1),
+            (self.urfs, 8, 2),
+            (SparseURF.from_dense(self.urfs), 10, 1),
+        ):
+            with mock.patch.object(
+                mantis, "make_weight_lookup", return_value=weight_lookup
+            ):
+                results = mantis.run_mantis(
+                    [],
+                    regions=regions,
+                    unit_response_functions=urfs,
+                    tile_size=tile_size,
+                    processes=processes,
+                )
+            numpy.testing.assert_allclose(results, expected)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.folder.name, "region_masks"))), 2
+        )
+
+    def test_float32_matches_float64(self):
+        """computing in float32 should stay within float32 precision of float64"""
+        weight_lookup = {1: 0.5, 3: 0.2}
+        window = compatibility.Window(0, 0, 29, 37)
+        expected = mantis.run_tile(
+            weight_lookup, window, unit_response_functions=self.urfs
+        )
+        with mock.patch.object(mantis.settings, "EngineDtype", "float32"):
+            changes = mantis.make_loading_changes(weight_lookup, window=window)
+            self.assertEqual(changes[2050].dtype, numpy.float32)
+            results = mantis.run_tile(
+                weight_lookup, window, unit_response_functions=self.urfs
+            )
+        self.assertEqual(results.dtype, numpy.float64)
+        numpy.testing.assert_allclose(results, expected, rtol=1e-5)
+
+    def test_batch_matches_single_runs(self):
+        """running K weight lookups in one pass should match running each on its own"""
+        weight_lookups = [{1: proportion, 3: 0.2} for proportion in (0.1, 0.5, 1.0)]
+        weight_lookups.append({mantis.ALL_OTHER_CROPS_CODE: 0.3, 2: 0.8})
+        window = compatibility.Window(0, 0, 29, 37)
+        expected = numpy.array(
+            [
+                mantis.run_tile(
+                    weight_lookup, window, unit_response_functions=self.urfs
+                )
+                for weight_lookup in weight_lookups
+            ]
+        )
+        for urfs, tile_size, processes in (
+            (self.urfs, None, 1),
+            (SparseURF.from_dense(self.urfs), 8, 2),
+        ):
+            results = mantis.run_weight_lookups(
+                weight_lookups,
+                unit_response_functions=urfs,
+                tile_size=tile_size,
+                processes=processes,
+            )
+            self.assertEqual(results.shape, expected.shape)
+            numpy.testing.assert_allclose(results, expected)
+
+    def test_reduction_ramp(self):
+        """modifications should phase in linearly between the reduction years, reusing the cached loadings"""
+        weight_lookup = {1: 0.5, 3: 0.2}
+        window = compatibility.Window(0, 0, 29, 37)
+        schedule = mantis.ReductionSchedule(2000, 2040, 2080)
+        results = mantis.run_tile(
+            weight_lookup, window, unit_response_functions=self.urfs, schedule=schedule
+        )
+
+        n_years = 2080 - 1945 + 1
+        base = numpy.concatenate(
+            [
+                block.copy()
+                for _, block in mantis.iterate_annual_loadings(
+                    mantis.make_base_loadings(window=window), last_year=2080
+                )
+            ]
+        )
+        changes = numpy.concatenate(
+            [
+                block.copy()
+                for _, block in mantis.iterate_annual_loadings(
+                    mantis.make_loading_changes(weight_lookup, window=window),
+                    last_year=2080,
+                )
+            ]
+        )
+        ramp = numpy.clip((numpy.arange(1945, 2081) - 2000) / 40, 0, 1)
+        annual = base + ramp[:, None, None] * changes
+        # loadings after the last data year stay at its value
+        numpy.testing.assert_array_equal(annual[-1], annual[2050 - 1945])
+        expected = mantis.convolve_and_sum_streaming(
+            [(0, annual)], n_years=n_years, unit_response_functions=self.urfs
+        )
+        self.assertEqual(results.shape, (n_years,))
+        numpy.testing.assert_allclose(results, expected)
+
+        # equal start and end years make a step, and moving them doesn't read or reclassify anything again
+        misses = raster_cache.raster_cache.misses
+        step = mantis.run_tile(
+            weight_lookup,
+            window,
+            unit_response_functions=self.urfs,
+            schedule=mantis.ReductionSchedule(2020, 2020, None),
+        )
+        self.assertEqual(raster_cache.raster_cache.misses, misses)
+        numpy.testing.assert_allclose(
+            step,
+            mantis.run_tile(weight_lookup, window, unit_response_functions=self.urfs),
+        )
+        numpy.testing.assert_array_equal(
+            mantis.reduction_ramp([2019, 2020, 2021], 2020, 2020), [0, 1, 1]
+        )
+
+    def test_extend_sim_end_year(self):
+        """a kept run should extend to a later sim_end_year without running the engine again"""
+        weight_lookup = {1: 0.5, 3: 0.2}
+        state_file = os.path.join(self.folder.name, "states", "run.npz")
+        # a delay that lands past the first run's last year, so the extension has to pick it up
+        unsaturated_zone = mantis.UnsaturatedZone("unsat", 0.0, 130.5)
+
+        def run(sim_end_year, state_file=None):
+            with mock.patch.object(
+                mantis, "make_weight_lookup", return_value=weight_lookup
+            ):
+                return mantis.run_mantis(
+                    [],
+                    unit_response_functions=SparseURF.from_dense(self.urfs),
+                    tile_size=10,
+                    processes=1,
+                    unsaturated_zone=unsaturated_zone,
+                    schedule=mantis.ReductionSchedule(2020, 2025, sim_end_year),
+                    state_file=state_file,
+                )
+
+        first = run(2060, state_file)
+        numpy.testing.assert_allclose(first, run(2060))
+        self.assertTrue(os.path.exists(state_file))
+
+        expected = run(2140)
+        with mock.patch.object(
+            mantis, "run_weight_lookups", side_effect=AssertionError
+        ):
+            extended = run(2140, state_file)
+            # the extension was kept too, so going further or back doesn't run anything either
+            further = run(2200, state_file)
+            earlier = run(2100, state_file)
+        self.assertEqual(extended.shape, expected.shape)
+        numpy.testing.assert_allclose(extended, expected)
+        numpy.testing.assert_allclose(extended[: len(first)], first)
+        numpy.testing.assert_allclose(further, run(2200))
+        numpy.testing.assert_allclose(earlier, expected[: 2100 - 1945 + 1])
+
+    def test_unsaturated_zone_delays(self):
+        """delays should match shifting each pixel's URF by hand, for dense and sparse URFs"""
+        weight_lookup = {1: 0.5, 3: 0.2}
+        window = compatibility.Window(0, 0, 29, 37)
+        undelayed = mantis.run_tile(
+            weight_lookup, window, unit_response_functions=self.urfs
+        )
+
+        # a single travel time shifts the whole series - fractions split it between the two years around it
+        for travel_time in (3.0, 2.25):
+            delayed = mantis.run_tile(
+                weight_lookup,
+                window,
+                unit_response_functions=self.urfs,
+                unsaturated_zone=mantis.UnsaturatedZone("unsat", 0.0, travel_time),
+            )
+            whole = int(travel_time)
+            fraction = travel_time - whole
+            expected = numpy.zeros_like(undelayed)
+            expected[whole:] += (1 - fraction) * undelayed[: len(undelayed) - whole]
+            expected[whole + 1 :] += fraction * undelayed[: len(undelayed) - whole - 1]
+            numpy.testing.assert_allclose(delayed, expected)
+
+        # per pixel delays from depth * water content / recharge, with no recharge at some pixels
+        random_state = numpy.random.RandomState(3)
+        shape = self.urfs.shape[1:]
+        depth = random_state.uniform(0, 40, shape)
+        recharge = random_state.choice([0.0, 1.0, 2.0, 4.0], shape)
+        sources = os.path.join(self.folder.name, "sources")
+        for name, array in (("depth", depth), ("recharge", recharge)):
+            self.store.add(
+                name,
+                array,
+                os.path.join(sources, "{}.tif".format(name)),
+                self.geotransform,
+                None,
+                (8, 8),
+            )
+        unsaturated_zone = mantis.UnsaturatedZone("unsat", 0.1, None)
+        with numpy.errstate(divide="ignore"):
+            delays = numpy.where(recharge > 0, depth * 0.1 / recharge, numpy.inf)
+        shifted = numpy.zeros(
+            (self.urfs.shape[0] + 2 + int(delays[numpy.isfinite(delays)].max()),)
+            + shape
+        )
+        for row, col in numpy.ndindex(shape):
+            delay = delays[row, col]
+            if numpy.isfinite(delay):
+                whole = int(delay)
+                fraction = delay - whole
+                urf = self.urfs[:, row, col]
+                shifted[whole : whole + len(urf), row, col] += (1 - fraction) * urf
+                shifted[whole + 1 : whole + 1 + len(urf), row, col] += fraction * urf
+        expected = mantis.run_tile(
+            weight_lookup, window, unit_response_functions=shifted
+        )
+
+        with mock.patch.multiple(
+            mantis.settings,
+            UnsatDepthRasters={"unsat": os.path.join(sources, "depth.tif")},
+            RechargeRaster=os.path.join(sources, "recharge.tif"),
+        ):
+            for urfs, tile_size, processes in (
+                (self.urfs, None, 1),
+                (SparseURF.from_dense(self.urfs), 8, 2),
+            ):
+                with mock.patch.object(
+                    mantis, "make_weight_lookup", return_value=weight_lookup
+                ):
+                    results = mantis.run_mantis(
+                        [],
+                        unit_response_functions=urfs,
+                        tile_size=tile_size,
+                        processes=processes,
+                        unsaturated_zone=unsaturated_zone,
+                    )
+                numpy.testing.assert_allclose(results, expected)
+
+
+class IngestRastersTestCase(SimpleTestCase):
+    """
+    Runs the ingest_rasters command into a temporary raster store, with the GIS reads mocked
+    """
+
+    def test_ingest_rasters(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # unsat depth rasters for two scenarios, with the same file name in different folders
+            sources = {}
+            for name in ("ngw", "scenario_1", "scenario_2"):
+                os.makedirs(os.path.join(folder, name))
+                file_name = "Ngw_1945.tif" if name == "ngw" else "depth.tif"
+                sources[name] = os.path.join(folder, name, file_name)
+                open(sources[name], "w").close()
+            values = {
+                source: numpy.full((3, 4), index, dtype=numpy.float32)
+                for index, source in enumerate(sources.values())
+            }
+            store_folder = os.path.join(folder, "store")
+
+            def ingest():
+                output = io.StringIO()
+                call_command("ingest_rasters", folder=store_folder, stdout=output)
+                return output.getvalue()
+
+            with mock.patch.object(compatibility, "GDAL", True), mock.patch.object(
+                compatibility,
+                "get_raster_info",
+                return_value=compatibility.RasterInfo(
+                    (3, 4), (0.0, 100.0, 0.0, 0.0, 0.0, -100.0), (3, 4), None
+                ),
+            ), mock.patch.object(
+                compatibility,
+                "read_raster_window",
+                side_effect=lambda source: values[source],
+            ), mock.patch.multiple(
+                mantis.settings,
+                NgwRasters={1945: sources["ngw"]},
+                LandUseRasters={},
+                UnsatDepthRasters={
+                    "scenario_1": sources["scenario_1"],
+                    "scenario_2": sources["scenario_2"],
+                },
+                RechargeRaster=None,
+                UnitResponseFunctionRaster=None,
+            ):
+                ingest()
+                store = raster_store.get_raster_store(store_folder)
+                names = set()
+                for source, array in values.items():
+                    name, _ = store.find(source)
+                    names.add(name)
+                    numpy.testing.assert_array_equal(store.open(name), array)
+                self.assertEqual(len(names), len(values))
+
+                output = ingest()
+                for source in values:
+                    self.assertIn(
+                        "{} is already ingested as {}".format(
+                            source, store.find(source)[0]
+                        ),
+                        output,
+                    )
@@ -6,8 +6,14 @@ Note:
     2. since we are using the Django lib provided User models, no duplicated test here for users
 """
 
+from unittest import mock
+
+import numpy
+
 from django.test import TestCase
+from npsat_backend import settings
 from npsat_manager import models
+from npsat_manager.support import compatibility, region_masks
 from django.db import transaction
 from django.contrib.auth.models import User
 from django.db import IntegrityError
@@ -252,6 +258,187 @@ class ModelRunTestCase(TestCase):
             "Ncrops 2 -9 0.7000 5 0.7000 DepthRange 20.11 350.22 ScreenLenRange 0.876 100.0 ENDofMSG\n",
         )
 
+    def test_process_results(self):
+        """Mantis output becomes one row of values per percentile, the same with float32 parsing"""
+        for dtype in ("float64", "float32"):
+            model_run = models.ModelRun.objects.get(name="Default model")
+            models.ResultPercentile.objects.filter(model=model_run).delete()
+            # 5 wells x 3 years, plus a well with a missing value
+            message = b"1 5 3 1.1 2.2 3.3 4.4 5.5 6.6 7.7 8.8 9.9 10.1 11.1 12.1 0.3 nan 0.5 EndOfMsg"
+            with mock.patch.object(models.settings, "EngineDtype", dtype):
+                models.process_results(message, model_run)
+
+            self.assertEqual(model_run.n_wells, 5)
+            self.assertEqual(model_run.results_source, models.ModelRun.RESULTS_MANTIS)
+            percentiles = {
+                result.percentile: result.values
+                for result in models.ResultPercentile.objects.filter(model=model_run)
+            }
+            self.assertEqual(
+                sorted(percentiles), sorted(settings.PERCENTILE_CALCULATIONS)
+            )
+            self.assertEqual(percentiles[50], [4.4, 8.8, 6.6])
+            self.assertEqual(percentiles[max(percentiles)][0], 10.1)
+
+    def test_python_engine_backend(self):
+        """in-process servers run the engine and save its year sums as the run's loading totals"""
+        server = models.MantisServer.objects.create(
+            host="localhost", backend=models.MantisServer.PYTHON_ENGINE
+        )
+        with mock.patch.object(models.compatibility, "PY_MANTIS", False):
+            server.startup()
+        self.assertFalse(server.online)
+        with mock.patch.object(models.compatibility, "PY_MANTIS", True):
+            server.startup()
+        self.assertTrue(server.online)
+
+        model_run = models.ModelRun.objects.get(name="Default model")
+        model_run.regions.add(models.Region.objects.get(name="Sac Basin"))
+        with mock.patch.object(models.compatibility, "PY_MANTIS", True):
+            # the Ngw rasters are for another load scenario
+            self.assertFalse(model_run.can_run_locally)
+            with mock.patch.object(
+                models.settings, "EngineLoadScenario", "test_scen_load"
+            ):
+                # the region doesn't have a geometry to make a mask from
+                self.assertFalse(model_run.can_run_locally)
+
+        # a region with a geometry, and a mask that's small enough
+        sac_basin = models.Region.objects.get(name="Sac Basin")
+        model_run.regions.set(
+            [
+                models.Region.objects.create(
+                    name="Square",
+                    region_type=models.Region.COUNTY,
+                    geometry={
+                        "type": "Polygon",
+                        "coordinates": [
+                            [[-120, 36], [-119, 36], [-119, 37], [-120, 37], [-120, 36]]
+                        ],
+                    },
+                )
+            ]
+        )
+        configured = {
+            "EngineLoadScenario": "test_scen_load",
+            "EngineFlowScenario": "test_scen_flow",
+            "UnitResponseFunctionRaster": "urfs.tif",
+        }
+        with mock.patch.object(models.compatibility, "PY_MANTIS", True), mock.patch(
+            "npsat_manager.support.compatibility.get_raster_info"
+        ), mock.patch("npsat_manager.support.region_masks.runs_window"), mock.patch(
+            "npsat_manager.support.region_masks.region_masks.union_runs"
+        ), mock.patch(
+            "npsat_manager.support.region_masks.runs_to_mask",
+            return_value=numpy.ones(10),
+        ):
+            with mock.patch.multiple(models.settings, **configured):
+                self.assertTrue(model_run.can_run_locally)
+            # without URFs, the engine has nothing to convolve the loadings with
+            without_urfs = dict(configured, UnitResponseFunctionRaster=None)
+            with mock.patch.multiple(models.settings, **without_urfs):
+                self.assertFalse(model_run.can_run_locally)
+            # the URFs were made for another flow scenario
+            other_flow = dict(configured, EngineFlowScenario="C2VsimRun01Ref6")
+            with mock.patch.multiple(models.settings, **other_flow):
+                self.assertFalse(model_run.can_run_locally)
+        model_run.regions.set([sac_basin])
+
+        from npsat_manager import mantis
+
+        with mock.patch.object(
+            mantis, "run_mantis", return_value=numpy.arange(5, dtype=numpy.float64)
+        ) as run_mantis:
+            server.send_command(model_run)
+        self.assertEqual(
+            run_mantis.call_args.kwargs["crop_code_field"], "swat_code"
+        )
+        self.assertEqual(
+            run_mantis.call_args.kwargs["schedule"],
+            mantis.ReductionSchedule(2020, 2025, 2300),
+        )
+        self.assertEqual(
+            run_mantis.call_args.kwargs["state_file"], model_run.engine_state_file
+        )
+        model_run.refresh_from_db()
+        self.assertEqual(model_run.status, models.ModelRun.COMPLETED)
+        self.assertEqual(model_run.n_wells, 0)
+        self.assertEqual(
+            model_run.results_source, models.ModelRun.RESULTS_PYTHON_ENGINE
+        )
+        # loading totals aren't concentrations, so they aren't saved as percentiles
+        self.assertEqual(model_run.loading_totals, [0, 1, 2, 3, 4])
+        self.assertFalse(
+            models.ResultPercentile.objects.filter(model=model_run).exists()
+        )
+
+    def test_choose_server(self):
+        """runs the engine can't be checked for go to Mantis instead of stopping run processing"""
+        from npsat_manager.management.commands import process_runs
+
+        command = process_runs.Command()
+        command.mantis_server = models.MantisServer(host="mantis")
+        command.local_server = models.MantisServer(
+            host="localhost", backend=models.MantisServer.PYTHON_ENGINE
+        )
+        model_run = models.ModelRun.objects.get(name="Default model")
+        with mock.patch.object(
+            models.ModelRun, "can_run_locally", new_callable=mock.PropertyMock
+        ) as can_run_locally:
+            can_run_locally.return_value = True
+            self.assertIs(command._choose_server(model_run), command.local_server)
+            can_run_locally.side_effect = FileNotFoundError("urfs.tif")
+            self.assertIs(command._choose_server(model_run), command.mantis_server)
+
+    def test_engine_state_file(self):
+        """kept engine state is only reused by runs on the same flow scenario and region boundaries"""
+        model_run = models.ModelRun.objects.get(name="Default model")
+        region = models.Region.objects.get(name="Sac Basin")
+        model_run.regions.add(region)
+        state_file = model_run.engine_state_file
+
+        model_run.sim_end_year = 2400
+        self.assertEqual(model_run.engine_state_file, state_file)
+
+        model_run.flow_scenario = models.Scenario.objects.create(
+            name="other flow",
+            mantis_id="other_flow",
+            scenario_type=models.Scenario.TYPE_FLOW,
+        )
+        self.assertNotEqual(model_run.engine_state_file, state_file)
+        model_run.flow_scenario = models.Scenario.objects.get(name="test_scen_flow")
+        self.assertEqual(model_run.engine_state_file, state_file)
+
+        region.geometry = {
+            "type": "Polygon",
+            "coordinates": [[[-120, 36], [-119, 36], [-119, 37], [-120, 36]]],
+        }
+        region.save()
+        self.assertNotEqual(model_run.engine_state_file, state_file)
+
+    def test_region_mask_key(self):
+        """mask keys come from the geometry's hash, without loading the geometry of saved regions"""
+        square = {
+            "type": "Polygon",
+            "coordinates": [[[-120, 36], [-119, 36], [-119, 37], [-120, 37], [-120, 36]]],
+        }
+        raster_info = compatibility.RasterInfo(
+            (10, 10), (0.0, 100.0, 0.0, 0.0, 0.0, -100.0), (10, 10), None
+        )
+        unsaved = models.Region(region_type=models.Region.COUNTY, geometry=square)
+        key = region_masks.RegionMaskCache.mask_key(unsaved, raster_info)
+
+        unsaved.save()
+        saved = models.Region.objects.get(id=unsaved.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                region_masks.RegionMaskCache.mask_key(saved, raster_info), key
+            )
+        other_grid = raster_info._replace(shape=(10, 11))
+        self.assertNotEqual(
+            region_masks.RegionMaskCache.mask_key(saved, other_grid), key
+        )
+
     def test_ModelRun_read(self):
         """test read to check default values if not specified"""
         model_run1 = models.ModelRun.objects.get(
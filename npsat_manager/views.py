@@ -1,3 +1,5 @@
+import json
+
 from rest_framework import viewsets
 from rest_framework.permissions import (
     BasePermission,
@@ -10,6 +12,9 @@ from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer
 
 from npsat_manager import serializers
 from npsat_manager import models
@@ -17,9 +22,18 @@ from npsat_backend import local_settings
 from npsat_manager.support import (
     tokens,
 )  # token code makes sure that all users have tokens - needs to be imported somewhere
+from npsat_manager.support import (
+    reference_cache,
+    scenario_crops,
+    spatial_index,
+    tiles,
+    topology,
+)
+from npsat_manager.support.raw_json import RawJSONRenderer
 
-from django.http import HttpResponse
-from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.db.models import F, OuterRef, Q, Subquery
 from django.contrib.auth.models import User
 
 
@@ -178,7 +192,78 @@ class GetModelStatus(APIView):
         return Response({"results": results})
 
 
-class ScenarioViewSet(viewsets.ModelViewSet):
+def etag_matches(request, etag):
+    """whether the request's If-None-Match has the ETag, so the client already has what it would get"""
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH", "")
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+
+class PrerenderedResponse(Response):
+    """
+    A Response whose content was rendered earlier, and is sent as it is. Its data is only parsed back out of the
+    content if something asks for it.
+    """
+
+    def __init__(self, content, content_type, **kwargs):
+        super().__init__(content_type=content_type, **kwargs)
+        # setting the content marks the response as rendered
+        self.content = content
+
+    @property
+    def data(self):
+        if self._data is None and self.content:
+            self._data = json.loads(self.content)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+
+class ReferenceCacheMixin(object):
+    """
+    Serves a viewset's JSON list responses from reference_cache, rendered once per reference data version and
+    set of query parameters, with strong ETags so clients that already have a response get a 304. Other
+    formats (like the browsable API, which shows who's logged in) skip the cache.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != "json":
+            return super().list(request, *args, **kwargs)
+
+        # the whole URL, since paginated responses link to the next page with it
+        key = reference_cache.response_key(
+            request.build_absolute_uri(request.path),
+            request.query_params,
+            request.accepted_media_type,
+        )
+        cached = reference_cache.get_response(key)
+        if cached is None:
+            response = super().list(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            content = request.accepted_renderer.render(
+                response.data,
+                request.accepted_media_type,
+                self.get_renderer_context(),
+            )
+            cached = reference_cache.set_response(
+                key, content, request.accepted_media_type
+            )
+
+        content, content_type, etag = cached
+        if etag_matches(request, etag):
+            response = PrerenderedResponse(
+                b"", content_type, status=status.HTTP_304_NOT_MODIFIED
+            )
+        else:
+            response = PrerenderedResponse(content, content_type)
+        response["ETag"] = etag
+        return response
+
+
+class ScenarioViewSet(ReferenceCacheMixin, viewsets.ModelViewSet):
     """
     scenario name
 
@@ -198,7 +283,7 @@ class ScenarioViewSet(viewsets.ModelViewSet):
         return queryset
 
 
-class CropViewSet(viewsets.ModelViewSet):
+class CropViewSet(ReferenceCacheMixin, viewsets.ModelViewSet):
     """
     Crop Names and Codes
 
@@ -215,18 +300,59 @@ class CropViewSet(viewsets.ModelViewSet):
         queryset = models.Crop.objects.filter(active_in_mantis=True).order_by("name")
         scenario_id = self.request.query_params.get("flow_scenario", False)
         if scenario_id:
-            scenario = models.Scenario.objects.get(id=scenario_id)
-            crop_type = scenario.crop_code_field
-            crop_type_list = [models.Crop.ALL_OTHER_CROPS, models.Crop.GENERAL_CROP]
-            if crop_type == models.Scenario.GNLM_CROP:
-                crop_type_list.append(models.Crop.GNLM_CROP)
-            elif crop_type == models.Scenario.SWAT_CROP:
-                crop_type_list.append(models.Crop.SWAT_CROP)
+            crop_types = scenario_crops.get_map().crop_types
+            try:
+                crop_type_list = crop_types[int(scenario_id)]
+            except (KeyError, ValueError):
+                raise ValidationError(
+                    {"flow_scenario": "No scenario {}".format(scenario_id)}
+                )
             queryset = queryset.filter(crop_type__in=crop_type_list)
         return queryset
 
 
-class RegionViewSet(viewsets.ModelViewSet):
+class ScenarioCrops(APIView):
+    """
+    API endpoint that returns the crops every scenario uses - the code field the scenario identifies them by
+    (caml_code or swat_code) and its active crops' ids and codes - so a client can get them all in one request.
+
+    Permissions: IsAdminUser | ReadOnly
+    """
+
+    permission_classes = [IsAdminUser | ReadOnly]
+    http_method_names = ["get"]
+
+    def get(self, request):
+        crop_map = scenario_crops.get_map()
+        if etag_matches(request, crop_map.etag):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(crop_map.content, content_type="application/json")
+        response["ETag"] = crop_map.etag
+        return response
+
+
+def get_simplify_level(request):
+    """the ?simplify= level asked for, as a key of settings.GeometrySimplifyLevels, or None for full geometries"""
+    simplify = request.query_params.get("simplify")
+    if not simplify:
+        return None
+    try:
+        level = int(simplify)
+    except ValueError:
+        level = None
+    if level not in local_settings.GeometrySimplifyLevels:
+        raise ValidationError(
+            {
+                "simplify": "Must be one of {}".format(
+                    sorted(local_settings.GeometrySimplifyLevels)
+                )
+            }
+        )
+    return level
+
+
+class RegionViewSet(ReferenceCacheMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows listing of Region
 
@@ -238,14 +364,339 @@ class RegionViewSet(viewsets.ModelViewSet):
     ]  # Admin users can do any operation, others, can read from the API, but not write
 
     serializer_class = serializers.RegionSerializer
+    # geometries are passed through as the JSON text they're stored as, rather than parsed and encoded again
+    renderer_classes = [RawJSONRenderer, BrowsableAPIRenderer]
 
     def get_queryset(self):
         queryset = models.Region.objects.filter(active_in_mantis=True).order_by("name")
         region_type = self.request.query_params.get("region_type", False)
         if region_type:
             queryset = queryset.filter(region_type=region_type)
+        bbox = self.get_bbox()
+        if bbox is not None:
+            # regions whose bounding boxes overlap the one asked for
+            west, south, east, north = bbox
+            queryset = queryset.filter(
+                bbox_west__lte=east,
+                bbox_east__gte=west,
+                bbox_south__lte=north,
+                bbox_north__gte=south,
+            )
+
+        simplify_level = self.get_simplify_level()
+        if simplify_level is not None:
+            # swap the full geometry for the simplified one at that level
+            simplified = models.SimplifiedGeometry.objects.filter(
+                region=OuterRef("pk"), level=simplify_level
+            ).values("geometry")[:1]
+            queryset = queryset.annotate(
+                simplified_geometry=Subquery(
+                    simplified, output_field=models.RawJSONField()
+                )
+            )
+        elif self.action == "geometry":
+            queryset = queryset.select_related("geometry_blob")
+        else:
+            # the geometry comes along in the same query, but its gzipped copy isn't needed
+            queryset = queryset.select_related("geometry_blob").defer(
+                "geometry_blob__geometry_gzip"
+            )
         return queryset
 
+    def get_serializer_class(self):
+        if self.get_simplify_level() is not None:
+            return serializers.SimplifiedRegionSerializer
+        return serializers.RegionSerializer
+
+    def get_simplify_level(self):
+        return get_simplify_level(self.request)
+
+    def get_bbox(self):
+        """the ?bbox=west,south,east,north asked for, in degrees, or None"""
+        bbox = self.request.query_params.get("bbox")
+        if not bbox:
+            return None
+        try:
+            west, south, east, north = [float(value) for value in bbox.split(",")]
+        except ValueError:
+            raise ValidationError({"bbox": "Must be west,south,east,north in degrees"})
+        if west > east or south > north:
+            raise ValidationError(
+                {"bbox": "west and south can't be past east and north"}
+            )
+        return west, south, east, north
+
+    @action(detail=False, methods=["get"])
+    def at(self, request):
+        """
+        The regions containing the point at ?lon=&lat= (in degrees), tested against their exact geometries.
+        Takes the same region_type and simplify parameters as the list.
+        """
+        try:
+            longitude = float(request.query_params["lon"])
+            latitude = float(request.query_params["lat"])
+        except (KeyError, ValueError):
+            raise ValidationError({"lon": "lon and lat are required, in degrees"})
+        # the queryset filters on region_type too - this just saves exact tests of other types' regions
+        region_type = request.query_params.get("region_type", "")
+
+        region_ids = spatial_index.get_index().regions_at(
+            longitude,
+            latitude,
+            region_type=int(region_type) if region_type.isdigit() else None,
+        )
+        queryset = self.get_queryset().filter(id__in=region_ids)
+        return Response(self.get_serializer(queryset, many=True).data)
+
+    @action(detail=True, methods=["get"])
+    def children(self, request, pk=None):
+        """
+        The regions of other types inside this one, each with the fraction of its area that's inside as overlap.
+        Takes region_type to pick the type of the children, min_overlap (default 0.5) for how much of a child has
+        to be inside, and the list's simplify parameter.
+        """
+        # not self.get_object(), since region_type is the children's type, not this region's
+        region = get_object_or_404(
+            models.Region.objects.filter(active_in_mantis=True), pk=pk
+        )
+        self.check_object_permissions(request, region)
+        try:
+            min_overlap = float(request.query_params.get("min_overlap", 0.5))
+        except ValueError:
+            raise ValidationError({"min_overlap": "Must be a number from 0 to 1"})
+
+        containments = models.RegionContainment.objects.filter(
+            parent=region, overlap__gte=min_overlap
+        )
+        region_type = request.query_params.get("region_type", "")
+        if region_type.isdigit():
+            containments = containments.filter(child_region_type=region_type)
+        overlaps = dict(containments.values_list("child_id", "overlap"))
+        # get_queryset applies region_type and the other list filters to the children
+        children = self.get_queryset().filter(id__in=overlaps)
+        return Response(
+            [
+                dict(child, overlap=overlaps[child["id"]])
+                for child in self.get_serializer(children, many=True).data
+            ]
+        )
+
+    @action(detail=True, methods=["get"])
+    def geometry(self, request, pk=None):
+        """
+        Just the region's GeoJSON. It's sent gzipped, as it was compressed when the region was saved, to any client
+        that accepts gzip. With ?simplify=, it's the simplified geometry at that level instead.
+        """
+        region = self.get_object()
+        if self.get_simplify_level() is not None:
+            return HttpResponse(
+                region.simplified_geometry or "null", content_type="application/json"
+            )
+
+        if region.geometry_blob is None:
+            return HttpResponse("null", content_type="application/json")
+        return geometry_blob_response(request, region.geometry_blob)
+
+
+def geometry_blob_response(request, blob):
+    """
+    A GeometryBlob's JSON, gzipped for clients that accept it. Its hash is its ETag, so a client that already
+    has it gets a 304.
+    """
+    etag = '"{}"'.format(blob.sha256)
+    if etag_matches(request, etag):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    elif "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+        response = HttpResponse(
+            bytes(blob.geometry_gzip), content_type="application/json"
+        )
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = HttpResponse(blob.geometry, content_type="application/json")
+    response["ETag"] = etag
+    response["Vary"] = "Accept-Encoding"
+    return response
+
+
+class GeometryBlobView(APIView):
+    """
+    API endpoint that returns a geometry by the SHA-256 it's stored under (a region's geometry_hash). What's
+    under a hash never changes, so responses can be cached indefinitely.
+
+    Permissions: IsAdminUser | ReadOnly
+    """
+
+    permission_classes = [IsAdminUser | ReadOnly]
+    http_method_names = ["get"]
+
+    def get(self, request, sha256):
+        blob = get_object_or_404(models.GeometryBlob, sha256=sha256)
+        response = geometry_blob_response(request, blob)
+        response["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+class RegionIndex(APIView):
+    """
+    API endpoint that lists every active region without its geometry - just what dropdowns and lookups need,
+    read straight from the columns without loading geometries. Not paginated.
+
+    Optional params:
+            region_type: only list regions of this type
+
+    Permissions: IsAdminUser | ReadOnly
+    """
+
+    permission_classes = [IsAdminUser | ReadOnly]
+    http_method_names = ["get"]
+
+    def get(self, request):
+        regions = models.Region.objects.filter(active_in_mantis=True).order_by("name")
+        region_type = request.query_params.get("region_type")
+        if region_type:
+            regions = regions.filter(region_type=region_type)
+        return Response(
+            list(
+                regions.values(
+                    "id",
+                    "external_id",
+                    "name",
+                    "mantis_id",
+                    "region_type",
+                    geometry_hash=F("geometry_blob"),
+                )
+            )
+        )
+
+
+class RegionGeometry(APIView):
+    """
+    API endpoint that returns the geometries of several regions at once, for fetching shapes as they're needed
+    after listing regions with /api/region_index/. Geometries are passed through as the JSON they're stored as.
+
+    Params:
+            ids: comma separated region ids, at most settings.RegionGeometryBatchSize of them
+            simplify: optional level from settings.GeometrySimplifyLevels, for simplified geometries
+
+    Permissions: IsAdminUser | ReadOnly
+    """
+
+    permission_classes = [IsAdminUser | ReadOnly]
+    http_method_names = ["get"]
+    renderer_classes = [RawJSONRenderer, BrowsableAPIRenderer]
+
+    def get(self, request):
+        try:
+            ids = [
+                int(region_id) for region_id in request.query_params["ids"].split(",")
+            ]
+        except (KeyError, ValueError):
+            raise ValidationError({"ids": "Must be region ids, joined by commas"})
+        if len(ids) > local_settings.RegionGeometryBatchSize:
+            raise ValidationError(
+                {
+                    "ids": "At most {} regions at a time".format(
+                        local_settings.RegionGeometryBatchSize
+                    )
+                }
+            )
+
+        simplify_level = get_simplify_level(request)
+        if simplify_level is None:
+            geometries = (
+                models.Region.objects.filter(id__in=ids, active_in_mantis=True)
+                .order_by("id")
+                .values_list("id", "geometry_blob__geometry")
+            )
+        else:
+            geometries = (
+                models.SimplifiedGeometry.objects.filter(
+                    region_id__in=ids,
+                    region__active_in_mantis=True,
+                    level=simplify_level,
+                )
+                .order_by("region_id")
+                .values_list("region_id", "geometry")
+            )
+        return Response(
+            [
+                {"id": region_id, "geometry": region_geometry}
+                for region_id, region_geometry in geometries
+            ]
+        )
+
+
+class RegionTopology(APIView):
+    """
+    API endpoint that returns every active region of a region_type as a TopoJSON topology - shared boundaries
+    are only sent once. Topologies are prebuilt, and sent gzipped to clients that accept it. They carry ETags,
+    and a request with a matching If-None-Match gets a 304 with no body.
+
+    Permissions: IsAdminUser | ReadOnly
+    """
+
+    permission_classes = [IsAdminUser | ReadOnly]
+    http_method_names = ["get"]
+
+    def get(self, request, region_type):
+        region_type = int(region_type)
+        if region_type not in dict(models.Region.REGION_TYPE):
+            raise Http404("No region type {}".format(region_type))
+
+        accepts_gzip = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+        try:
+            topology_file = open(
+                topology.get_topology_path(region_type, compressed=accepts_gzip), "rb"
+            )
+        except FileNotFoundError:
+            # a region was saved after the topology was found, which removed it - build it again
+            topology_file = open(
+                topology.get_topology_path(region_type, compressed=accepts_gzip), "rb"
+            )
+        etag = topology.topology_etag(topology_file, compressed=accepts_gzip)
+        if etag_matches(request, etag):
+            topology_file.close()
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = FileResponse(topology_file, content_type="application/json")
+            if accepts_gzip:
+                response["Content-Encoding"] = "gzip"
+        response["ETag"] = etag
+        response["Vary"] = "Accept-Encoding"
+        return response
+
+
+class RegionTiles(APIView):
+    """
+    API endpoint that returns the regions of a region_type in one web mercator tile, as a GeoJSON
+    FeatureCollection simplified for the tile's zoom and clipped to it. Tiles carry strong ETags, and a request
+    with a matching If-None-Match gets a 304 with no body.
+
+    Permissions: IsAdminUser | ReadOnly
+    """
+
+    permission_classes = [IsAdminUser | ReadOnly]
+    http_method_names = ["get"]
+
+    def get(self, request, region_type, z, x, y):
+        region_type, z, x, y = int(region_type), int(z), int(x), int(y)
+        if region_type not in dict(models.Region.REGION_TYPE):
+            raise Http404("No region type {}".format(region_type))
+        if not tiles.tile_exists(z, x, y):
+            raise Http404("No tile {}/{}/{}".format(z, x, y))
+
+        accepts_gzip = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+        path, etag = tiles.get_tile(region_type, z, x, y, compressed=accepts_gzip)
+        if etag_matches(request, etag):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = FileResponse(open(path, "rb"), content_type="application/json")
+            if accepts_gzip:
+                response["Content-Encoding"] = "gzip"
+        response["ETag"] = etag
+        response["Vary"] = "Accept-Encoding"
+        return response
+
 
 class ModelRunViewSet(viewsets.ModelViewSet):
     """